@@ -1,26 +1,1520 @@
 import typing
 import openstudio
-import pandas as pd
 from pathlib import Path
 from inspect import getsourcefile
 from os.path import abspath
+import argparse
+import array
+import calendar
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import functools
+import glob
+import hashlib
+import itertools
 import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import xml.etree.ElementTree as ET
+
+RESOURCES_PATH = Path(abspath(getsourcefile(lambda:0))).parent.joinpath("resources/resources.xlsx").resolve()
+SHEETS = ["people", "schedules", "schedule_sets", "materials", "lights", "equipment", "infiltration", "outdoor_air", "space_types",
+          "constructions", "construction_sets"]
+# optional sheet of {alias, space_type} rows, extra names assign_space_types matches spaces by
+ALIAS_SHEET = "space_type_aliases"
+# sheets a workbook may leave out, they read as no rows
+OPTIONAL_SHEETS = {"constructions", "construction_sets", ALIAS_SHEET}
+# bump when the layout of the cached records changes
+CACHE_VERSION = 6
+# space types without a schedule_set use this one
+DEFAULT_SCHEDULE_SET = "Office"
+# column each sheet's rows are referenced by
+KEYS = {"people": "description", "lights": "description", "equipment": "description", "infiltration": "description",
+        "outdoor_air": "description", "schedule_sets": "name", "space_types": "name",
+        "materials": "name", "constructions": "name", "construction_sets": "name"}
+# schedule_sets column -> DefaultScheduleSet setter
+SCHEDULE_SET_COLUMNS = {
+    "hours_of_operation": "setHoursofOperationSchedule",
+    "number_of_people": "setNumberofPeopleSchedule",
+    "lighting": "setLightingSchedule",
+    "electric_equipment": "setElectricEquipmentSchedule",
+    "infiltration": "setInfiltrationSchedule",
+}
+# how the schedules sheet is built: ScheduleRuleset trees or ScheduleFile columns of a shared CSV
+SCHEDULE_FORMATS = ["Ruleset", "ScheduleFile"]
+
+# (lower, upper) of the ScheduleTypeLimits OpenStudio gives each schedule type (Fractional, OnOff), keyed by lowercase schedule_type
+SCHEDULE_TYPE_LIMITS = {"occupancy": (0.0, 1.0), "lighting": (0.0, 1.0), "equipment": (0.0, 1.0), "hvac": (0.0, 1.0), "infiltration": (0.0, 1.0)}
+
+# materials type -> {column: setter} of the OpenStudio material class of that name
+MATERIAL_PROPERTIES = {
+    "StandardOpaqueMaterial": {"roughness": "setRoughness", "thickness": "setThickness", "conductivity": "setConductivity",
+                               "density": "setDensity", "specific_heat": "setSpecificHeat",
+                               "thermal_absorptance": "setThermalAbsorptance", "solar_absorptance": "setSolarAbsorptance",
+                               "visible_absorptance": "setVisibleAbsorptance"},
+    "MasslessOpaqueMaterial": {"roughness": "setRoughness", "thermal_resistance": "setThermalResistance",
+                               "thermal_absorptance": "setThermalAbsorptance", "solar_absorptance": "setSolarAbsorptance",
+                               "visible_absorptance": "setVisibleAbsorptance"},
+    "AirGap": {"thermal_resistance": "setThermalResistance"},
+    "SimpleGlazing": {"u_factor": "setUFactor", "shgc": "setSolarHeatGainCoefficient", "visible_transmittance": "setVisibleTransmittance"},
+}
+# construction_sets column -> (DefaultConstructionSet child, its setter)
+CONSTRUCTION_SET_COLUMNS = {
+    "exterior_wall": ("DefaultExteriorSurfaceConstructions", "setWallConstruction"),
+    "exterior_floor": ("DefaultExteriorSurfaceConstructions", "setFloorConstruction"),
+    "exterior_roof": ("DefaultExteriorSurfaceConstructions", "setRoofCeilingConstruction"),
+    "interior_wall": ("DefaultInteriorSurfaceConstructions", "setWallConstruction"),
+    "interior_floor": ("DefaultInteriorSurfaceConstructions", "setFloorConstruction"),
+    "interior_ceiling": ("DefaultInteriorSurfaceConstructions", "setRoofCeilingConstruction"),
+    "ground_wall": ("DefaultGroundContactSurfaceConstructions", "setWallConstruction"),
+    "ground_floor": ("DefaultGroundContactSurfaceConstructions", "setFloorConstruction"),
+    "ground_roof": ("DefaultGroundContactSurfaceConstructions", "setRoofCeilingConstruction"),
+    "fixed_window": ("DefaultExteriorSubSurfaceConstructions", "setFixedWindowConstruction"),
+    "operable_window": ("DefaultExteriorSubSurfaceConstructions", "setOperableWindowConstruction"),
+    "exterior_door": ("DefaultExteriorSubSurfaceConstructions", "setDoorConstruction"),
+    "glass_door": ("DefaultExteriorSubSurfaceConstructions", "setGlassDoorConstruction"),
+    "skylight": ("DefaultExteriorSubSurfaceConstructions", "setSkylightConstruction"),
+    "interior_window": ("DefaultInteriorSubSurfaceConstructions", "setFixedWindowConstruction"),
+    "interior_door": ("DefaultInteriorSubSurfaceConstructions", "setDoorConstruction"),
+}
+
+# sheet -> {column: "number" | "text" | "time"} the builders read, checked by validate_library
+VALUE_TYPES = {
+    "people": {"area per person": "number"},
+    "lights": {"Adjusted IPD": "number"},
+    "equipment": {"W/m2": "number"},
+    "infiltration": {"hvac_off": "number"},
+    "outdoor_air": {"L/s/person": "number"},
+    "schedules": {"space_type": "text", "schedule_type": "text", "day_type": "day_type", "to": "time", "value": "number"},
+}
+CLOCK = re.compile(r"^\d{1,2}:\d{2}(:\d{2})?$")
+# schedules day_type -> the part of a ruleset it becomes, its default day or a weekend rule
+DAY_TYPES = {"weekdays": "default", "default": "default", "weekend": "weekend"}
+
+# sheet -> {column: sheet whose row it names}
+REFERENCES = {
+    "space_types": {"schedule_set": "schedule_sets", "outdoor_air": "outdoor_air", "infiltration": "infiltration",
+                    "lights": "lights", "equipment": "equipment", "people": "people", "construction_set": "construction_sets"},
+    "schedule_sets": {column: "schedules" for column in SCHEDULE_SET_COLUMNS},
+    "construction_sets": {column: "constructions" for column in CONSTRUCTION_SET_COLUMNS},
+    "constructions": {"material": "materials"},
+}
+
+
+# sheet -> ModelObject cast of the objects built from it
+LIBRARY_CASTS = {"schedules": "to_ScheduleRuleset", "schedule_sets": "to_DefaultScheduleSet",
+                 "people": "to_PeopleDefinition", "lights": "to_LightsDefinition",
+                 "equipment": "to_ElectricEquipmentDefinition", "infiltration": "to_SpaceInfiltrationDesignFlowRate",
+                 "outdoor_air": "to_DesignSpecificationOutdoorAir", "space_types": "to_SpaceType",
+                 "materials": "to_Material", "constructions": "to_Construction", "construction_sets": "to_DefaultConstructionSet"}
+# AdditionalProperties features upsert runs tag library objects with
+TAG_SHEET = "aus_library_sheet"
+TAG_KEY = "aus_library_key"
+TAG_FINGERPRINT = "aus_library_fingerprint"
+# Building features an incremental run leaves for the next one
+STATE_WORKBOOK = "aus_library_workbook"
+STATE_ROWS = "aus_library_rows"
+
+# by-name lookups made while building, read as deltas by Trace
+LOOKUPS = collections.Counter()
+
+# prebuilt libraries and schedule CSVs kept next to a workbook, the least recently used beyond that are removed
+PREBUILT_SIZE = 8
+
+# object types merge_library reuses when model has one with the same fields from this index on
+MERGE_REUSE = {"OS:ScheduleTypeLimits": 1, "OS:External:File": 2}
+
+# workbooks load_library keeps parsed for the life of the process, {(path, content hash): entry}, least recently used first
+LIBRARY_REGISTRY = collections.OrderedDict()
+# how many workbooks, or versions of one, the registry holds before evicting
+REGISTRY_SIZE = 8
+REGISTRY_LOCK = threading.Lock()
+# measure argument values for the registry
+REGISTRY_MODES = ["Use", "Bypass", "Clear"]
+
+# sheet -> (SpaceType load getter, load's definition getter, value getter, setter) of the value a sweep variant scales,
+# outdoor air hangs off the space type directly
+VARIANT_FIELDS = {
+    "lights": ("lights", "lightsDefinition", "wattsperSpaceFloorArea", "setWattsperSpaceFloorArea"),
+    "equipment": ("electricEquipment", "electricEquipmentDefinition", "wattsperSpaceFloorArea", "setWattsperSpaceFloorArea"),
+    "people": ("people", "peopleDefinition", "spaceFloorAreaperPerson", "setSpaceFloorAreaperPerson"),
+    "outdoor_air": (None, "designSpecificationOutdoorAir", "outdoorAirFlowperPerson", "setOutdoorAirFlowperPerson"),
+}
+
+# load_report values of a space, in report order: densities, people, air and the equivalent full-load hours of the load schedules
+REPORT_COLUMNS = ["lighting_w_m2", "equipment_w_m2", "m2_per_person", "infiltration_ach", "oa_l_s_person",
+                  "lighting_eflh", "equipment_eflh", "occupancy_eflh"]
+# report column -> (space_types column, sheet column) of the library value a space type is expected to have
+REPORT_SOURCES = {"lighting_w_m2": ("lights", "Adjusted IPD"), "equipment_w_m2": ("equipment", "W/m2"),
+                  "m2_per_person": ("people", "area per person"), "infiltration_ach": ("infiltration", "hvac_off"),
+                  "oa_l_s_person": ("outdoor_air", "L/s/person")}
+# eflh report column -> (schedule_sets column of the library schedule it is expected to come from, report column of the load it schedules)
+REPORT_SCHEDULES = {"lighting_eflh": ("lighting", "lighting_w_m2"), "equipment_eflh": ("electric_equipment", "equipment_w_m2"),
+                    "occupancy_eflh": ("number_of_people", "m2_per_person")}
+# relative difference from the workbook a space type value is reported as a mismatch at
+REPORT_TOLERANCE = 1e-3
+
+# file names of export_library, <name>.<version>.osm with its components in <name>.<version>/ and the manifest <name>.json
+EXPORT_NAME = "aus_library"
+
+# any OpenStudio handle, renewed when a prebuilt library is merged so it can go into a model more than once
+HANDLE = re.compile(r"\{[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\}")
+
+
+class LibraryError(Exception):
+    """ the workbook describes something that can't be built, e.g. a row naming a missing row """
+
+
+class Record(collections.abc.Mapping):
+    """ one workbook row, read-only: its values in column order and the {column: position} all rows of its sheet share
+
+    Reads like the dict it replaces (get, [], items, dict(record)) without every row holding its own
+    hash table of the column names, about half the memory of a dict row.
+    """
+    __slots__ = ("_columns", "_values")
+
+    def __init__(self, columns:dict, values:tuple):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, column):
+        return self._values[self._columns[column]]
+
+    def get(self, column, default=None):
+        i = self._columns.get(column)
+        return default if i is None else self._values[i]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return f"Record({dict(self)!r})"
+
+
+class Upsert:
+    """ library objects a previous upsert run tagged, claimed by key as their rows are rebuilt """
+
+    def __init__(self, model):
+        self.objects = library_objects(model)
+        self.counts = collections.Counter()
+        self.seen = collections.Counter()
+
+    def tag_key(self, sheet, key):
+        """ rows repeating a name (the lights sheet has some) are told apart by their order """
+        self.seen[sheet, key] += 1
+        return duplicate_key(key, self.seen[sheet, key])
+
+    def claim(self, sheet, key):
+        LOOKUPS["upsert"] += 1
+        return self.objects.get(sheet, {}).pop(key, (None, None))
+
+    def remove_stale(self, workbook:dict):
+        """ remove unclaimed objects whose key is no longer in the workbook, returns how many """
+        removed = 0
+        # dependents first so nothing is left pointing at a removed object
+        for sheet in ["space_types", "schedule_sets", "people", "lights", "equipment", "infiltration", "outdoor_air", "schedules",
+                      "construction_sets", "constructions", "materials"]:
+            seen = collections.Counter(row_key(sheet, r) for r in workbook.get(sheet, []))
+            keys = {duplicate_key(key, n) for key, count in seen.items() for n in range(1, count + 1)}
+            for key, (obj, _) in self.objects.get(sheet, {}).items():
+                if key not in keys:
+                    obj.remove()
+                    removed += 1
+        self.counts["removed"] += removed
+        return removed
+
+
+class Trace:
+    """ wall time, OpenStudio objects created and by-name lookups for each phase of a run """
+
+    def __init__(self, model):
+        self.model = model
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start, objects, lookups = time.perf_counter(), self.model.numObjects(), sum(LOOKUPS.values())
+        try:
+            yield
+        finally:
+            self.phases.append({
+                "phase": name,
+                "seconds": time.perf_counter() - start,
+                "objects": self.model.numObjects() - objects,
+                "lookups": sum(LOOKUPS.values()) - lookups,
+            })
+
+    def report(self, runner):
+        """ one registerInfo line and registerValue triple per phase, plus the totals """
+        totals = {"seconds": 0.0, "objects": 0, "lookups": 0}
+        for p in self.phases:
+            runner.registerInfo(f"{p['phase']}: {p['seconds']:.3f} s, {p['objects']} objects, {p['lookups']} lookups")
+            runner.registerValue(f"{p['phase']}_seconds", p["seconds"], "s")
+            runner.registerValue(f"{p['phase']}_objects", p["objects"])
+            runner.registerValue(f"{p['phase']}_lookups", p["lookups"])
+            totals = {k: v + p[k] for k, v in totals.items()}
+        runner.registerValue("total_seconds", totals["seconds"], "s")
+        runner.registerValue("total_objects", totals["objects"])
+        runner.registerValue("total_lookups", totals["lookups"])
+        return totals
+
+    def write(self, path, **extra):
+        """ JSON trace for dashboards, returns False when it cannot be written """
+        payload = {
+            "measure": "aus_library",
+            "started": self.started.isoformat(),
+            **extra,
+            "phases": self.phases,
+            "total_seconds": sum(p["seconds"] for p in self.phases),
+        }
+        try:
+            with open(path, "w") as f:
+                json.dump(payload, f, indent=2)
+        except OSError:
+            return False
+        return True
 
-
-def sheet_to_json(sheet_name):
-    path_to_file = Path(abspath(getsourcefile(lambda:0))).parent.joinpath("resources/resources.xlsx").resolve()
-    sheet = pd.read_excel(path_to_file, sheet_name=sheet_name)
+def duplicate_key(key, occurrence):
+    return key if occurrence == 1 else f"{key} #{occurrence}"
+
+def fingerprint(data, depends=()):
+    """ hash of a workbook row (or nested schedule) plus the handles of the objects it points at """
+    payload = json.dumps([data, list(depends)], sort_keys=True, default=_json_default)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def _json_default(value):
+    """ Records serialise as the dicts they stand for, so a row hashes the same whichever loader read it """
+    return dict(value) if isinstance(value, Record) else str(value)
+
+def tag_object(obj, sheet, key, digest):
+    props = obj.additionalProperties()
+    props.setFeature(TAG_SHEET, sheet)
+    props.setFeature(TAG_KEY, key)
+    props.setFeature(TAG_FINGERPRINT, digest)
+
+def library_objects(model):
+    """ {sheet: {key: (object, fingerprint)}} from one pass over the model's AdditionalProperties """
+    found = {}
+    for props in model.getAdditionalPropertiess():
+        sheet = props.getFeatureAsString(TAG_SHEET)
+        if not sheet.is_initialized() or sheet.get() not in LIBRARY_CASTS:
+            continue
+        obj = getattr(props.modelObject(), LIBRARY_CASTS[sheet.get()])()
+        if not obj.is_initialized():
+            continue
+        key = props.getFeatureAsString(TAG_KEY).get()
+        found.setdefault(sheet.get(), {})[key] = (obj.get(), props.getFeatureAsString(TAG_FINGERPRINT).get())
+    return found
+
+def upsert_row(sheet, key, data, new, apply, upsert=None, depends=None):
+    """ new() then apply(obj, data)
+
+    With an Upsert the object a previous run tagged with this key is reused instead, and the row is
+    only re-applied when its fingerprint changed. depends(data) lists the handles the row points at,
+    so a row is also refreshed when something it references was recreated.
+    """
+    if upsert is None:
+        obj = new()
+        apply(obj, data)
+        return obj
+    digest = fingerprint(data, depends(data) if depends else ())
+    key = upsert.tag_key(sheet, key)
+    obj, previous = upsert.claim(sheet, key)
+    if obj is None:
+        obj = new()
+        apply(obj, data)
+        upsert.counts["created"] += 1
+    elif previous != digest:
+        apply(obj, data)
+        upsert.counts["updated"] += 1
+    else:
+        upsert.counts["unchanged"] += 1
+        return obj
+    tag_object(obj, sheet, key, digest)
+    return obj
+
+def reference_handles(index:dict, sheet):
+    """ depends callable for upsert_row: handles of the indexed objects a row references """
+    def _handles(data:dict):
+        return [str(index[target][name].handle()) for target, name in row_references(sheet, data)
+                if name in index.get(target, {})]
+    return _handles
+
+def row_hashes(data:dict):
+    """ {sheet: {key: (name, fingerprint)}}, the rows of a schedule or construction hash together """
+    hashes = {}
+    for sheet, rows in data.items():
+        grouped, seen = {}, collections.Counter()
+        for row in rows or []:
+            name = key = row_key(sheet, row)
+            if sheet not in ("schedules", "constructions"):
+                seen[name] += 1
+                key = duplicate_key(name, seen[name])
+            grouped.setdefault(key, (name, []))[1].append(row)
+        hashes[sheet] = {key: (name, fingerprint(group)) for key, (name, group) in grouped.items()}
+    return hashes
+
+def library_state(model):
+    """ (workbook hash, {"rows": {sheet: {key: hash}}, "handles": {sheet: {name: handle}}}) the last incremental run stored """
+    props = model.getBuilding().additionalProperties()
+    digest, state = props.getFeatureAsString(STATE_WORKBOOK), props.getFeatureAsString(STATE_ROWS)
+    if not digest.is_initialized() or not state.is_initialized():
+        return None, {}
+    return digest.get(), json.loads(state.get())
+
+def store_library_state(model, digest, hashes:dict, index:dict):
+    props = model.getBuilding().additionalProperties()
+    props.setFeature(STATE_WORKBOOK, digest)
+    props.setFeature(STATE_ROWS, json.dumps({
+        "rows": {sheet: {key: h for key, (_, h) in rows.items()} for sheet, rows in hashes.items()},
+        "handles": {sheet: {name: str(obj.handle()) for name, obj in objects.items()} for sheet, objects in index.items()},
+    }))
+
+def library_delta(model, data:dict, hashes:dict, digest):
+    """ (rows to rebuild, {sheet: {name: object}} to resolve the rest to) against the last incremental run
+
+    A row is rebuilt when its hash changed, its object is gone, it shares its object with a rebuilt
+    row (identical schedules share a ruleset) or it references a rebuilt row, so dependent schedule
+    sets and space types are re-pointed when a definition is replaced.
+    """
+    previous, state = library_state(model)
+    handles = state.get("handles", {})
+    dirty, base = {}, {}
+    for sheet, rows in hashes.items():
+        old = state.get("rows", {}).get(sheet, {})
+        dirty[sheet] = {name for key, (name, h) in rows.items() if previous != digest and old.get(key) != h}
+        base[sheet] = {}
+        for name in {name for name, _ in rows.values()} - dirty[sheet]:
+            obj = model.getModelObject(openstudio.toUUID(handles.get(sheet, {}).get(name, "")))
+            obj = getattr(obj.get(), LIBRARY_CASTS[sheet])() if obj.is_initialized() else obj
+            if obj.is_initialized():
+                base[sheet][name] = obj.get()
+            else:
+                dirty[sheet].add(name)
+
+    changed = True
+    while changed:
+        changed = False
+        for sheet, rows in data.items():
+            shared = {handles.get(sheet, {}).get(name) for name in dirty[sheet]} - {None}
+            for row in rows or []:
+                name = row_key(sheet, row)
+                if name in dirty[sheet]:
+                    continue
+                if handles.get(sheet, {}).get(name) in shared or any(n in dirty.get(t, ()) for t, n in row_references(sheet, row)):
+                    dirty[sheet].add(name)
+                    base[sheet].pop(name, None)
+                    changed = True
+    return {sheet: [r for r in rows or [] if row_key(sheet, r) in dirty[sheet]] for sheet, rows in data.items()}, base
+
+
+XLSX_NS = {
+    "m": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+# strings pandas.read_excel turns into NaN
+XLSX_NA_VALUES = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                  "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+XLSX_DATE_FORMAT_IDS = set(range(14, 23)) | {45, 46, 47}
+XLSX_FORMAT_STRIP = re.compile(r'\[(?!hh?\]|mm?\]|ss?\])[^\]]*\]|"[^"]*"')
+XLSX_FORMAT_DATE = re.compile(r"(?<![_\\])[dmhysDMHYS]")
+# pandas to_json default double_precision
+JSON_DOUBLE_PRECISION = 10
+
+
+def sheet_to_json(sheet_name, path=RESOURCES_PATH):
+    import pandas as pd
+    sheet = pd.read_excel(path, sheet_name=sheet_name)
     jason = json.loads( sheet.to_json(orient='records') )
     return jason
 
-def read_excel():
-    sheets = ["people", "schedules","schedule_sets", "materials","lights", "equipment", "infiltration", "outdoor_air", "space_types"]
-    return {k: sheet_to_json(k) for k in sheets}
+def sheets_to_json(sheet_names, path=RESOURCES_PATH):
+    """ same records as sheet_to_json but opens and parses the workbook once for all sheets """
+    import pandas as pd
+    present = pd.ExcelFile(path).sheet_names
+    sheets = pd.read_excel(path, sheet_name=[k for k in sheet_names if k in present or k not in OPTIONAL_SHEETS])
+    return {k: check_columns(k, to_records(json.loads( sheets[k].to_json(orient='records') )), path) if k in sheets else []
+            for k in sheet_names}
+
+def to_records(rows:list):
+    """ dict rows with the same columns as Records sharing those columns """
+    positions = {column: i for i, column in enumerate(rows[0])} if rows else {}
+    return [Record(positions, tuple(row.get(column) for column in positions)) for row in rows]
+
+def _xlsx_column(ref):
+    """ "AB12" -> 27 (zero based) """
+    index = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index - 1
+
+def _xlsx_text(element):
+    # rich text runs are concatenated, phonetic hints (rPh) are skipped like openpyxl does
+    return "".join(t.text or "" for t in element.iter(f'{{{XLSX_NS["m"]}}}t')
+                   if t not in element.findall("m:rPh/m:t", XLSX_NS))
+
+def _xlsx_shared_strings(book):
+    try:
+        root = ET.fromstring(book.read("xl/sharedStrings.xml"))
+    except KeyError:
+        return []
+    return [_xlsx_text(si) for si in root.findall("m:si", XLSX_NS)]
+
+def _xlsx_date_styles(book):
+    """ indexes of the cell styles that openpyxl would read as dates or times """
+    try:
+        root = ET.fromstring(book.read("xl/styles.xml"))
+    except KeyError:
+        return set()
+    custom = {int(f.get("numFmtId")): f.get("formatCode") for f in root.iterfind("m:numFmts/m:numFmt", XLSX_NS)}
+    def _is_date(fmt_id):
+        if fmt_id in custom:
+            code = XLSX_FORMAT_STRIP.sub("", custom[fmt_id].split(";")[0])
+            return XLSX_FORMAT_DATE.search(code) is not None
+        return fmt_id in XLSX_DATE_FORMAT_IDS
+    xfs = root.findall("m:cellXfs/m:xf", XLSX_NS)
+    return {i for i, xf in enumerate(xfs) if _is_date(int(xf.get("numFmtId", 0)))}
+
+def _xlsx_sheet_paths(book):
+    """ sheet name -> zip member of the worksheet xml """
+    workbook = ET.fromstring(book.read("xl/workbook.xml"))
+    rels = ET.fromstring(book.read("xl/_rels/workbook.xml.rels"))
+    targets = {r.get("Id"): r.get("Target") for r in rels.findall("rel:Relationship", XLSX_NS)}
+    paths = {}
+    for sheet in workbook.iterfind("m:sheets/m:sheet", XLSX_NS):
+        target = targets[sheet.get(f'{{{XLSX_NS["r"]}}}id')]
+        paths[sheet.get("name")] = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    return paths
+
+def _xlsx_epoch(book):
+    workbook_pr = ET.fromstring(book.read("xl/workbook.xml")).find("m:workbookPr", XLSX_NS)
+    if workbook_pr is not None and workbook_pr.get("date1904") in ("1", "true"):
+        return datetime.datetime(1904, 1, 1)
+    return datetime.datetime(1899, 12, 30)
+
+def _xlsx_serial_to_date(value, epoch):
+    """ openpyxl's from_excel: a time of day below 1.0, a datetime otherwise """
+    day, fraction = divmod(value, 1)
+    diff = datetime.timedelta(milliseconds=round(fraction * 86400 * 1000))
+    if 0 <= value < 1 and diff.days == 0:
+        minutes, seconds = divmod(diff.seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return datetime.time(hours, minutes, seconds, diff.microseconds)
+    if 0 < value < 60 and epoch.year == 1899:
+        # Excel's phantom 1900-02-29
+        day += 1
+    return epoch + datetime.timedelta(days=day) + diff
+
+def _xlsx_cell(cell, shared, date_styles, epoch):
+    kind = cell.get("t", "n")
+    if kind == "inlineStr":
+        element = cell.find("m:is", XLSX_NS)
+        return None if element is None else _xlsx_text(element)
+    v = cell.find("m:v", XLSX_NS)
+    if v is None or v.text is None:
+        return None
+    if kind == "s":
+        return shared[int(v.text)]
+    if kind in ("str", "e"):
+        return v.text
+    if kind == "b":
+        return v.text in ("1", "true")
+    if kind == "d":
+        return datetime.datetime.fromisoformat(v.text.rstrip("Z"))
+    number = float(v.text)
+    if int(cell.get("s", 0)) in date_styles:
+        return _xlsx_serial_to_date(number, epoch)
+    return int(number) if number.is_integer() else number
+
+def _xlsx_column_names(header, width):
+    """ header row -> column names, mangling blanks and duplicates the way pandas does """
+    names, seen = [], {}
+    for i in range(width):
+        value = header[i] if i < len(header) else None
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+def _json_value(value, column_kind):
+    """ what the record holds after pandas' to_json/json.loads round trip """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return round((value - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    if isinstance(value, datetime.time):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return value
+    if column_kind == "float" or isinstance(value, float):
+        return round(float(value), JSON_DOUBLE_PRECISION)
+    return value
+
+def _xlsx_column_kind(values):
+    """ the dtype pandas would infer, only int/float/other matter for the JSON output """
+    present = [v for v in values if v is not None]
+    if any(isinstance(v, (str, bool, datetime.time, datetime.datetime)) for v in present):
+        return "object"
+    if len(present) == len(values) and all(isinstance(v, int) for v in present):
+        return "int"
+    return "float"
+
+def _xlsx_rows(stream, shared, date_styles, epoch):
+    """ (row number, values) of the non-blank rows of a worksheet, parsed incrementally so only one row is held """
+    sheet_data, number = None, 0
+    for event, row in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if row.tag == f'{{{XLSX_NS["m"]}}}sheetData':
+                sheet_data = row
+            continue
+        if row.tag != f'{{{XLSX_NS["m"]}}}row':
+            continue
+        number = int(row.get("r", number + 1))
+        cells = {}
+        for position, cell in enumerate(row.findall("m:c", XLSX_NS)):
+            column = _xlsx_column(cell.get("r")) if cell.get("r") else position
+            value = _xlsx_cell(cell, shared, date_styles, epoch)
+            if isinstance(value, str) and value in XLSX_NA_VALUES:
+                value = None
+            if value is not None:
+                cells[column] = value
+        # drop the parsed rows from the tree as we go
+        sheet_data.clear()
+        if cells:
+            yield number, [cells.get(i) for i in range(max(cells) + 1)]
+
+def _xlsx_records(stream, shared, date_styles, epoch):
+    # like pandas: the first sheet row is the header, blank rows inside the data are kept, trailing ones dropped
+    rows = []
+    for number, values in _xlsx_rows(stream, shared, date_styles, epoch):
+        rows.extend([] for _ in range(number - 1 - len(rows)))
+        rows.append(values)
+    if not rows:
+        return []
+    header, body = rows[0], rows[1:]
+    width = max(len(r) for r in rows)
+    columns = _xlsx_column_names(header, width)
+    body = [r + [None] * (width - len(r)) for r in body]
+    kinds = [_xlsx_column_kind([r[i] for r in body]) for i in range(width)]
+    positions = {name: i for i, name in enumerate(columns)}
+    return [Record(positions, tuple(_json_value(r[i], kinds[i]) for i in range(width))) for r in body]
+
+def _xlsx_iter_records(stream, shared, date_styles, epoch):
+    """ _xlsx_records one row at a time
+
+    A column's dtype is only known after its last row, so numbers keep the type of their own
+    cell (3 rather than the 3.0 of a column with blanks) and the columns are the header's.
+    """
+    rows = _xlsx_rows(stream, shared, date_styles, epoch)
+    previous, header = next(rows, (None, None))
+    if header is None:
+        return
+    columns = _xlsx_column_names(header, len(header))
+    positions = {name: i for i, name in enumerate(columns)}
+    blank = []
+    for number, values in rows:
+        if len(values) > len(columns):
+            columns = _xlsx_column_names(header, len(values))
+            positions = {name: i for i, name in enumerate(columns)}
+        # blank rows only count once a later row shows they are not trailing
+        blank.extend(range(number - previous - 1))
+        for _ in blank:
+            yield Record(positions, (None,) * len(columns))
+        blank.clear()
+        previous = number
+        values = values + [None] * (len(columns) - len(values))
+        yield Record(positions, tuple(_json_value(value, None) for value in values))
+
+def missing_columns(sheet, columns):
+    """ the columns the builders key or read a sheet by (KEYS, VALUE_TYPES) that its header lacks """
+    required = ([KEYS[sheet]] if sheet in KEYS else []) + list(VALUE_TYPES.get(sheet, {}))
+    return [column for column in required if column not in columns]
+
+def check_columns(sheet, rows, path=RESOURCES_PATH):
+    """ rows, once the sheet is known to have the columns it needs, a ValueError naming those it lacks otherwise
+
+    Checked once as a sheet is parsed, the values themselves are left to validate_library.
+    """
+    missing = missing_columns(sheet, rows[0]) if rows else []
+    if missing:
+        raise ValueError(f"Worksheet {sheet} in {path} has no column(s) {', '.join(missing)}")
+    return rows
+
+def xlsx_to_json(sheet_names, path=RESOURCES_PATH):
+    """ the records sheets_to_json returns, read with zipfile + ElementTree so pandas is never imported """
+    with zipfile.ZipFile(path) as book:
+        paths = _xlsx_sheet_paths(book)
+        missing = [name for name in sheet_names if name not in paths and name not in OPTIONAL_SHEETS]
+        if missing:
+            raise ValueError(f"Worksheet(s) {missing} not found in {path}")
+        shared = _xlsx_shared_strings(book)
+        date_styles = _xlsx_date_styles(book)
+        epoch = _xlsx_epoch(book)
+        def _read(name):
+            with book.open(paths[name]) as stream:
+                return check_columns(name, _xlsx_records(stream, shared, date_styles, epoch), path)
+        return {name: _read(name) if name in paths else [] for name in sheet_names}
+
+def xlsx_stream(sheet_names, path=RESOURCES_PATH):
+    """ {sheet: generator of records}, each sheet is read row by row as it is iterated and only once
+
+    Memory stays at one row per sheet plus the shared strings however large the workbook gets,
+    so build_library can be fed a workbook that would not fit as records. validate_library needs
+    every row, so each row is checked on its own as it is read instead (check_row) and the first
+    bad one raises LibraryError; references between rows are not checked. Every generator opens
+    the workbook itself, it is closed when the generator is used up, closed or collected.
+    """
+    with zipfile.ZipFile(path) as book:
+        paths = _xlsx_sheet_paths(book)
+        missing = [name for name in sheet_names if name not in paths and name not in OPTIONAL_SHEETS]
+        if missing:
+            raise ValueError(f"Worksheet(s) {missing} not found in {path}")
+        shared = _xlsx_shared_strings(book)
+        date_styles = _xlsx_date_styles(book)
+        epoch = _xlsx_epoch(book)
+
+    def _records(name):
+        with zipfile.ZipFile(path) as book, book.open(paths[name]) as stream:
+            records = _xlsx_iter_records(stream, shared, date_styles, epoch)
+            first = next(records, None)
+            if first is not None:
+                records = itertools.chain(check_columns(name, [first], path), records)
+            for number, record in enumerate(records, start=1):
+                _, errors = check_row(name, record, number)
+                if errors:
+                    raise LibraryError("; ".join(errors))
+                yield record
+
+    return {name: _records(name) if name in paths else iter(()) for name in sheet_names}
+
+# workbook parsers, pandas is only imported when its backend is asked for
+LOADERS = {"xlsx": xlsx_to_json, "pandas": sheets_to_json, "stream": xlsx_stream}
+
+def cache_path(path=RESOURCES_PATH):
+    """ compiled snapshot lives next to the workbook, resources.xlsx -> resources.cache """
+    return Path(path).with_suffix(".cache")
+
+def workbook_stamp(path=RESOURCES_PATH):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def workbook_hash(path=RESOURCES_PATH):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_cache(path, sheets:dict, digest=None):
+    """ pickle the records atomically, a read-only measure directory just means no cache """
+    target = cache_path(path)
+    payload = {
+        "version": CACHE_VERSION,
+        "stamp": workbook_stamp(path),
+        "hash": digest or workbook_hash(path),
+        "sheets": sheets,
+    }
+    try:
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=target.name, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, target)
+    except OSError:
+        return False
+    return True
+
+def load_cache(path=RESOURCES_PATH):
+    """ cached sheets if they were compiled from this exact workbook, otherwise None
+
+    The mtime/size stamp is the fast path. When only the stamp moved (fresh checkout, touch)
+    the content hash decides and the stamp is refreshed instead of reparsing the workbook.
+    """
+    try:
+        with open(cache_path(path), "rb") as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION:
+        return None
+    if cached.get("stamp") == workbook_stamp(path):
+        return cached["sheets"]
+    digest = workbook_hash(path)
+    if cached.get("hash") != digest:
+        return None
+    write_cache(path, cached["sheets"], digest)
+    return cached["sheets"]
+
+# sheet -> (OpenStudio class, {IDD field: workbook column, or a constant in a tuple}) of the definitions render_library writes,
+# the fields each builder's setters leave behind
+RENDERED_DEFINITIONS = {
+    "people": ("PeopleDefinition", {"Number of People Calculation Method": ("Area/Person",), "Number of People": ("",),
+                                    "People per Space Floor Area": ("",), "Space Floor Area per Person": "area per person"}),
+    "lights": ("LightsDefinition", {"Design Level Calculation Method": ("Watts/Area",), "Lighting Level": ("",),
+                                    "Watts per Space Floor Area": "Adjusted IPD", "Watts per Person": ("",)}),
+    "equipment": ("ElectricEquipmentDefinition", {"Design Level Calculation Method": ("Watts/Area",), "Design Level": ("",),
+                                                  "Watts per Space Floor Area": "W/m2", "Watts per Person": ("",)}),
+    "infiltration": ("SpaceInfiltrationDesignFlowRate", {"Design Flow Rate Calculation Method": ("AirChanges/Hour",), "Design Flow Rate": ("",),
+                                                         "Flow per Space Floor Area": ("",), "Flow per Exterior Surface Area": ("",),
+                                                         "Air Changes per Hour": "hvac_off"}),
+    "outdoor_air": ("DesignSpecificationOutdoorAir", {"Outdoor Air Flow per Person": "L/s/person"}),
+}
+# how OpenStudio writes the characters IDF reserves
+OSM_ESCAPES = str.maketrans({",": "&#44", ";": "&#59", "!": "&#33"})
+
+def _field_key(name):
+    """ IDD field name or setter -> comparable key, "setWattsperSpaceFloorArea" and "Watts per Space Floor Area" meet """
+    key = re.sub(r"[^a-z0-9]", "", name.lower())
+    return key[3:] if name.startswith("set") else key
+
+def _template(obj):
+    """ (IDD type, field strings, {field key: index}, {index: choices}) of an object fresh from its constructor """
+    idd = obj.iddObject()
+    fields = {_field_key(idd.getField(i).get().name()): i for i in range(idd.numFields())}
+    choices = {i: {k.name().lower() for k in idd.getField(i).get().keys()} for i in range(idd.numFields())}
+    return idd.name(), _fields(obj)[:idd.numFields()], fields, {i: keys for i, keys in choices.items() if keys}
+
+@functools.lru_cache(maxsize=None)
+def osm_templates(csv_path=None):
+    """ {class name: _template} of the classes render_library writes and {schedule set column: ScheduleTypeLimits fields}
+    assigning a schedule to that slot adds, recorded through the API once. csv_path adds the ExternalFile and
+    ScheduleFile templates for that schedule CSV.
+    """
+    model = openstudio.model.Model()
+    ruleset = openstudio.model.ScheduleRuleset(model)
+    people, lights = openstudio.model.PeopleDefinition(model), openstudio.model.LightsDefinition(model)
+    equipment = openstudio.model.ElectricEquipmentDefinition(model)
+    objects = {"ScheduleRuleset": ruleset, "ScheduleDay": ruleset.defaultDaySchedule(), "ScheduleRule": openstudio.model.ScheduleRule(ruleset),
+               "PeopleDefinition": people, "LightsDefinition": lights, "ElectricEquipmentDefinition": equipment,
+               "People": openstudio.model.People(people), "Lights": openstudio.model.Lights(lights),
+               "ElectricEquipment": openstudio.model.ElectricEquipment(equipment)}
+    for kind in ["ScheduleTypeLimits", "SpaceInfiltrationDesignFlowRate", "DesignSpecificationOutdoorAir", "DefaultScheduleSet", "SpaceType", "Construction",
+                 "DefaultConstructionSet", "DefaultSurfaceConstructions", "DefaultSubSurfaceConstructions", *MATERIAL_PROPERTIES]:
+        objects[kind] = getattr(openstudio.model, kind)(model)
+    if csv_path is not None:
+        objects["ExternalFile"] = openstudio.model.ExternalFile.getExternalFile(model, str(csv_path), False).get()
+        objects["ScheduleFile"] = openstudio.model.ScheduleFile(objects["ExternalFile"], 1, 1)
+    templates = {kind: _template(obj) for kind, obj in objects.items()}
+
+    limits = {}
+    for column, setter in SCHEDULE_SET_COLUMNS.items():
+        schedule = openstudio.model.ScheduleRuleset(model)
+        getattr(openstudio.model.DefaultScheduleSet(model), setter)(schedule)
+        limits[column] = _fields(schedule.scheduleTypeLimits().get())
+    return templates, limits
+
+def _osm_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # OpenStudio's own double formatting
+        return f"{value:.15g}"
+    return str(value).translate(OSM_ESCAPES)
+
+class OsmWriter:
+    """ OSM objects rendered from osm_templates, kept as field lists until text() so references can still be set """
+
+    def __init__(self, csv_path=None):
+        self.templates, self.limits = osm_templates(csv_path)
+        self.objects = {}
+
+    def add(self, kind, values:dict, extensible=(), fields=None):
+        """ a kind object with values set by IDD field name, returns its new handle """
+        idd_type, template, _, _ = self.templates[kind]
+        handle = "{%s}" % uuid.uuid4()
+        self.objects[handle] = [kind, idd_type, [handle, *(fields or template)[1:]]]
+        self.set(handle, values)
+        self.objects[handle][2].extend(_osm_value(v) for v in extensible)
+        return handle
+
+    def set(self, handle, values:dict):
+        kind, _, fields = self.objects[handle]
+        _, _, index, choices = self.templates[kind]
+        for name, value in values.items():
+            i = index[_field_key(name)]
+            value = _osm_value(value)
+            if i in choices and value and value.lower() not in choices[i]:
+                raise ValueError(name)
+            fields.extend([""] * (i + 1 - len(fields)))
+            fields[i] = value
+
+    def text(self, taken=None, reuse=None, rename=True):
+        """ the objects as OSM, names made unique by unique_names since addObjects rejects a batch repeating one
+
+        taken ({IDD type: names}) and reuse ({MERGE_REUSE type: {fields from its index on: handle}}) describe the
+        file the text goes into: its names are avoided and counted too, so taken should hold every named type, and
+        its reusable objects stand in for identical ones here. rename=False keeps the names as the builders set
+        them, for merge_library to make unique against the model it merges into.
+        """
+        replaced = {}
+        for handle, (_, idd_type, fields) in self.objects.items():
+            if idd_type in MERGE_REUSE and reuse and _trimmed(fields[MERGE_REUSE[idd_type]:]) in reuse.get(idd_type, {}):
+                replaced[handle] = reuse[idd_type][_trimmed(fields[MERGE_REUSE[idd_type]:])]
+        objects = [o for handle, o in self.objects.items() if handle not in replaced]
+        if rename:
+            existing = collections.defaultdict(list)
+            for idd_type, names in (taken or {}).items():
+                for name in names:
+                    existing[name_suffix(name)[0].lower()].append((idd_type, name))
+            unique_names([(idd_type, fields) for _, idd_type, fields in objects], lambda base: existing.get(base.lower(), ()))
+        return "".join(f"{idd_type},\n  " + ",\n  ".join(replaced.get(f, f) for f in fields) + ";\n\n" for _, idd_type, fields in objects)
+
+def name_suffix(name):
+    """ "Office 12" -> ("Office", 12), "Office" -> ("Office", None), how setName reads the suffix it counts up """
+    match = re.fullmatch(r"(.*) (\d+)", name)
+    return (match.group(1), int(match.group(2))) if match else (name, None)
+
+def unique_names(objects, existing):
+    """ give the (IDD type, field strings) objects, in order, the names setName would give them one by one
+
+    A name taken within its type, ignoring case, or a blank one becomes its base name (see name_suffix)
+    with one more than the highest suffix that base has in any type. existing(base) returns the
+    (IDD type, name) pairs already there for a base name, what getObjectsByName(base, False) finds.
+    """
+    blank = {idd_type: name_suffix(fields[1])[0] for idd_type, fields, _, _ in osm_templates()[0].values()}
+    used, suffixes, loaded = collections.defaultdict(set), {}, set()
+
+    def _use(idd_type, name):
+        base, number = name_suffix(name)
+        suffixes[base.lower()] = max(suffixes.get(base.lower(), 0), number or 0)
+        used[idd_type].add(name.lower())
+
+    for idd_type, fields in objects:
+        if len(fields) < 2:
+            continue
+        base = name_suffix(fields[1])[0] if fields[1] else blank.get(idd_type, idd_type)
+        if base.lower() not in loaded:
+            loaded.add(base.lower())
+            for pair in existing(base):
+                _use(*pair)
+        if not fields[1] or fields[1].lower() in used[idd_type]:
+            fields[1] = f"{base} {suffixes.get(base.lower(), 0) + 1}"
+        _use(idd_type, fields[1])
+
+def _render_day(osm, name, profiles):
+    """ ScheduleDay with the template's values overwritten by each profile, what addValue leaves """
+    _, template, _, _ = osm.templates["ScheduleDay"]
+    points = {int(h) * 60 + int(m): float(v) for h, m, v in zip(*[iter(template[4:])] * 3)}
+    for profile in profiles:
+        points.update(zip(profile["minutes"], profile["values"]))
+    values = [v for minute in sorted(points) for v in (minute // 60, minute % 60, points[minute])]
+    return osm.add("ScheduleDay", {"Name": name}, values, fields=template[:4])
+
+def _render_ruleset(osm, name, schedules:dict):
+    """ make_schedule_ruleset as OSM, returns the handles of the ruleset and of its days """
+    default = {d: s for d, s in schedules.items() if get_schedule_handler(d, s) is make_default_schedule}
+    days = [_render_day(osm, next(iter(default), None) or osm.templates["ScheduleDay"][1][1], default.values())]
+    ruleset = osm.add("ScheduleRuleset", {"Name": name, "Default Day Schedule Name": days[0]})
+    keys = [profile_key(s) for s in default.values()]
+    for day_name, profile in schedules.items():
+        if day_name in default:
+            continue
+        if profile_key(profile) in keys:
+            continue
+        # the rule is named before its day, as make_schedule_rule does, so both get the suffixes setName gives them
+        rule = osm.add("ScheduleRule", {"Name": day_name, "Schedule Ruleset Name": ruleset, "Rule Order": 0,
+                                        "Apply Sunday": "Yes", "Apply Saturday": "Yes"})
+        days.append(_render_day(osm, day_name, [profile]))
+        osm.set(rule, {"Day Schedule Name": days[-1]})
+    return ruleset, days
+
+def render_library(data:dict, schedule_format="Ruleset", year=None, path=RESOURCES_PATH, taken=None, reuse=None, rename=True):
+    """ OSM text of the objects build_library creates for data, written without creating any of them
+
+    Every object starts from the fields a fresh object of its class has and gets the fields the
+    builder's setters would set, references are handles assigned up front. merge_library adds
+    the text to a model in one addObjects call, a fraction of the per-object SWIG calls.
+    taken, reuse and rename go to OsmWriter.text.
+    """
+    compiled_schedules = compile_schedules(data.get("schedules"))
+    index = {sheet: {} for sheet in SHEETS}
+    limited = {}  # schedule handle -> the handles its ScheduleTypeLimits go on
+    if schedule_format == "ScheduleFile":
+        year = year or DEFAULT_YEAR
+        csv_path, columns = schedule_csv(compiled_schedules, year, path)
+        osm = OsmWriter(csv_path)
+        # a bare name is looked up in the model's files directory, see copy_schedule_csvs
+        external_file = osm.add("ExternalFile", {"File Name": csv_path.name})
+        files = {}
+        for name in compiled_schedules:
+            if columns[name] not in files:
+                files[columns[name]] = osm.add("ScheduleFile", {"Name": name, "External File Name": external_file, "Column Number": columns[name],
+                                                                "Rows to Skip at Top": 1,
+                                                                "Number of Hours of Data": (366 if calendar.isleap(year) else 365) * 24})
+                limited[files[columns[name]]] = [files[columns[name]]]
+            index["schedules"][name] = files[columns[name]]
+    else:
+        osm = OsmWriter()
+        rulesets = {}
+        for name, schedules in compiled_schedules.items():
+            signature = tuple(sorted((d, profile_key(s)) for d, s in schedules.items()))
+            if signature not in rulesets:
+                ruleset, days = _render_ruleset(osm, name, schedules)
+                rulesets[signature] = ruleset
+                limited[ruleset] = [ruleset, *days]
+            index["schedules"][name] = rulesets[signature]
+
+    # the first schedule set slot a schedule goes into decides its limits, as the setters do
+    limits = {}
+    for data_row in data.get("schedule_sets") or []:
+        owner = f"schedule set '{data_row.get('name')}'"
+        values = {"Name": data_row.get("name")}
+        for column, setter in SCHEDULE_SET_COLUMNS.items():
+            if not data_row.get(column):
+                continue
+            schedule = values[setter + "Name"] = resolve(index, "schedules", data_row.get(column), owner)
+            if limited.get(schedule):
+                fields = osm.limits[column]
+                if fields[1] not in limits:
+                    limits[fields[1]] = osm.add("ScheduleTypeLimits", {}, fields=fields)
+                for handle in limited.pop(schedule):
+                    osm.set(handle, {"Schedule Type Limits Name": limits[fields[1]]})
+        index["schedule_sets"][data_row.get("name")] = osm.add("DefaultScheduleSet", values)
+
+    for sheet, (kind, columns) in RENDERED_DEFINITIONS.items():
+        for row in data.get(sheet) or []:
+            values = {field: column[0] if isinstance(column, tuple) else row.get(column) for field, column in columns.items()}
+            index[sheet][row.get(KEYS[sheet])] = osm.add(kind, {"Name": row.get(KEYS[sheet]), **values})
+
+    interned = {}
+    for row in data.get("materials") or []:
+        name = row.get("name")
+        kind, properties = material_properties(row)
+        if name in interned:
+            if interned[name] != (kind, properties):
+                raise LibraryError(f"material '{name}' appears twice in the materials sheet with different properties")
+            continue
+        interned[name] = kind, properties
+        try:
+            index["materials"][name] = osm.add(kind, {"Name": name, **{MATERIAL_PROPERTIES[kind][c]: v for c, v in properties.items()}})
+        except ValueError as e:
+            column = next(c for c, setter in MATERIAL_PROPERTIES[kind].items() if setter == str(e))
+            raise LibraryError(f"material '{name}' has invalid {column} {properties[column]!r}") from None
+
+    for name, layers in construction_layers(data.get("constructions")).items():
+        owner = f"construction '{name}'"
+        index["constructions"][name] = osm.add("Construction", {"Name": name}, [resolve(index, "materials", m, owner) for m in layers])
+
+    for row in data.get("construction_sets") or []:
+        owner = f"construction set '{row.get('name')}'"
+        values = {"Name": row.get("name")}
+        for group in dict.fromkeys(group for group, _ in CONSTRUCTION_SET_COLUMNS.values()):
+            columns = {column: setter for column, (g, setter) in CONSTRUCTION_SET_COLUMNS.items() if g == group}
+            if any(row.get(column) for column in columns):
+                values[group + "Name"] = osm.add(
+                    "DefaultSubSurfaceConstructions" if "SubSurface" in group else "DefaultSurfaceConstructions",
+                    {"Name": f"{row.get('name')} {group[len('Default'):-len('Constructions')]}",
+                     **{setter + "Name": resolve(index, "constructions", row.get(c), owner) for c, setter in columns.items() if row.get(c)}})
+        index["construction_sets"][row.get("name")] = osm.add("DefaultConstructionSet", values)
+
+    for row in data.get("space_types") or []:
+        owner = f"space type '{row.get('name')}'"
+        space_type = osm.add("SpaceType", {"Name": row.get("name")})
+        for sheet, kind in [("lights", "Lights"), ("equipment", "ElectricEquipment"), ("people", "People")]:
+            if row.get(sheet):
+                definition = resolve(index, sheet, row.get(sheet), owner)
+                osm.add(kind, {"Name": "", f"{kind}DefinitionName": definition, "Space or SpaceType Name": space_type})
+        if row.get("infiltration"):
+            # the library object stays unassigned and each space type gets a copy, like create_space_types
+            library = resolve(index, "infiltration", row.get("infiltration"), owner)
+            osm.add("SpaceInfiltrationDesignFlowRate", {"Space or SpaceType Name": space_type}, fields=osm.objects[library][2])
+        values = {"Default Schedule Set Name": resolve(index, "schedule_sets", row.get("schedule_set") or DEFAULT_SCHEDULE_SET, owner)}
+        if row.get("outdoor_air"):
+            values["Design Specification Outdoor Air Object Name"] = resolve(index, "outdoor_air", row.get("outdoor_air"), owner)
+        if row.get("construction_set"):
+            values["Default Construction Set Name"] = resolve(index, "construction_sets", row.get("construction_set"), owner)
+        osm.set(space_type, values)
+        index["space_types"][row.get("name")] = space_type
+    return osm.text(taken, reuse, rename)
+
+def osm_objects(lines, idd_types=None):
+    """ (IDD type, field strings) of the idd_types objects in OSM text lines, every object for None, read a line at a time """
+    kind, values, wanted = None, [], False
+    for line in lines:
+        line = line.split("!", 1)[0].strip()
+        if not line:
+            continue
+        if kind is None:
+            kind = line.split(",", 1)[0].rstrip(";")
+            values, wanted = [], idd_types is None or kind in idd_types
+        if wanted:
+            values.append(line)
+        if line.endswith(";"):
+            if wanted:
+                yield kind, [f.strip() for f in "".join(values)[:-1].split(",")[1:]]
+            kind = None
+
+@functools.lru_cache(maxsize=None)
+def has_name_field(idd_type):
+    """ whether objects of the OpenStudio IDD type have a name, the field setName suffixes """
+    idd = openstudio.IddFileAndFactoryWrapper(openstudio.IddFileType("OpenStudio")).getObject(idd_type)
+    return idd.is_initialized() and idd.get().hasNameField()
+
+def osm_year(fields):
+    """ assumedYear of the YearDescription with these OSM fields, DEFAULT_YEAR without one """
+    if not fields:
+        return DEFAULT_YEAR
+    model = openstudio.model.Model()
+    description = model.getYearDescription()
+    for i, value in enumerate(fields[1:], start=1):
+        if value:
+            description.setString(i, value)
+    return description.assumedYear()
+
+def patch_osm(seed, output, data:dict, schedule_format="Ruleset", path=RESOURCES_PATH):
+    """ seed's text with data's library rendered after it, written to output without loading a model, returns the objects appended
+
+    One streaming pass copies the seed while collecting the names of its objects, the MERGE_REUSE
+    objects it can reuse, its version and its YearDescription; the library
+    is rendered around those and appended in one write. The library only references itself, so
+    nothing in the seed needs to change. A seed from another OpenStudio version raises
+    LibraryError, it has to go through the VersionTranslator. ScheduleFile CSVs go to the
+    files directory next to output, see copy_schedule_csvs.
+    """
+    taken, reuse, found = collections.defaultdict(set), collections.defaultdict(dict), {}
+    output = Path(output)
+    fd, tmp = tempfile.mkstemp(dir=output.parent, prefix=output.name, suffix=".tmp")
+    try:
+        with open(seed, encoding="utf-8") as src, os.fdopen(fd, "w", encoding="utf-8") as dst:
+            last = "\n"
+
+            def _copy():
+                nonlocal last
+                for last in src:
+                    dst.write(last)
+                    yield last
+
+            for idd_type, fields in osm_objects(_copy()):
+                if idd_type == "OS:Version" and fields[1:2] != [openstudio.openStudioVersion()]:
+                    raise LibraryError(f"{seed} was saved by OpenStudio {fields[1] if len(fields) > 1 else '?'}, the text patch needs "
+                                       f"{openstudio.openStudioVersion()}: apply it through the VersionTranslator instead")
+                if len(fields) > 1 and has_name_field(idd_type):
+                    taken[idd_type].add(fields[1])
+                if idd_type in MERGE_REUSE:
+                    reuse[idd_type].setdefault(_trimmed(fields[MERGE_REUSE[idd_type]:]), fields[0])
+                found.setdefault(idd_type, fields)
+            year = osm_year(found.get("OS:YearDescription")) if schedule_format == "ScheduleFile" else None
+            text = render_library(data, schedule_format, year, path, taken, reuse)
+            dst.write(("" if last.endswith("\n") else "\n") + "\n" + text)
+        copy_schedule_csvs(text, path, output.parent / "files")
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(re.findall(r"^OS:", text, re.M))
+
+def prebuilt_path(data:dict, path=RESOURCES_PATH, **options):
+    """ library model built from exactly these rows and build_library options, resources.xlsx -> resources.<hash>.osm
+
+    The OpenStudio version and CACHE_VERSION are part of the hash, bump the latter when the builders change.
+    """
+    digest = fingerprint([data, options], [CACHE_VERSION, openstudio.openStudioVersion()])
+    return Path(path).with_name(f"{Path(path).stem}.{digest[:16]}.osm")
+
+def prebuilt_library(data:dict, path=RESOURCES_PATH, **options):
+    """ render_library of data, cached next to the workbook
+
+    options go to render_library, e.g. schedule_format and the year ScheduleFile columns start in.
+    Every selection, format and year is a file of its own, evict_prebuilt keeps the PREBUILT_SIZE
+    most recently used.
+    """
+    target = prebuilt_path(data, path, **options)
+    try:
+        text = target.read_text()
+        mark_used(target)
+        return text
+    except OSError:
+        pass
+    # names are made unique against the model it is merged into
+    text = render_library(data, path=path, rename=False, **options)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=target.name, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, target)
+    except OSError:
+        pass
+    evict_prebuilt(path)
+    return text
+
+def mark_used(path):
+    """ set path's access time to now, the mtime stays, evict_prebuilt keeps the most recently used files """
+    with contextlib.suppress(OSError):
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+def evict_prebuilt(path=RESOURCES_PATH, keep=PREBUILT_SIZE):
+    """ remove all but the keep most recently used prebuilt libraries, and as many schedule CSVs, next to the workbook """
+    digest = "[0-9a-f]" * 16
+    for pattern in [f"{Path(path).stem}.{digest}.osm", f"{Path(path).stem}.{digest}.schedules.csv"]:
+        files = []
+        for file in Path(path).parent.glob(pattern):
+            with contextlib.suppress(OSError):
+                files.append((file.stat().st_atime_ns, file))
+        for _, file in sorted(files, reverse=True)[keep:]:
+            with contextlib.suppress(OSError):
+                file.unlink()
+
+def merge_library(model, text):
+    """ add the objects of a prebuilt library to model, returns the added objects
+
+    Every handle gets a fresh UUID first so references between library objects are kept while
+    merging the same library twice never clashes. Names follow the per-object path, unique_names
+    gives every object the name setName would against model ("Office 1"). The MERGE_REUSE types
+    are the exception, e.g. ScheduleTypeLimits identical to one in model are reused as OpenStudio
+    does when a schedule is assigned.
+    """
+    reused = {}
+    for kind, first in MERGE_REUSE.items():
+        existing = {_fields(o, first): _fields(o)[0] for o in model.getObjectsByType(openstudio.IddObjectType(kind))}
+        for fields in _osm_fields(text, kind):
+            if _trimmed(fields[first:]) in existing:
+                reused[fields[0]] = existing[_trimmed(fields[first:])]
+    handles = dict(reused)
+    text = HANDLE.sub(lambda m: handles.setdefault(m.group(), "{%s}" % uuid.uuid4()), text)
+    idf = openstudio.IdfFile.load(text, openstudio.IddFileType("OpenStudio"))
+    if not idf.is_initialized():
+        raise LibraryError("the prebuilt library could not be parsed")
+    kept = set(reused.values())
+    objects = [o for o in idf.get().objects() if str(o.handle()) not in kept]
+    names = [(o.iddObject().name(), [None, o.nameString()] if o.iddObject().hasNameField() else []) for o in objects]
+    unique_names(names, lambda base: [(o.iddObject().name(), o.nameString()) for o in model.getObjectsByName(base, False)])
+    for obj, (_, fields) in zip(objects, names):
+        if fields and fields[1] != obj.nameString():
+            obj.setName(fields[1])
+    # names are unique already, skipping the batch's own name checks keeps addObjects linear
+    return model.addObjects(openstudio.IdfObjectVector(objects), False)
+
+def _osm_fields(text, idd_type):
+    """ field strings of the idd_type objects in OSM text, found without parsing the rest of it """
+    for match in re.finditer(rf"^{re.escape(idd_type)},(.*?);", text, re.M | re.S):
+        fields = re.sub(r"!.*", "", match.group(1)).split(",")
+        yield [re.sub(r"&#(\d+)", lambda m: chr(int(m.group(1))), f.strip()) for f in fields]
+
+def _trimmed(fields):
+    fields = list(fields)
+    while fields and not fields[-1]:
+        fields.pop()
+    return tuple(fields)
+
+def _fields(obj, first=None):
+    """ field strings of obj, from `first` on as a hashable tuple without trailing blanks when given """
+    fields = [obj.getString(i).get() if obj.getString(i).is_initialized() else "" for i in range(obj.numFields())]
+    return fields if first is None else _trimmed(fields[first:])
+
+def read_excel(path=RESOURCES_PATH, use_cache=True, loader="xlsx", sheets=SHEETS):
+    """ records of the requested sheets, only the sheets missing from the cache get parsed
+
+    The "stream" loader bypasses the cache and returns a generator per sheet instead.
+    """
+    if loader == "stream":
+        return xlsx_stream(sheets, path)
+    cached = (load_cache(path) if use_cache else None) or {}
+    missing = [k for k in sheets if k not in cached]
+    if missing:
+        cached.update(LOADERS[loader](missing, path))
+        if use_cache:
+            write_cache(path, cached)
+    return {k: cached[k] for k in sheets}
+
+def schedule_name(schedule:dict):
+    """ name of the ScheduleRuleset a schedules row belongs to, e.g. Class5Officebuilding-Occupancy """
+    return f'{schedule.get("space_type").replace(" ","")}-{schedule.get("schedule_type")}'
+
+def row_key(sheet, data:dict):
+    return schedule_name(data) if sheet == "schedules" else data.get(KEYS[sheet])
+
+def row_references(sheet, data:dict):
+    """ (sheet, name) pairs of the rows this row points at """
+    refs = []
+    for column, target in REFERENCES.get(sheet, {}).items():
+        name = data.get(column)
+        if not name and column == "schedule_set":
+            name = DEFAULT_SCHEDULE_SET
+        if name:
+            refs.append((target, name))
+    return refs
+
+def _value_problem(kind, value):
+    """ why value is not a valid kind (see VALUE_TYPES), None when it is """
+    if kind == "number":
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+            return f"a number, not {value!r}"
+    elif kind == "time":
+        if not isinstance(value, str) or not CLOCK.match(value):
+            return f"a time like 08:30, not {value!r}"
+    elif kind == "day_type":
+        if value not in DAY_TYPES:
+            return f"one of {', '.join(DAY_TYPES)}, not {value!r}"
+    elif not isinstance(value, str) or not value.strip():
+        return f"text, not {value!r}"
+    return None
+
+def check_row(sheet, row, number):
+    """ ({column: kind} the builders read from row, errors in those values), number is the row's place in its sheet
+
+    The columns are None for a material of no known type.
+    """
+    key = row_key(sheet, row)
+    if sheet == "schedules":
+        where = f"schedule '{key}' {row.get('day_type')} until {row.get('to')}"
+    else:
+        where = f"{sheet} '{key}'" if key else f"{sheet} row {number}"
+    columns = dict(VALUE_TYPES.get(sheet, {}))
+    if sheet == "materials":
+        try:
+            kind, _ = material_properties(row)
+        except LibraryError as e:
+            return None, [f"{where}: {e}"]
+        columns.update({column: "number" for column in MATERIAL_PROPERTIES[kind] if row.get(column) is not None})
+        if row.get("roughness") is not None:
+            columns["roughness"] = "text"
+    errors = []
+    for column, kind in columns.items():
+        problem = _value_problem(kind, row.get(column))
+        if problem:
+            errors.append(f"{where}: {column} has to be {problem}")
+    return columns, errors
+
+def validate_library(data:dict):
+    """ (errors, warnings) for the records in data, checked before anything is built
+
+    One pass indexes every row by key while checking the types of the values the builders read
+    and collecting the references; the references and schedule day profiles are checked against
+    that afterwards. A key repeated with the same values only warns, the last row wins like it
+    does when building.
+    """
+    errors, warnings = [], []
+    index, references, days = {}, [], {}
+    for sheet, rows in data.items():
+        keys = index.setdefault(sheet, {})
+        for number, row in enumerate(rows or [], start=1):
+            key = row_key(sheet, row)
+            where = f"{sheet} '{key}'" if key else f"{sheet} row {number}"
+            columns, problems = check_row(sheet, row, number)
+            errors.extend(problems)
+            if columns is None:
+                continue
+            if sheet == "schedules":
+                if not any(_value_problem(columns[c], row.get(c)) for c in ("to", "value")):
+                    day = days.setdefault((schedule_name(row), row.get("day_type")), (row.get("schedule_type"), []))
+                    day[1].append((_minute(row.get("to")), row.get("value")))
+                continue
+            if not key:
+                errors.append(f"{where} has no {KEYS[sheet]}")
+                continue
+            built = {c: row.get(c) for c in [*columns, *REFERENCES.get(sheet, {})]}
+            if key in keys and sheet != "constructions":
+                if keys[key] != built:
+                    errors.append(f"{where} appears more than once with different values")
+                else:
+                    warnings.append(f"{where} appears more than once with the same values, the last row is used")
+            keys.setdefault(key, built)
+            references.extend((where, target, name) for target, name in row_references(sheet, row))
+    index["schedules"] = {name for name, _ in days}
+
+    for where, target, name in references:
+        if name not in index.get(target, {}):
+            errors.append(f"{where} references '{name}' but there is no such row in the {target} sheet")
+    for (name, day_type), (schedule_type, points) in days.items():
+        try:
+            compile_profile(points, f"schedule '{name}' {day_type}", schedule_type)
+        except LibraryError as e:
+            errors.append(str(e))
+    return errors, warnings
+
+def read_library(space_types=None, path=RESOURCES_PATH, entry=None, **kwargs):
+    """ read_excel limited to the dependency closure of the named space types, None reads the whole library
+
+    Sheets are read level by level (space_types -> schedule sets, loads and construction sets ->
+    schedules and constructions -> materials) so a cache miss only parses the sheets the
+    selection actually needs. With a registry entry the sheets come from library_sheets instead.
+    """
+    if entry is not None:
+        read_sheets = functools.partial(library_sheets, entry)
+    else:
+        read_sheets = lambda sheets: read_excel(path, sheets=sheets, **kwargs)
+    if space_types is None:
+        return read_sheets(SHEETS)
+    return library_closure(read_sheets, space_types)
+
+def load_library(path=RESOURCES_PATH, use_registry=True):
+    """ registry entry of the workbook at path: {"path", "stamp", "sheets", "aliases", "schedules", "checks"}
+
+    Entries are keyed by path and content hash so variants of the library (one workbook per
+    climate zone, say) and edits of one workbook never share records. The mtime/size stamp is
+    the fast path like load_cache's. "sheets" (see library_sheets), "aliases" (the ALIAS_SHEET rows), "schedules"
+    (compile_schedules of all rows) and "checks" ({selection: validate_library result}) fill in as runs need them.
+    use_registry=False reads a fresh entry and leaves the registry alone.
+    """
+    path = Path(path).resolve()
+    stamp = workbook_stamp(path)
+    if use_registry:
+        with REGISTRY_LOCK:
+            for key, entry in reversed(LIBRARY_REGISTRY.items()):
+                if entry["path"] == path and entry["stamp"] == stamp:
+                    LIBRARY_REGISTRY.move_to_end(key)
+                    return entry
+    key = (path, workbook_hash(path))
+    with REGISTRY_LOCK:
+        entry = LIBRARY_REGISTRY.get(key) if use_registry else None
+    if entry is None:
+        entry = {"path": path, "sheets": {}, "aliases": None, "schedules": None, "checks": {}}
+    entry["stamp"] = stamp
+    if use_registry:
+        with REGISTRY_LOCK:
+            LIBRARY_REGISTRY[key] = entry
+            LIBRARY_REGISTRY.move_to_end(key)
+            while len(LIBRARY_REGISTRY) > REGISTRY_SIZE:
+                LIBRARY_REGISTRY.popitem(last=False)
+    return entry
+
+def library_sheets(entry, sheets):
+    """ {sheet: rows} of entry's workbook, the sheets no run has asked for yet are parsed now and kept in the entry """
+    missing = [k for k in sheets if k not in entry["sheets"]]
+    if missing:
+        rows = read_excel(entry["path"], sheets=missing)
+        with REGISTRY_LOCK:
+            entry["sheets"].update(rows)
+    return {k: entry["sheets"][k] for k in sheets}
+
+def clear_registry():
+    with REGISTRY_LOCK:
+        LIBRARY_REGISTRY.clear()
+
+def registry_schedules(entry, schedules:list):
+    """ compile_schedules of these rows of entry's workbook, picked from the entry's compiled schedules """
+    if entry["schedules"] is None:
+        entry["schedules"] = compile_schedules(library_sheets(entry, ["schedules"])["schedules"])
+    return {name: entry["schedules"][name] for name in dict.fromkeys(map(schedule_name, schedules))}
+
+def library_closure(read_sheets, space_types):
+    """ rows reachable from the named space types, read_sheets(names) -> {sheet: rows} supplies the sheets """
+    levels = [["space_types"], ["schedule_sets", "people", "lights", "equipment", "infiltration", "outdoor_air", "construction_sets"],
+              ["schedules", "constructions"], ["materials"]]
+    wanted = {"space_types": set(space_types)}
+    data = {}
+    for level in levels:
+        needed = [k for k in level if wanted.get(k)]
+        sheets = read_sheets(needed) if needed else {}
+        for sheet in level:
+            data[sheet] = [r for r in sheets.get(sheet, []) if row_key(sheet, r) in wanted.get(sheet, ())]
+            for r in data[sheet]:
+                for target, name in row_references(sheet, r):
+                    wanted.setdefault(target, set()).add(name)
+    return data
+
+def model_space_type_names(model):
+    """ names and standards space types of the space types the model's spaces use """
+    names = set()
+    for space in model.getSpaces():
+        space_type = space.spaceType()
+        if not space_type.is_initialized():
+            continue
+        space_type = space_type.get()
+        names.add(space_type.nameString())
+        if space_type.standardsSpaceType().is_initialized():
+            names.add(space_type.standardsSpaceType().get())
+    return names
+
+def name_tokens(text):
+    """ "189.1-2009 - Office - OpenOffice" -> ("189", "1", "2009", "office", "openoffice") """
+    return tuple(re.findall(r"[a-z0-9]+", str(text or "").lower()))
+
+def space_type_aliases(space_types, aliases=()):
+    """ {name tokens: {library space type}} of the space type names and the ALIAS_SHEET rows naming one of them """
+    index = collections.defaultdict(set)
+    for name in space_types:
+        index[name_tokens(name)].add(name)
+    for row in aliases:
+        if row.get("space_type") in space_types and name_tokens(row.get("alias")):
+            index[name_tokens(row.get("alias"))].add(row.get("space_type"))
+    index.pop((), None)
+    return index
+
+def space_match_texts(space):
+    """ what a space is matched by, in order: its name, its story, its space type and that type's standards tags """
+    texts = [space.nameString()]
+    if space.buildingStory().is_initialized():
+        texts.append(space.buildingStory().get().nameString())
+    if space.spaceType().is_initialized():
+        space_type = space.spaceType().get()
+        texts.append(space_type.nameString())
+        texts.extend(tag.get() for tag in (space_type.standardsSpaceType(), space_type.standardsBuildingType()) if tag.is_initialized())
+    return texts
+
+def match_space_types(spaces, aliases:dict):
+    """ ([(space, library space type)], [unmatched space], [(ambiguous space, [space types])]) in one pass over spaces
+
+    Every run of a text's tokens as long as the longest alias is looked up in aliases, so a space
+    costs a few dict lookups whatever the size of the library. The first text with a match decides
+    and its longest aliases win, "Office perimeter 2" is Office perimeter rather than Office; when
+    they name more than one space type the space is ambiguous.
+    """
+    longest = max(map(len, aliases), default=0)
+    matched, unmatched, ambiguous = [], [], []
+    for space in spaces:
+        best = set()
+        for text in space_match_texts(space):
+            tokens = name_tokens(text)
+            for size in range(min(longest, len(tokens)), 0, -1):
+                best = set().union(*(aliases.get(tokens[i:i + size], ()) for i in range(len(tokens) - size + 1)))
+                if best:
+                    break
+            if best:
+                break
+        if not best:
+            unmatched.append(space)
+        elif len(best) == 1:
+            matched.append((space, best.pop()))
+        else:
+            ambiguous.append((space, sorted(best)))
+    return matched, unmatched, ambiguous
+
+def assign_space_types(model, space_types:dict, aliases=()):
+    """ set every space of model to the library space type match_space_types finds for it
+
+    space_types maps library names to the SpaceType objects built for them, aliases are ALIAS_SHEET
+    rows. Returns (spaces assigned, unmatched space names, {ambiguous space name: [space types]}),
+    unmatched and ambiguous spaces keep the space type they had.
+    """
+    matched, unmatched, ambiguous = match_space_types(model.getSpaces(), space_type_aliases(space_types, aliases))
+    for space, name in matched:
+        space.setSpaceType(space_types[name])
+    return len(matched), [s.nameString() for s in unmatched], {s.nameString(): names for s, names in ambiguous}
+
+def hour_profile(data_pairs, owner):
+    """ compile_profile for [hour, value] pairs with fractional hours, e.g. [[8.5, 0.0], [24.0, 1.0]] """
+    return compile_profile([(round(hour * 60), value) for hour, value in data_pairs], owner)
 
 def create_complex_schedule(model, options = {}):
     defaults = {
         'name': None,
-        'default_day': ['always_on', [24.0, 1.0]]
+        'winter_design_day': None,
+        'summer_design_day': None,
+        'default_day': ['always_on', [24.0, 1.0]],
+        'rules': None
     }
     # merge user inputs with defaults
     options = {**defaults, **options}
@@ -34,33 +1528,22 @@ def create_complex_schedule(model, options = {}):
         sch_ruleset.setWinterDesignDaySchedule(winter_dsn_day)
         winter_dsn_day = sch_ruleset.winterDesignDaySchedule()
         winter_dsn_day.setName(f"{sch_ruleset.name()} Winter Design Day")
-        for data_pair in options['winter_design_day']:
-            hour = int(data_pair[0])
-            min = int((data_pair[0] - hour) * 60)
-            winter_dsn_day.addValue(openstudio.Time(0, hour, min, 0), data_pair[1])
+        update_schedule_data(winter_dsn_day, hour_profile(options['winter_design_day'], winter_dsn_day.nameString()))
     # Summer Design Day
     if options['summer_design_day'] is not None:
-        summer_dsn_day = openstudio.Model.ScheduleDay(model)
+        summer_dsn_day = openstudio.model.ScheduleDay(model)
         sch_ruleset.setSummerDesignDaySchedule(summer_dsn_day)
         summer_dsn_day = sch_ruleset.summerDesignDaySchedule()
         summer_dsn_day.setName(f"{sch_ruleset.name()} Summer Design Day")
-        for data_pair in options['summer_design_day']:
-            hour = int(data_pair[0])
-            min = int((data_pair[0] - hour) * 60)
-            summer_dsn_day.addValue(openstudio.Time(0, hour, min, 0), data_pair[1])
+        update_schedule_data(summer_dsn_day, hour_profile(options['summer_design_day'], summer_dsn_day.nameString()))
     # Default Day
     default_day = sch_ruleset.defaultDaySchedule()
     default_day.setName(f"{sch_ruleset.name()} {options['default_day'][0]}")
-    default_data_array = options['default_day']
-    del default_data_array[0]
-    for data_pair in default_data_array:
-        hour = int(data_pair[0])
-        min = int((data_pair[0] - hour) * 60)
-        default_day.addValue(openstudio.Time(0, hour, min, 0), data_pair[1])
+    update_schedule_data(default_day, hour_profile(options['default_day'][1:], default_day.nameString()))
     # Rules
     if options['rules'] is not None:
         for data_array in options['rules']:
-            rule = openstudio.Model.ScheduleRule(sch_ruleset)
+            rule = openstudio.model.ScheduleRule(sch_ruleset)
             rule.setName(f"{sch_ruleset.name()} {data_array[0]} Rule")
             date_range = data_array[1].split('-')
             start_date = date_range[0].split('/')
@@ -84,21 +1567,16 @@ def create_complex_schedule(model, options = {}):
                 rule.setApplySaturday(True)
             day_schedule = rule.daySchedule()
             day_schedule.setName(f"{sch_ruleset.name()} {data_array[0]}")
-            del data_array[0:3]
-            for data_pair in data_array:
-                hour = int(data_pair[0])
-                min = int((data_pair[0] - hour) * 60)
-                day_schedule.addValue(openstudio.Time(0, hour, min, 0), data_pair[1])
+            update_schedule_data(day_schedule, hour_profile(data_array[3:], day_schedule.nameString()))
     return sch_ruleset
 
 def make_schedule_sets():
     return "lights"
 
-def create_people_load(osm, peoples:dict):
+def create_people_load(osm, peoples:dict, upsert=None):
     # make a people def
     
-    def _make(data:dict):
-        people_def = openstudio.model.PeopleDefinition(osm)
+    def _apply(people_def, data:dict):
         people_def.setSpaceFloorAreaperPerson( data.get("area per person") )
         people_def.setName( data.get("description") )
         #setSpaceFloorAreaperPerson
@@ -106,177 +1584,900 @@ def create_people_load(osm, peoples:dict):
         #setFractionRadiant
         #setSensibleHeatFraction
 
-        # make a people load
-        people_load = openstudio.model.People(people_def)
+        # the People loads are made per space type in create_space_types
         #set work efficiency schedule name
         #set clothing insulation schedule name 
         #set air velocity schedule name
 
-    list(map( _make, peoples))
+    def _make(data:dict):
+        new = lambda: openstudio.model.PeopleDefinition(osm)
+        return data.get("description"), upsert_row("people", data.get("description"), data, new, _apply, upsert)
+
+    return dict(map( _make, peoples))
 
-def create_lights_load(osm, lights:dict):
+def create_lights_load(osm, lights:dict, upsert=None):
     
-    def _make(data:dict):
-        lights_def = openstudio.model.LightsDefinition(osm)
+    def _apply(lights_def, data:dict):
         lights_def.setWattsperSpaceFloorArea( data.get("Adjusted IPD") )
         lights_def.setName( data.get("description") )
-        
-
-    list(map( _make, lights))
 
-def create_electric_equipment_load(osm, equipments:dict):
     def _make(data:dict):
-        equip_def = openstudio.model.ElectricEquipmentDefinition(osm)
+        new = lambda: openstudio.model.LightsDefinition(osm)
+        return data.get("description"), upsert_row("lights", data.get("description"), data, new, _apply, upsert)
+
+    return dict(map( _make, lights))
+
+def create_electric_equipment_load(osm, equipments:dict, upsert=None):
+    def _apply(equip_def, data:dict):
         equip_def.setWattsperSpaceFloorArea( data.get("W/m2") )
         equip_def.setName( data.get("description") )
-        equip_load = openstudio.model.ElectricEquipment(equip_def)
 
-    list(map( _make, equipments))
+    def _make(data:dict):
+        new = lambda: openstudio.model.ElectricEquipmentDefinition(osm)
+        return data.get("description"), upsert_row("equipment", data.get("description"), data, new, _apply, upsert)
 
-def create_infiltration_objects(osm, infiltrations:dict):
+    return dict(map( _make, equipments))
 
-    def _make(data:dict):
-        infiltration = openstudio.model.SpaceInfiltrationDesignFlowRate(osm)
+def create_infiltration_objects(osm, infiltrations:dict, upsert=None):
+
+    def _apply(infiltration, data:dict):
         infiltration.setName(data.get("description"))
         infiltration.setAirChangesperHour( data.get("hvac_off") )
 
-    list(map( _make, infiltrations))
-
-def create_outdoor_air_objects(osm, outdoor_airs:dict):
     def _make(data:dict):
-        ventilation = openstudio.model.DesignSpecificationOutdoorAir(osm)
+        new = lambda: openstudio.model.SpaceInfiltrationDesignFlowRate(osm)
+        return data.get("description"), upsert_row("infiltration", data.get("description"), data, new, _apply, upsert)
+
+    return dict(map( _make, infiltrations))
+
+def create_outdoor_air_objects(osm, outdoor_airs:dict, upsert=None):
+    def _apply(ventilation, data:dict):
         ventilation.setOutdoorAirFlowperPerson( data.get("L/s/person") )
         ventilation.setName(data.get("description"))
 
-    list(map( _make, outdoor_airs))
-
-def create_space_types(osm, space_types_dicts:list):
-    
     def _make(data:dict):
-        space_type = openstudio.model.SpaceType(osm)
-        space_type.setName( data.get("name"))
-
-        lights_def = openstudio.model.getLightsDefinitionByName(osm, data.get("lights") ).get()
-        lights = openstudio.model.Lights(lights_def)
-        space_load = openstudio.model.SpaceLoad(lights)
-        space_load.setSpaceType( space_type)
+        new = lambda: openstudio.model.DesignSpecificationOutdoorAir(osm)
+        return data.get("description"), upsert_row("outdoor_air", data.get("description"), data, new, _apply, upsert)
+
+    return dict(map( _make, outdoor_airs))
+
+def resolve(index:dict, sheet, name, owner):
+    """ object built for `name` this run, a dangling name raises LibraryError saying which row used it """
+    LOOKUPS["resolve"] += 1
+    try:
+        return index[sheet][name]
+    except KeyError:
+        raise LibraryError(f"{owner} references '{name}' but there is no such row in the {sheet} sheet") from None
+
+def material_properties(data:dict):
+    """ (type, {column: value}) of a materials row, the type defaults to StandardOpaqueMaterial """
+    kind = data.get("type") or "StandardOpaqueMaterial"
+    if kind not in MATERIAL_PROPERTIES:
+        raise LibraryError(f"material '{data.get('name')}' has unknown type '{kind}', expected one of {sorted(MATERIAL_PROPERTIES)}")
+    return kind, {column: data[column] for column in MATERIAL_PROPERTIES[kind] if data.get(column) is not None}
+
+def create_materials(osm, materials_dicts:list, upsert=None):
+    """ one material per distinct name, repeated rows with the same type and properties share it """
+
+    def _apply(material, data:dict):
+        kind, properties = material_properties(data)
+        typed = getattr(material, f"to_{kind}")()
+        if not typed.is_initialized():
+            raise LibraryError(f"material '{data.get('name')}' is already in the model as another type than {kind}")
+        typed = typed.get()
+        typed.setName(data.get("name"))
+        for column, value in properties.items():
+            if getattr(typed, MATERIAL_PROPERTIES[kind][column])(value) is False:
+                raise LibraryError(f"material '{data.get('name')}' has invalid {column} {value!r}")
+
+    interned = {}
+    def _make(data:dict):
+        name = data.get("name")
+        identity = material_properties(data)
+        if name in interned:
+            if interned[name][0] != identity:
+                raise LibraryError(f"material '{name}' appears twice in the materials sheet with different properties")
+            return name, interned[name][1]
+        new = lambda: getattr(openstudio.model, identity[0])(osm)
+        interned[name] = identity, upsert_row("materials", name, data, new, _apply, upsert)
+        return name, interned[name][1]
+
+    return dict(map( _make, materials_dicts or []))
+
+def construction_layers(constructions_dicts:list):
+    """ {name: [material, ...]} from the constructions sheet, one row per layer listed outside to inside """
+    layers = {}
+    for row in constructions_dicts or []:
+        layers.setdefault(row.get("name"), []).append(row.get("material"))
+    return layers
+
+def create_constructions(osm, constructions_dicts:list, materials:dict, upsert=None):
+    """ materials maps name -> the material built for it """
+
+    def _apply(construction, data:dict):
+        construction.setName(data.get("name"))
+        owner = f"construction '{data.get('name')}'"
+        construction.setLayers([resolve({"materials": materials}, "materials", name, owner) for name in data.get("layers")])
+
+    def _depends(data:dict):
+        return [str(materials[name].handle()) for name in data.get("layers") if name in materials]
+
+    def _make(item):
+        name, layers = item
+        new = lambda: openstudio.model.Construction(osm)
+        return name, upsert_row("constructions", name, {"name": name, "layers": layers}, new, _apply, upsert, _depends)
+
+    return dict(map( _make, construction_layers(constructions_dicts).items()))
+
+def create_construction_sets(osm, construction_sets_dicts:list, constructions:dict, upsert=None):
+    """ DefaultConstructionSets wired to the constructions named in CONSTRUCTION_SET_COLUMNS, blank columns reset """
+
+    def _apply(construction_set, data:dict):
+        construction_set.setName(data.get("name"))
+        owner = f"construction set '{data.get('name')}'"
+        for group in dict.fromkeys(group for group, _ in CONSTRUCTION_SET_COLUMNS.values()):
+            columns = {column: setter for column, (g, setter) in CONSTRUCTION_SET_COLUMNS.items() if g == group}
+            children = getattr(construction_set, group[0].lower() + group[1:])()
+            if children.is_initialized():
+                children = children.get()
+            elif any(data.get(column) for column in columns):
+                children = getattr(openstudio.model, "DefaultSubSurfaceConstructions" if "SubSurface" in group else "DefaultSurfaceConstructions")(osm)
+                children.setName(f"{data.get('name')} {group[len('Default'):-len('Constructions')]}")
+                getattr(construction_set, f"set{group}")(children)
+            else:
+                continue
+            for column, setter in columns.items():
+                if data.get(column):
+                    getattr(children, setter)(resolve({"constructions": constructions}, "constructions", data.get(column), owner))
+                else:
+                    getattr(children, "reset" + setter[len("set"):])()
 
-        equip_def = openstudio.model.getElectricEquipmentDefinitionByName(osm, data.get("equipment") ).get()
-        equip = openstudio.model.ElectricEquipment(equip_def)
-        space_load = openstudio.model.SpaceLoad(equip)
-        space_load.setSpaceType( space_type)
+    def _make(data:dict):
+        new = lambda: openstudio.model.DefaultConstructionSet(osm)
+        depends = reference_handles({"constructions": constructions}, "construction_sets")
+        return data.get("name"), upsert_row("construction_sets", data.get("name"), data, new, _apply, upsert, depends)
 
-        people_def = openstudio.model.getPeopleDefinitionByName(osm, data.get("people") ).get()
-        people = openstudio.model.People(people_def)
-        space_load = openstudio.model.SpaceLoad(people)
-        space_load.setSpaceType( space_type)
+    return dict(map( _make, construction_sets_dicts or []))
 
-        inf = openstudio.model.getSpaceInfiltrationDesignFlowRateByName(osm, data.get("infiltration") ).get()
-        space_load = openstudio.model.SpaceLoad(inf)
-        space_load.setSpaceType( space_type)
+def create_space_types(osm, space_types_dicts:list, index:dict, upsert=None):
+    """ index maps sheet -> {name: object} of everything the space types reference """
 
-        s = osm.getDefaultScheduleSetByName("Office").get()
+    def _apply(space_type, data:dict):
+        space_type.setName( data.get("name"))
+        owner = f"space type '{data.get('name')}'"
+        # an updated space type gets its loads rebuilt
+        for load in [*space_type.lights(), *space_type.electricEquipment(), *space_type.people(), *space_type.spaceInfiltrationDesignFlowRates()]:
+            load.remove()
+
+        if data.get("lights"):
+            lights = openstudio.model.Lights(resolve(index, "lights", data.get("lights"), owner))
+            lights.setSpaceType( space_type)
+
+        if data.get("equipment"):
+            equip = openstudio.model.ElectricEquipment(resolve(index, "equipment", data.get("equipment"), owner))
+            equip.setSpaceType( space_type)
+
+        if data.get("people"):
+            people = openstudio.model.People(resolve(index, "people", data.get("people"), owner))
+            people.setSpaceType( space_type)
+
+        if data.get("infiltration"):
+            # infiltration is a load not a definition, the library object stays unassigned and each space type gets a copy
+            inf = resolve(index, "infiltration", data.get("infiltration"), owner).clone(osm).to_SpaceInfiltrationDesignFlowRate().get()
+            if inf.hasAdditionalProperties():
+                inf.removeAdditionalProperties()
+            inf.setSpaceType( space_type)
+
+        s = resolve(index, "schedule_sets", data.get("schedule_set") or DEFAULT_SCHEDULE_SET, owner)
         space_type.setDefaultScheduleSet(s)
-        oa = osm.getDesignSpecificationOutdoorAirByName("office 7.5 L/s/person").get()
-        space_type.setDesignSpecificationOutdoorAir( oa)
-
-
-    list(map( _make, space_types_dicts))
-
-    pass
-
-def set_in(d, path, value):
-    parts = path.split('.') if isinstance(path, str) else path
-    if len(parts) <= 1:
-        d[parts[0]] = value
-        return d
-    if not parts[0] in d:
-        d[parts[0]] = {}
-    set_in(d[parts[0]], parts[1:], value)
-    return d
+        if data.get("outdoor_air"):
+            oa = resolve(index, "outdoor_air", data.get("outdoor_air"), owner)
+            space_type.setDesignSpecificationOutdoorAir( oa)
+        else:
+            space_type.resetDesignSpecificationOutdoorAir()
+        if data.get("construction_set"):
+            space_type.setDefaultConstructionSet( resolve(index, "construction_sets", data.get("construction_set"), owner))
+        else:
+            space_type.resetDefaultConstructionSet()
 
-def nest_schedules( schedules:dict):
-
-    nested_schedules = {}
-    def _nest(schedule):
-        set_in(nested_schedules, 
-               [f'{schedule.get("space_type").replace(" ","")}-{schedule.get("schedule_type")}',schedule.get("day_type") ],
-                {"data":[], "day_type":schedule.get("day_type") } )
-
-    list( map(_nest, schedules ) )
-
-    def _update_data(schedule):
-        path = f'{schedule.get("space_type").replace(" ","")}-{schedule.get("schedule_type")}'
-        nested_schedules[path][schedule.get("day_type") ]["data"].append( 
-            {"from":schedule.get("from"), 
-              "to":schedule.get("to"), 
-               "value":schedule.get("value")}
-        )                  
-    
-    list( map(_update_data, schedules ) )
-
-    return nested_schedules
-
-def update_schedule_data(schedule, data):
-    for values in data.get("data"):
-        hour = int(values.get("to").split(":")[0])
-        min = int( values.get("to").split(":")[1] )
-        schedule.addValue(openstudio.Time(0, hour, min, 0), values.get("value"))
-
-def make_default_schedule(osm, schedule_ruleset,name,  day_schedule:dict):
+    def _make(data:dict):
+        new = lambda: openstudio.model.SpaceType(osm)
+        depends = reference_handles(index, "space_types")
+        return data.get("name"), upsert_row("space_types", data.get("name"), data, new, _apply, upsert, depends)
+
+    return dict(map( _make, space_types_dicts))
+
+def build_library(osm, data:dict, upsert=None, trace=None, schedule_format="Ruleset", year=None, base=None, compiled_schedules=None,
+                  path=RESOURCES_PATH):
+    """ create the library objects for the rows in data, returns {sheet: {key: object}}
+
+    schedule_format picks the schedule builder, see SCHEDULE_FORMATS. year is the calendar year
+    ScheduleFile columns start in, the model's own by default. base holds {sheet: {key: object}} of
+    rows left out of data that the built rows may still reference. compiled_schedules is
+    compile_schedules of data's schedules rows when the caller has it already, see registry_schedules.
+    path is the workbook the ScheduleFile CSV is cached next to.
+    """
+    index = collections.defaultdict(dict, {sheet: dict(objects) for sheet, objects in (base or {}).items()})
+    phase = trace.phase if trace is not None else lambda name: contextlib.nullcontext()
+
+    # Make Schedules
+    with phase("schedules"):
+        if compiled_schedules is None:
+            compiled_schedules = compile_schedules(data.get("schedules"))
+        if schedule_format == "ScheduleFile":
+            index["schedules"].update(make_schedule_files(osm, compiled_schedules, upsert, year, path))
+        else:
+            index["schedules"].update(make_schedule_rulesets(osm, compiled_schedules, upsert))
+
+    # Make Schedule Sets
+    with phase("schedule_sets"):
+        index["schedule_sets"].update(create_schedule_sets(osm, data.get("schedule_sets"), index["schedules"], upsert))
+
+    # People
+    with phase("people"):
+        index["people"].update(create_people_load(osm, data.get("people"), upsert))
+
+    # Lights
+    with phase("lights"):
+        index["lights"].update(create_lights_load(osm, data.get("lights"), upsert))
+
+    # electric equipment defs   (BCA and that mech std)
+    with phase("equipment"):
+        index["equipment"].update(create_electric_equipment_load(osm, data.get("equipment"), upsert))
+
+    # infiltration defs (mostly BCA)
+    with phase("infiltration"):
+        index["infiltration"].update(create_infiltration_objects(osm, data.get("infiltration"), upsert))
+
+    # OA defs   (AS 1668.2)
+    with phase("outdoor_air"):
+        index["outdoor_air"].update(create_outdoor_air_objects(osm, data.get("outdoor_air"), upsert))
+
+    # Materials, constructions and the construction sets space types default to
+    with phase("materials"):
+        index["materials"].update(create_materials(osm, data.get("materials"), upsert))
+    with phase("constructions"):
+        index["constructions"].update(create_constructions(osm, data.get("constructions"), index["materials"], upsert))
+    with phase("construction_sets"):
+        index["construction_sets"].update(create_construction_sets(osm, data.get("construction_sets"), index["constructions"], upsert))
+
+    # Make Space Types
+    with phase("space_types"):
+        index["space_types"].update(create_space_types(osm, data.get("space_types"), index, upsert))
+    return index
+
+def _minute(text):
+    """ "HH:MM[:SS]" -> minutes after midnight, a 00:00 end is midnight at the end of the day """
+    hour, min = text.split(":")[:2]
+    return int(hour) * 60 + int(min) or 24 * 60
+
+def _clock(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def compile_profile(points, owner, schedule_type=None):
+    """ (until minute, value) pairs -> {"minutes": array("H"), "values": array("d")} with runs of equal values merged
+
+    Raises LibraryError unless the times increase, the last one is 24:00 and the values are
+    within the limits SCHEDULE_TYPE_LIMITS gives schedule_type.
+    """
+    limits = SCHEDULE_TYPE_LIMITS.get(str(schedule_type).lower())
+    minutes, values = array.array("H"), array.array("d")
+    for until, value in points:
+        if minutes and until <= minutes[-1]:
+            raise LibraryError(f"{owner}: times must increase but {_clock(until)} follows {_clock(minutes[-1])}")
+        if value is None or (limits and not limits[0] <= value <= limits[1]):
+            raise LibraryError(f"{owner}: value {value} until {_clock(until)} is outside the {schedule_type} limits {list(limits or ())}")
+        if values and values[-1] == value:
+            minutes[-1] = until
+        else:
+            minutes.append(until)
+            values.append(value)
+    if not minutes or minutes[-1] != 24 * 60:
+        raise LibraryError(f"{owner} ends at {_clock(minutes[-1]) if minutes else 'no time'}, a day has to end at 24:00")
+    return {"minutes": minutes, "values": values}
+
+def compile_schedules(schedules:list):
+    """ schedules rows -> {ruleset name: {day_type: profile}} in one pass, see compile_profile """
+    points = {}
+    for row in schedules:
+        day = points.setdefault(schedule_name(row), {}).setdefault(row.get("day_type"), (row.get("schedule_type"), []))
+        day[1].append((_minute(row.get("to")), row.get("value")))
+
+    def _compile(name, day_type, schedule_type, day_points):
+        profile = compile_profile(day_points, f"schedule '{name}' {day_type}", schedule_type)
+        return {"day_type": day_type, "schedule_type": schedule_type, **profile}
+
+    return {name: {d: _compile(name, d, *day) for d, day in days.items()} for name, days in points.items()}
+
+def profile_key(profile:dict):
+    """ hashable identity of a compiled day """
+    return (profile.get("schedule_type"), profile["minutes"].tobytes(), profile["values"].tobytes())
+
+def update_schedule_data(schedule, profile:dict):
+    for until, value in zip(profile["minutes"], profile["values"]):
+        schedule.addValue(openstudio.Time(0, 0, until, 0), value)
+
+def make_default_schedule(osm, schedule_ruleset,name,  day_schedule:dict, days=None):
     default_day = schedule_ruleset.defaultDaySchedule()
     default_day.setName( name )
     update_schedule_data(default_day, day_schedule )
 
-def make_weekend_schedule(osm, schedule_ruleset,name, schedule_dict:dict):
-    rule = openstudio.model.ScheduleRule(schedule_ruleset)
+def make_weekend_schedule(osm, schedule_ruleset,name, schedule_dict:dict, days=None):
+    """ days maps (schedule type, profile) to a ScheduleDay already built in this run, the rule clones it """
+    key = profile_key(schedule_dict)
+    if days is not None and key in days:
+        rule = openstudio.model.ScheduleRule(schedule_ruleset, days[key])
+    else:
+        rule = openstudio.model.ScheduleRule(schedule_ruleset)
+        update_schedule_data(rule.daySchedule(), schedule_dict )
+        if days is not None:
+            days[key] = rule.daySchedule()
     rule.setName(name)
     rule.setApplySunday(True)
     rule.setApplySaturday(True)
-    day_schedule = rule.daySchedule()
-    day_schedule.setName(name)
-    update_schedule_data(day_schedule, schedule_dict )
+    rule.daySchedule().setName(name)
 
 def get_schedule_handler(name, schedule):
-        if name in ["weekdays", "default"]:
-            return make_default_schedule
-        if name in ["weekend"]:
-            return make_weekend_schedule
+    """ builder of a day type, see DAY_TYPES, LibraryError for a day type it does not know """
+    if name not in DAY_TYPES:
+        raise LibraryError(f"unknown day type {name!r}, it has to be one of {', '.join(DAY_TYPES)}")
+    return make_default_schedule if DAY_TYPES[name] == "default" else make_weekend_schedule
 
-def make_schedule_ruleset(osm, name, schedules:dict):
+def make_schedule_ruleset(osm, name, schedules:dict, upsert=None, days=None):
     """ map per like { Class5OfficeBuilding-Occupancy: {"daytype"} """
 
-    schedule_ruleset = openstudio.model.ScheduleRuleset(osm)
-    schedule_ruleset.setName( name )
-    
-    for name,schedule_dict in schedules.items():
-        # get the handler
-        handler = get_schedule_handler(name, schedule_dict)
-        handler(osm, schedule_ruleset, name, schedule_dict) 
+    def _apply(schedule_ruleset, schedules:dict):
+        # every day type is known before the ruleset changes
+        handlers = {d: get_schedule_handler(d, s) for d, s in schedules.items()}
+        schedule_ruleset.setName( name )
+        # an updated ruleset starts from an empty default day and no rules
+        schedule_ruleset.defaultDaySchedule().clearValues()
+        for rule in schedule_ruleset.scheduleRules():
+            rule.remove()
+
+        default = [profile_key(s) for d, s in schedules.items() if handlers[d] is make_default_schedule]
+        for day_name, schedule_dict in schedules.items():
+            handler = handlers[day_name]
+            # a rule repeating the default day changes nothing
+            if handler is not make_default_schedule and profile_key(schedule_dict) in default:
+                continue
+            handler(osm, schedule_ruleset, day_name, schedule_dict, days) 
+
+    new = lambda: openstudio.model.ScheduleRuleset(osm)
+    return upsert_row("schedules", name, schedules, new, _apply, upsert)
+
+def make_schedule_rulesets(osm, compiled_schedules:dict, upsert=None):
+    """ make_schedule_ruleset for each compiled schedule, names whose days have the same profiles share one ruleset """
+    days = {}
+    rulesets = {}
+
+    def _make(item):
+        name, schedules = item
+        signature = tuple(sorted((d, profile_key(s)) for d, s in schedules.items()))
+        if signature not in rulesets:
+            rulesets[signature] = make_schedule_ruleset(osm, name, schedules, upsert, days)
+        return name, rulesets[signature]
+
+    return dict(map(_make, compiled_schedules.items()))
+
+# OpenStudio's assumed year when the model has no YearDescription
+DEFAULT_YEAR = 2009
+
+def day_signature(day_schedule):
+    """ (until minutes, values) of a ScheduleDay """
+    return (tuple(round(t.totalMinutes()) for t in day_schedule.times()), tuple(day_schedule.values()))
+
+def model_year(model):
+    """ the year a model's schedules run in, its YearDescription's assumed year """
+    return model.yearDescription().get().assumedYear() if model.yearDescription().is_initialized() else DEFAULT_YEAR
+
+@functools.lru_cache(maxsize=None)
+def rule_date_fields():
+    """ indexes of the Start Month, Start Day, End Month and End Day fields of OS:Schedule:Rule, looked up by IDD name """
+    fields = osm_templates()[0]["ScheduleRule"][2]
+    return tuple(fields[_field_key(name)] for name in ("Start Month", "Start Day", "End Month", "End Day"))
+
+def ruleset_signature(schedule_ruleset, year=None):
+    """ everything schedule_8760 reads from a ScheduleRuleset, hashable so expansions are cached by content
+
+    Rules are kept in priority order, each as (day, ("range", start, end) or ("dates", days of year), Mon..Sun flags).
+    """
+    year = year or model_year(schedule_ruleset.model())
+
+    def _doy(month, day):
+        return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1])).timetuple().tm_yday
+
+    def _rule(rule):
+        if rule.dateSpecificationType() == "SpecificDates":
+            dates = ("dates", tuple(_doy(d.monthOfYear().value(), d.dayOfMonth()) for d in rule.specificDates()))
+        else:
+            # Start Month, Start Day, End Month, End Day read as plain fields, the Date getters are far slower
+            month_days = [rule.getInt(i) for i in rule_date_fields()]
+            month_days = [v.get() if v.is_initialized() else default for v, default in zip(month_days, (1, 1, 12, 31))]
+            dates = ("range", _doy(*month_days[:2]), _doy(*month_days[2:]))
+        flags = (rule.applyMonday(), rule.applyTuesday(), rule.applyWednesday(), rule.applyThursday(),
+                 rule.applyFriday(), rule.applySaturday(), rule.applySunday())
+        return day_signature(rule.daySchedule()), dates, flags
+
+    return year, day_signature(schedule_ruleset.defaultDaySchedule()), tuple(map(_rule, schedule_ruleset.scheduleRules()))
+
+@functools.lru_cache(maxsize=4096)
+def hourly_profile(signature):
+    """ 24 hourly means of a day_signature """
+    import numpy as np
+    minutes, values = signature
+    durations = np.diff(np.asarray((0,) + minutes))
+    hours = np.repeat(np.asarray(values, dtype=float), durations).reshape(24, 60)
+    # an hour without a change keeps its exact value, the mean would add rounding noise
+    hourly = np.where((hours == hours[:, :1]).all(axis=1), hours[:, 0], hours.mean(axis=1))
+    hourly.setflags(write=False)
+    return hourly
+
+def expand_days(profiles, day_index):
+    """ one row of profiles per day of year, day_index[doy - 1] picks the row """
+    import numpy as np
+    return np.asarray(profiles)[np.asarray(day_index)].ravel()
+
+@functools.lru_cache(maxsize=4096)
+def _expand_signature(signature):
+    import numpy as np
+    year, default, rules = signature
+    doy = np.arange(1, (366 if calendar.isleap(year) else 365) + 1)
+    weekday = (datetime.date(year, 1, 1).weekday() + doy - 1) % 7
+    day_index = np.zeros(len(doy), dtype=np.intp)
+    # lowest priority first so higher priority rules overwrite it
+    for i in reversed(range(len(rules))):
+        day, dates, flags = rules[i]
+        if dates[0] == "dates":
+            in_dates = np.isin(doy, dates[1])
+        elif dates[1] <= dates[2]:
+            in_dates = (doy >= dates[1]) & (doy <= dates[2])
+        else:
+            in_dates = (doy >= dates[1]) | (doy <= dates[2])
+        day_index[in_dates & np.asarray(flags)[weekday]] = i + 1
+    profiles = [hourly_profile(default)] + [hourly_profile(rule[0]) for rule in rules]
+    values = expand_days(profiles, day_index)
+    values.setflags(write=False)
+    return values
+
+def schedule_8760(schedule_ruleset, year=None):
+    """ hourly values of a ScheduleRuleset over its model's year as a read-only NumPy array (8784 in a leap year)
+
+    Applies the default day, the rules by priority with their date ranges or specific dates and
+    weekday flags. Holiday and design day schedules are not part of the year. Results are cached
+    by ruleset_signature, so rulesets with the same content share one array.
+    """
+    return _expand_signature(ruleset_signature(schedule_ruleset, year))
+
+def schedules_8760(model):
+    """ schedule_8760 of every ScheduleRuleset in model, by name """
+    year = model_year(model)
+    return {s.nameString(): schedule_8760(s, year) for s in model.getScheduleRulesets()}
+
+def compiled_signature(schedules:dict, year):
+    """ ruleset_signature of the ruleset make_schedule_ruleset builds from compiled schedules, without building it """
+    default, rules = ((24 * 60,), (0.0,)), []
+    for day_name, profile in schedules.items():
+        day = (tuple(profile["minutes"]), tuple(profile["values"]))
+        handler = get_schedule_handler(day_name, profile)
+        if handler is make_default_schedule:
+            default = day
+        elif handler is make_weekend_schedule:
+            rules.append((day, ("range", 1, 366), (False,) * 5 + (True, True)))
+    return year, default, tuple(rules)
+
+def schedule_csv(compiled_schedules:dict, year, path=RESOURCES_PATH):
+    """ CSV with one hourly column per distinct compiled schedule for the year, returns (csv path, {name: column number})
+
+    Schedules with the same hourly values share a column. The file is named by the hash of its
+    columns, resources.<hash>.schedules.csv next to the workbook, only written when missing and
+    evicted like the prebuilt libraries, see evict_prebuilt.
+    It is shared by everyone building from the workbook, so it is world-readable, and models
+    reference a copy in their own files directory. A failed write raises LibraryError.
+    """
+    signatures = {name: compiled_signature(schedules, year) for name, schedules in compiled_schedules.items()}
+    distinct = list(dict.fromkeys(signatures.values()))
+    columns = {name: distinct.index(signature) + 1 for name, signature in signatures.items()}
+    digest = fingerprint([str(s) for s in distinct], [CACHE_VERSION])
+    target = Path(path).with_name(f"{Path(path).stem}.{digest[:16]}.schedules.csv")
+    if target.exists():
+        mark_used(target)
+    else:
+        import numpy as np
+        header = [next(n for n, c in columns.items() if c == i + 1) for i in range(len(distinct))]
+        values = np.column_stack([_expand_signature(s) for s in distinct]) if distinct else np.empty((0, 0))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=target.name, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                np.savetxt(f, values, fmt="%.10g", delimiter=",", header=",".join(header), comments="")
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, target)
+        except OSError as e:
+            raise LibraryError(f"could not write the schedule CSV {target}: {e}") from e
+        evict_prebuilt(path)
+    return target, columns
+
+def model_files_dir(model):
+    """ the files directory of the workflow model was opened with, None when the workflow has no path """
+    workflow = model.workflowJSON()
+    if not workflow.oswPath().is_initialized():
+        return None
+    return Path(str(workflow.absoluteFilePaths()[0]))
+
+def schedule_files_dir(model, path=RESOURCES_PATH):
+    """ where model's schedule CSVs go: its workflow's files directory, or beside the workbook when the workflow has no path
+
+    OpenStudio would pick the working directory for a workflow without a path, so the workbook's
+    directory is added to the workflow's file paths instead and the CSVs are used where schedule_csv wrote them.
+    """
+    files_dir = model_files_dir(model)
+    if files_dir is None:
+        files_dir = Path(path).parent
+        workflow = model.workflowJSON()
+        if not any(Path(str(p)) == files_dir for p in workflow.absoluteFilePaths()):
+            workflow.addFilePath(str(files_dir))
+    return files_dir
+
+def copy_schedule_csv(source, files_dir):
+    """ copy a schedule CSV into files_dir unless it is already there """
+    target = Path(files_dir) / Path(source).name
+    if target.exists():
+        return
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, target)
+    except OSError as e:
+        raise LibraryError(f"could not copy the schedule CSV {source} to {files_dir}: {e}") from e
+
+def copy_schedule_csvs(text, path, files_dir):
+    """ copy the schedule CSVs the ExternalFiles of rendered text name from next to the workbook into files_dir """
+    for fields in _osm_fields(text, "OS:External:File"):
+        copy_schedule_csv(Path(path).with_name(fields[2]), files_dir)
+
+def copy_external_files(model, files_dir):
+    """ copy the files model's ExternalFiles name into files_dir, where a workflow next to a saved model finds them """
+    workflow = model.workflowJSON()
+    for external_file in model.getExternalFiles():
+        source = workflow.findFile(external_file.fileName())
+        target = Path(files_dir) / external_file.fileName()
+        if not source.is_initialized() or target.exists():
+            continue
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(str(source.get()), target)
+        except OSError as e:
+            raise LibraryError(f"could not copy {source.get()} to {files_dir}: {e}") from e
+
+def make_schedule_files(osm, compiled_schedules:dict, upsert=None, year=None, path=RESOURCES_PATH):
+    """ one ScheduleFile per distinct column of schedule_csv, names with the same hourly values share it
+
+    The CSV is copied into the model's files directory, see schedule_files_dir, and the model
+    only records its name, so the model does not depend on where the workbook is.
+    """
+    year = year or model_year(osm)
+    csv_path, columns = schedule_csv(compiled_schedules, year, path)
+    files_dir = schedule_files_dir(osm, path)
+    copy_schedule_csv(csv_path, files_dir)
+    external_file = openstudio.model.ExternalFile.getExternalFile(osm, csv_path.name, False)
+    if not external_file.is_initialized():
+        raise LibraryError(f"could not find {csv_path.name} in the model's files directory {files_dir}")
+    hours = (366 if calendar.isleap(year) else 365) * 24
+    files = {}
+
+    def _make(item):
+        name, schedules = item
+        column = columns[name]
+        if column not in files:
+            def _apply(schedule_file, schedules:dict):
+                schedule_file.setName(name)
+                schedule_file.setColumnNumber(column)
+                schedule_file.setRowstoSkipatTop(1)
+                schedule_file.setNumberofHoursofData(hours)
+            new = lambda: openstudio.model.ScheduleFile(external_file.get(), column, 1)
+            files[column] = upsert_row("schedules", name, schedules, new, _apply, upsert)
+        return name, files[column]
+
+    return dict(map(_make, compiled_schedules.items()))
+
+def create_schedule_sets(osm, schedule_sets_dict:dict, schedules:dict, upsert=None):
+    """ schedules maps the ruleset names to the rulesets made by make_schedule_ruleset """
+    index = {"schedules": schedules}
+
+    def _apply(schedule_set, data:dict):
+        schedule_set.setName( data.get("name") )
+        owner = f"schedule set '{data.get('name')}'"
+        for column, setter in SCHEDULE_SET_COLUMNS.items():
+            if data.get(column):
+                s = resolve(index, "schedules", data.get(column), owner)
+                getattr(schedule_set, setter)( s )
+            else:
+                getattr(schedule_set, "re" + setter)()
 
-    osm.getSchedules()
+    def _make(data:dict):
+        new = lambda: openstudio.model.DefaultScheduleSet(osm)
+        depends = reference_handles(index, "schedule_sets")
+        return data.get("name"), upsert_row("schedule_sets", data.get("name"), data, new, _apply, upsert, depends)
+
+    return dict(map( _make, schedule_sets_dict))
+
+@functools.lru_cache(maxsize=None)
+def report_fields():
+    """ {IDD type: {field key: index}} of the objects load_report reads from the model text """
+    model = openstudio.model.Model()
+    lights, equipment = openstudio.model.LightsDefinition(model), openstudio.model.ElectricEquipmentDefinition(model)
+    people = openstudio.model.PeopleDefinition(model)
+    objects = [lights, equipment, people, openstudio.model.Lights(lights), openstudio.model.ElectricEquipment(equipment),
+               openstudio.model.People(people), model.getBuilding()]
+    for kind in ["Space", "SpaceType", "BuildingStory", "DefaultScheduleSet", "SpaceInfiltrationDesignFlowRate", "DesignSpecificationOutdoorAir"]:
+        objects.append(getattr(openstudio.model, kind)(model))
+    return {idd_type: fields for idd_type, _, fields, _ in map(_template, objects)}
+
+def schedule_eflh(model):
+    """ {schedule handle: annual equivalent full-load hours, the sum of its hourly values} of the rulesets, schedule files and constants """
+    import numpy as np
+    year = model_year(model)
+    hours = {str(s.handle()): float(schedule_8760(s, year).sum()) for s in model.getScheduleRulesets()}
+    year_hours = (366 if calendar.isleap(year) else 365) * 24
+    # timeSeries() does not expose its values to Python, the CSV columns are read instead, each file once
+    tables, workflow = {}, model.workflowJSON()
+    for schedule in model.getScheduleFiles():
+        found = workflow.findFile(schedule.externalFile().fileName())
+        path = str(found.get() if found.is_initialized() else schedule.externalFile().filePath())
+        key = (path, schedule.rowstoSkipatTop(), schedule.columnSeparator())
+        if key not in tables:
+            try:
+                delimiter = {"comma": ",", "tab": "\t", "semicolon": ";"}.get(key[2].lower())
+                tables[key] = np.loadtxt(path, delimiter=delimiter, skiprows=key[1], ndmin=2)
+            except (OSError, ValueError):
+                tables[key] = None
+        table = tables[key]
+        if table is not None and 0 < schedule.columnNumber() <= table.shape[1]:
+            # sub-hourly columns average to the same hours
+            hours[str(schedule.handle())] = float(table[:, schedule.columnNumber() - 1].mean()) * year_hours
+    for schedule in model.getScheduleConstants():
+        hours[str(schedule.handle())] = schedule.value() * year_hours
+    return hours
+
+def load_report(model, library=None, space_types=None):
+    """ {"spaces": rows, "space_types": rows} with the REPORT_COLUMNS of every space and space type, for QA
+
+    Spaces, loads, definitions, schedule sets and outdoor air are read as OSM text, one dump per
+    object instead of a getter per field, with floor areas the only other call made per space, and
+    the arrays they give are summed with NumPy the way
+    EnergyPlus sees them: a space gets its own loads plus its space type's, level and per person
+    loads over its floor area and people. A load without a schedule takes the default schedule set
+    of its owner, then the space type's, story's, building's and the building space type's. EFLH are
+    weighted by the load they schedule. Only AirChanges/Hour infiltration is counted.
+
+    Space type rows are area weighted over their spaces, or their own loads when no space uses
+    them. With library rows every library space type also gets expected_<column> from the workbook
+    and the columns that differ by more than REPORT_TOLERANCE in "mismatches". space_types
+    ({library name: SpaceType}) maps renamed library space types, by default they match by name.
+    """
+    import numpy as np
+    fields = report_fields()
+
+    def _table(idd_type):
+        # the whole model's toIdfFile grows faster than its size, the types read here are dumped on their own
+        text = "".join(map(str, model.getObjectsByType(openstudio.IddObjectType(idd_type))))
+        return {f[0]: f for f in _osm_fields(text, idd_type)}
+
+    def _get(row, idd_type, key):
+        i = fields[idd_type][key]
+        return row[i] if row is not None and i < len(row) else ""
+
+    def _number(row, idd_type, key):
+        value = _get(row, idd_type, key)
+        try:
+            return float(value)
+        except ValueError:
+            return 0.0 if value == "" else float("nan")
+
+    areas = {str(s.handle()): s.floorArea() for s in model.getSpaces()}
+    spaces, types = _table("OS:Space"), _table("OS:SpaceType")
+    sets, stories = _table("OS:DefaultScheduleSet"), _table("OS:BuildingStory")
+    building = next(iter(_table("OS:Building").values()), None)
+    type_handles = list(types)
+    type_index = {handle: j for j, handle in enumerate(type_handles)}
+    # spaces, then one stand-in space (nan area) for every space type no space uses
+    space_handles = list(spaces)
+    space_type = [type_index.get(_get(spaces[h], "OS:Space", "spacetypename"), len(types)) for h in space_handles]
+    unused = sorted(set(range(len(types))) - set(space_type))
+    space_type = np.array(space_type + unused, dtype=np.intp)
+    area = np.array([areas.get(h, 0.0) for h in space_handles] + [np.nan] * len(unused))
+    space_index = {handle: i for i, handle in enumerate(space_handles)}
+
+    def _default_schedule(owner, column):
+        if owner in space_index:
+            space = spaces[owner]
+            chain = [space, types.get(_get(space, "OS:Space", "spacetypename")), stories.get(_get(space, "OS:Space", "buildingstoryname"))]
+            kinds = ["OS:Space", "OS:SpaceType", "OS:BuildingStory"]
+        else:
+            chain, kinds = [types.get(owner)], ["OS:SpaceType"]
+        chain += [building, types.get(_get(building, "OS:Building", "spacetypename"))]
+        kinds += ["OS:Building", "OS:SpaceType"]
+        for row, kind in zip(chain, kinds):
+            schedule = _get(sets.get(_get(row, kind, "defaultschedulesetname")), "OS:DefaultScheduleSet", column)
+            if schedule:
+                return schedule
+        return ""
+
+    eflh = schedule_eflh(model)
+    # (load type, definition type, definition key, schedule field, schedule set field, {method: (channel, value field)}),
+    # people first since per person loads scale with them
+    kinds = {
+        "people": ("OS:People", "OS:People:Definition", "peopledefinitionname", "numberofpeopleschedulename", "numberofpeopleschedulename",
+                   {"People": ("level", "numberofpeople"), "People/Area": ("area", "peopleperspacefloorarea"),
+                    "Area/Person": ("area", "spacefloorareaperperson")}),
+        "lights": ("OS:Lights", "OS:Lights:Definition", "lightsdefinitionname", "schedulename", "lightingschedulename",
+                   {"LightingLevel": ("level", "lightinglevel"), "Watts/Area": ("area", "wattsperspacefloorarea"),
+                    "Watts/Person": ("person", "wattsperperson")}),
+        "equipment": ("OS:ElectricEquipment", "OS:ElectricEquipment:Definition", "electricequipmentdefinitionname", "schedulename",
+                      "electricequipmentschedulename",
+                      {"EquipmentLevel": ("level", "designlevel"), "Watts/Area": ("area", "wattsperspacefloorarea"),
+                       "Watts/Person": ("person", "wattsperperson")}),
+    }
 
-def create_schedule_sets(osm, schedule_sets_dict:dict):
+    def _spread(owners, values):
+        # per space sum of the values of loads owned by the space or by its space type
+        owners = np.asarray(owners, dtype=np.intp).reshape(-1, 2)
+        values = np.asarray(values, dtype=float)
+        own = owners[:, 0] == 0
+        by_space = np.bincount(owners[own, 1], weights=values[own], minlength=len(area))
+        by_type = np.bincount(owners[~own, 1], weights=values[~own], minlength=len(types) + 1)
+        return by_space + by_type[space_type]
+
+    def _owner(handle):
+        if handle in space_index:
+            return (0, space_index[handle])
+        return (1, type_index[handle]) if handle in type_index else None
+
+    density, hours = {}, {}
+    for name, (idd_type, definition_type, definition_key, schedule_key, set_key, methods) in kinds.items():
+        definitions = _table(definition_type)
+        owners, channels, schedule_hours = [], {"level": [], "area": [], "person": []}, []
+        for load in _table(idd_type).values():
+            owner = _owner(_get(load, idd_type, "spaceorspacetypename"))
+            definition = definitions.get(_get(load, idd_type, definition_key))
+            method = methods.get(_get(definition, definition_type, "designlevelcalculationmethod" if name != "people" else "numberofpeoplecalculationmethod"))
+            if owner is None or method is None:
+                continue
+            value = _number(definition, definition_type, method[1])
+            if method[1] == "spacefloorareaperperson":
+                value = 1 / value if value else 0.0
+            value *= _number(load, idd_type, "multiplier") or 1.0
+            owners.append(owner)
+            for channel in channels:
+                channels[channel].append(value if channel == method[0] else 0.0)
+            schedule = _get(load, idd_type, schedule_key) or _default_schedule(_get(load, idd_type, "spaceorspacetypename"), set_key)
+            schedule_hours.append(eflh.get(schedule, np.nan))
+        level = _spread(owners, channels["level"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            per_area = np.where(level != 0, level / area, 0.0)
+        parts = [_spread(owners, channels["area"]), per_area, _spread(owners, channels["person"]) * density.get("people", 0.0)]
+        density[name] = sum(parts)
+        # the hours of every load weighted by what it adds to the space, a load without a schedule leaves its spaces without hours
+        def _times(channel):
+            channel = np.asarray(channels[channel], dtype=float)
+            return np.where(channel != 0, channel * np.asarray(schedule_hours, dtype=float), 0.0)
+
+        weighted = _spread(owners, _times("area"))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weighted = weighted + np.where(level != 0, _spread(owners, _times("level")) / area, 0.0)
+            weighted = weighted + _spread(owners, _times("person")) * density.get("people", 0.0)
+            hours[name] = np.where(density[name] != 0, weighted / density[name], np.nan)
+
+    infiltration = [(_owner(_get(row, "OS:SpaceInfiltration:DesignFlowRate", "spaceorspacetypename")),
+                     _number(row, "OS:SpaceInfiltration:DesignFlowRate", "airchangesperhour"))
+                    for row in _table("OS:SpaceInfiltration:DesignFlowRate").values()
+                    if _get(row, "OS:SpaceInfiltration:DesignFlowRate", "designflowratecalculationmethod") == "AirChanges/Hour"]
+    infiltration = [(owner, value) for owner, value in infiltration if owner is not None]
+    outdoor_air = _table("OS:DesignSpecification:OutdoorAir")
+    oa_types = np.array([_number(outdoor_air.get(_get(types[h], "OS:SpaceType", "designspecificationoutdoorairobjectname")),
+                                 "OS:DesignSpecification:OutdoorAir", "outdoorairflowperperson") for h in type_handles] + [0.0])
+    oa_own = [outdoor_air.get(_get(spaces[h], "OS:Space", "designspecificationoutdoorairobjectname")) for h in space_handles] + [None] * len(unused)
+    columns = {
+        "lighting_w_m2": density["lights"],
+        "equipment_w_m2": density["equipment"],
+        "m2_per_person": np.divide(1.0, density["people"], out=np.full(len(area), np.nan), where=density["people"] != 0),
+        "infiltration_ach": _spread([o for o, _ in infiltration], [v for _, v in infiltration]),
+        "oa_l_s_person": np.array([_number(row, "OS:DesignSpecification:OutdoorAir", "outdoorairflowperperson") if row is not None
+                                   else oa_types[space_type[i]] for i, row in enumerate(oa_own)]),
+        "lighting_eflh": hours["lights"],
+        "equipment_eflh": hours["equipment"],
+        "occupancy_eflh": hours["people"],
+    }
 
-    def _make(data:dict):
-        schedule_set = openstudio.model.DefaultScheduleSet(osm)
-        schedule_set.setName( data.get("name") )
-        s = osm.getScheduleRulesetByName(data.get("hours_of_operation")).get()
-        schedule_set.setHoursofOperationSchedule( s )
-        s = osm.getScheduleRulesetByName(data.get("number_of_people")).get()
-        schedule_set.setNumberofPeopleSchedule( s )
-        s = osm.getScheduleRulesetByName(data.get("lighting")).get()
-        schedule_set.setLightingSchedule( s )
-        s = osm.getScheduleRulesetByName(data.get("electric_equipment")).get()
-        schedule_set.setElectricEquipmentSchedule( s )
-        s = osm.getScheduleRulesetByName(data.get("infiltration")).get()
-        schedule_set.setInfiltrationSchedule( s )
-
-    list(map( _make, schedule_sets_dict))
+    # space types: area weighted over their spaces, stand-ins and spaces without floor area count once
+    groups = len(types) + 1
+    type_area = np.bincount(space_type, weights=np.nan_to_num(area), minlength=groups)
+    weight = np.where((type_area[space_type] > 0) & (area > 0), area, 0.0)
+    weight = np.where(type_area[space_type] > 0, weight, 1.0)
+    people = weight * density["people"]
+    weights = {"m2_per_person": weight, "oa_l_s_person": people,
+               "lighting_eflh": weight * density["lights"], "equipment_eflh": weight * density["equipment"], "occupancy_eflh": people}
+
+    def _mean(values, w):
+        known = ~np.isnan(values)
+        total = np.bincount(space_type[known], weights=w[known], minlength=groups)
+        summed = np.bincount(space_type[known], weights=(w * values)[known], minlength=groups)
+        return np.divide(summed, total, out=np.full(groups, np.nan), where=total != 0)
+
+    by_type = {column: _mean(values, weights.get(column, weight)) for column, values in columns.items() if column != "m2_per_person"}
+    people_density = _mean(density["people"], weight)
+    by_type["m2_per_person"] = np.divide(1.0, people_density, out=np.full(groups, np.nan), where=people_density != 0)
+
+    def _value(x):
+        return None if x is None or x != x else round(float(x), 6)
+
+    def _name(handle, idd_type):
+        return _get(spaces.get(handle) or types.get(handle), idd_type, "name")
+
+    report = {"spaces": [], "space_types": []}
+    for i, handle in enumerate(space_handles):
+        report["spaces"].append({"name": _name(handle, "OS:Space"), "space_type": _name(type_handles[space_type[i]], "OS:SpaceType")
+                                 if space_type[i] < len(types) else "", "floor_area": _value(area[i]),
+                                 **{column: _value(values[i]) for column, values in columns.items()}})
+
+    library_names = {str(obj.handle()): name for name, obj in (space_types or {}).items()}
+    rows = {row.get("name"): row for row in (library or {}).get("space_types") or []}
+    lookups = {sheet: {row.get(KEYS[sheet]): row for row in (library or {}).get(sheet) or []} for sheet in ["lights", "equipment", "people", "infiltration", "outdoor_air", "schedule_sets"]}
+    compiled = compile_schedules((library or {}).get("schedules") or []) if library else {}
+    year = model_year(model)
+    for j, handle in enumerate(type_handles):
+        name = _name(handle, "OS:SpaceType")
+        row = {"name": name, "spaces": int(np.sum(space_type[:len(space_handles)] == j)), "floor_area": _value(type_area[j]),
+               **{column: _value(by_type[column][j]) for column in REPORT_COLUMNS}}
+        source = rows.get(library_names.get(handle, name)) if space_types is None or handle in library_names else None
+        if source is not None:
+            expected = {column: lookups[sheet].get(source.get(sheet), {}).get(value) for column, (sheet, value) in REPORT_SOURCES.items()}
+            schedule_set = lookups["schedule_sets"].get(source.get("schedule_set") or DEFAULT_SCHEDULE_SET, {})
+            for column, (set_column, load) in REPORT_SCHEDULES.items():
+                # no load, no hours to compare
+                schedule = compiled.get(schedule_set.get(set_column)) if row[load] else None
+                expected[column] = float(_expand_signature(compiled_signature(schedule, year)).sum()) if schedule else None
+            row.update({f"expected_{column}": _value(value) for column, value in expected.items()})
+            row["mismatches"] = [column for column, value in expected.items() if value is not None and
+                                 (row[column] is None or not np.isclose(row[column], value, rtol=REPORT_TOLERANCE, atol=1e-6))]
+        report["space_types"].append(row)
+    return report
+
+def write_load_report(report:dict, path):
+    """ load_report as JSON, or as one CSV table with a level column when path ends in .csv """
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        rows = [{"level": level[:-1], **row} for level in ["spaces", "space_types"] for row in report[level]]
+        columns = list(dict.fromkeys(["level", "name", "space_type", "spaces", "floor_area", *REPORT_COLUMNS,
+                                      *(column for row in rows for column in row)]))
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows({k: " ".join(v) if isinstance(v, list) else v for k, v in row.items()} for row in rows)
+    else:
+        path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+def register_load_report(runner, report:dict):
+    """ registerValue of every space type's report values, <space type>_<column>, and a warning per library mismatch """
+    for row in report["space_types"]:
+        slug = re.sub(r"\W+", "_", row["name"]).strip("_").lower()
+        for column in REPORT_COLUMNS:
+            if row[column] is not None:
+                runner.registerValue(f"{slug}_{column}", row[column])
+        if row.get("mismatches"):
+            runner.registerWarning(f"Space type '{row['name']}' differs from the workbook in {', '.join(row['mismatches'])}.")
+    runner.registerValue("load_report_spaces", len(report["spaces"]))
+    runner.registerValue("load_report_mismatches", sum(bool(row.get("mismatches")) for row in report["space_types"]))
 
 class AUSLibrary(openstudio.measure.ModelMeasure):
     """A ModelMeasure."""
 
+    def __init__(self, library:dict=None):
+        """ library: sheets already read by read_excel, built instead of the workbook argument's, e.g. by the benchmark or an edited library """
+        super().__init__()
+        self.library = library
+        # {sheet: {key: object}} the last run built or reused, read by sweep
+        self.index = None
+
     def name(self):
 
         return "AUS Library"
@@ -296,11 +2497,77 @@ class AUSLibrary(openstudio.measure.ModelMeasure):
         """
         args = openstudio.measure.OSArgumentVector()
 
-        # example_arg = openstudio.measure.OSArgument.makeStringArgument("Dummy", True)
-        # example_arg.setDisplayName("Dummy Arg")
-        # example_arg.setDescription("This .")
-        # example_arg.setDefaultValue("sd")
-        # args.append(example_arg)
+        space_types = openstudio.measure.OSArgument.makeStringArgument("space_types", False)
+        space_types.setDisplayName("Space Types")
+        space_types.setDescription("Library space types to build, comma separated. 'All' builds the whole library, 'Model' the space types used by the model's spaces. Only the schedules, schedule sets and loads they reference are created.")
+        space_types.setDefaultValue("All")
+        args.append(space_types)
+
+        workbook = openstudio.measure.OSArgument.makeStringArgument("workbook", False)
+        workbook.setDisplayName("Library Workbook")
+        workbook.setDescription("Optional path of the workbook to build the library from, e.g. a climate zone variant. Empty uses the resources.xlsx shipped with the measure.")
+        workbook.setDefaultValue("")
+        args.append(workbook)
+
+        upsert = openstudio.measure.OSArgument.makeBoolArgument("upsert", False)
+        upsert.setDisplayName("Update Existing Library Objects")
+        upsert.setDescription("Reuse the objects a previous upsert run created: unchanged rows are skipped and changed rows are updated in place instead of duplicated.")
+        upsert.setDefaultValue(False)
+        args.append(upsert)
+
+        remove_stale = openstudio.measure.OSArgument.makeBoolArgument("remove_stale", False)
+        remove_stale.setDisplayName("Remove Stale Library Objects")
+        remove_stale.setDescription("With upsert, remove library objects whose row is no longer in the workbook.")
+        remove_stale.setDefaultValue(False)
+        args.append(remove_stale)
+
+        incremental = openstudio.measure.OSArgument.makeBoolArgument("incremental", False)
+        incremental.setDisplayName("Only Apply Workbook Changes")
+        incremental.setDescription("With upsert, record the workbook's row hashes on the model's Building and on the next run rebuild only the rows that changed since, plus the schedule sets and space types that depend on them.")
+        incremental.setDefaultValue(False)
+        args.append(incremental)
+
+        prebuilt = openstudio.measure.OSArgument.makeBoolArgument("prebuilt", False)
+        prebuilt.setDisplayName("Merge Prebuilt Library")
+        prebuilt.setDescription("Render the library once as OSM text cached next to the workbook and add that to the model in one call.")
+        prebuilt.setDefaultValue(False)
+        args.append(prebuilt)
+
+        schedule_format = openstudio.measure.OSArgument.makeChoiceArgument("schedule_format", SCHEDULE_FORMATS, False)
+        schedule_format.setDisplayName("Schedule Format")
+        schedule_format.setDescription("Ruleset builds ScheduleRuleset objects. ScheduleFile writes the hourly values of the model's year to a CSV, identical schedules sharing a column, copies it into the model's files directory and references its columns with ScheduleFile objects.")
+        schedule_format.setDefaultValue("Ruleset")
+        args.append(schedule_format)
+
+        assign = openstudio.measure.OSArgument.makeBoolArgument("assign_space_types", False)
+        assign.setDisplayName("Assign Space Types to Spaces")
+        assign.setDescription("Match every space to a library space type by its name, then its story, then its current space type and standards tags, using the space type names and the optional space_type_aliases sheet, and assign the matches. Unmatched and ambiguous spaces are reported and left as they are.")
+        assign.setDefaultValue(False)
+        args.append(assign)
+
+        library_registry = openstudio.measure.OSArgument.makeChoiceArgument("library_registry", REGISTRY_MODES, False)
+        library_registry.setDisplayName("In-Process Library Registry")
+        library_registry.setDescription("Use keeps the parsed workbook, its compiled schedules and validation in memory for later runs in the same process, keyed by path and content. Bypass reads the workbook afresh without touching the registry, Clear empties the registry before reading.")
+        library_registry.setDefaultValue("Use")
+        args.append(library_registry)
+
+        stream_workbook = openstudio.measure.OSArgument.makeBoolArgument("stream_workbook", False)
+        stream_workbook.setDisplayName("Stream the Workbook")
+        stream_workbook.setDescription("Build the whole library while reading the workbook row by row, for workbooks too large to hold in memory. Each row is checked as it is read, references between rows are not, so a bad row stops the run part way. Bypasses the cache and the registry and cannot be combined with a space type selection, upsert, prebuilt or a load report.")
+        stream_workbook.setDefaultValue(False)
+        args.append(stream_workbook)
+
+        load_report = openstudio.measure.OSArgument.makeStringArgument("load_report", False)
+        load_report.setDisplayName("Load Report")
+        load_report.setDescription("Optional path of a .csv or .json file receiving the lighting and equipment W/m2, m2/person, infiltration ACH, OA per person and load schedule equivalent full-load hours of every space and space type, with the library space types checked against the workbook. The space type values are also registered as output values.")
+        load_report.setDefaultValue("")
+        args.append(load_report)
+
+        trace_file = openstudio.measure.OSArgument.makeStringArgument("trace_file", False)
+        trace_file.setDisplayName("Trace File")
+        trace_file.setDescription("Optional path of a JSON file receiving the wall time, objects created and by-name lookups of each phase.")
+        trace_file.setDefaultValue("")
+        args.append(trace_file)
 
         return args
 
@@ -316,35 +2583,589 @@ class AUSLibrary(openstudio.measure.ModelMeasure):
         if not (runner.validateUserArguments(self.arguments(model), user_arguments)):
             return False
 
-        data = read_excel()
-
-        # Make Schedules
-        nested_schedules = nest_schedules( data.get("schedules"))
-        [ make_schedule_ruleset(model, name, schedules) for name, schedules in nested_schedules.items()] 
-        
-        # Make Schedule Sets
-        create_schedule_sets(model, data.get("schedule_sets"))
-
-        # People
-        create_people_load(model, data.get("people"))
-
-        # Lights
-        create_lights_load(model, data.get("lights"))
-
-        # electric equipment defs   (BCA and that mech std)
-        create_electric_equipment_load(model, data.get("equipment"))
-
-        # infiltration defs (mostly BCA)
-        create_infiltration_objects(model, data.get("infiltration"))
+        trace = Trace(model)
+        selection = runner.getStringArgumentValue("space_types", user_arguments).strip()
+        workbook = runner.getStringArgumentValue("workbook", user_arguments).strip() or RESOURCES_PATH
+        registry = runner.getStringArgumentValue("library_registry", user_arguments)
+        if registry == "Clear":
+            clear_registry()
+        entry = None
+        stream = self.library is None and runner.getBoolArgumentValue("stream_workbook", user_arguments)
+        if stream:
+            refused = [name for name in ("upsert", "prebuilt") if runner.getBoolArgumentValue(name, user_arguments)]
+            if selection.lower() != "all":
+                refused.insert(0, "a space type selection")
+            if runner.getStringArgumentValue("load_report", user_arguments).strip():
+                refused.append("load_report")
+            if refused:
+                runner.registerError(f"The streamed workbook is read once while building and cannot be combined with {', '.join(refused)}.")
+                return False
+        if selection.lower() == "all":
+            names = None
+        elif selection.lower() == "model":
+            names = model_space_type_names(model)
+        else:
+            names = {n.strip() for n in selection.split(",") if n.strip()}
+        with trace.phase("read"):
+            if self.library is not None:
+                data = self.library if names is None else library_closure(lambda sheets: {k: self.library[k] for k in sheets}, names)
+            elif stream:
+                try:
+                    data = read_excel(workbook, loader="stream")
+                except (OSError, ValueError, zipfile.BadZipFile) as e:
+                    runner.registerError(f"Could not read the workbook {workbook}: {e}")
+                    return False
+            else:
+                try:
+                    entry = load_library(workbook, use_registry=registry != "Bypass")
+                    # only the sheets the selection's closure reaches are parsed
+                    data = read_library(names, entry=entry)
+                except (OSError, ValueError, zipfile.BadZipFile) as e:
+                    runner.registerError(f"Could not read the workbook {workbook}: {e}")
+                    return False
+        if selection.lower() != "all":
+            found = {r.get("name") for r in data.get("space_types")}
+            if selection.lower() != "model" and names - found:
+                runner.registerError(f"Space types not in the library: {', '.join(sorted(names - found))}")
+                return False
+            if not found:
+                runner.registerAsNotApplicable("None of the model's space types are in the library.")
+                return True
+
+        with trace.phase("validate"):
+            checks = entry["checks"] if entry is not None else {}
+            selected = "All" if selection.lower() == "all" else tuple(sorted(names))
+            # a streamed workbook is checked row by row as build_library reads it, see xlsx_stream
+            if not stream and selected not in checks:
+                checks[selected] = validate_library(data)
+            errors, warnings = checks[selected] if not stream else ([], [])
+        for warning in warnings:
+            runner.registerWarning(warning)
+        if errors:
+            for error in errors:
+                runner.registerError(error)
+            return False
 
-        # OA defs   (AS 1668.2)
-        create_outdoor_air_objects(model, data.get("outdoor_air"))
+        upsert = None
+        if runner.getBoolArgumentValue("upsert", user_arguments):
+            with trace.phase("upsert_index"):
+                upsert = Upsert(model)
+
+        incremental = runner.getBoolArgumentValue("incremental", user_arguments)
+        if incremental and upsert is None:
+            runner.registerWarning("incremental only applies together with upsert, the whole library is built.")
+            incremental = False
+        remove_stale = runner.getBoolArgumentValue("remove_stale", user_arguments)
+        if remove_stale and upsert is None:
+            runner.registerWarning("remove_stale only applies together with upsert, no objects are removed.")
+            remove_stale = False
+        prebuilt = runner.getBoolArgumentValue("prebuilt", user_arguments)
+        if prebuilt and upsert is not None:
+            runner.registerError("The prebuilt library cannot be combined with upsert, upsert has to match objects one by one.")
+            return False
 
-        # Make Space Types
-        create_space_types(model, data.get("space_types"))
+        schedule_format = runner.getStringArgumentValue("schedule_format", user_arguments)
+        if schedule_format == "ScheduleFile" and upsert is not None:
+            runner.registerError("ScheduleFile schedules cannot be combined with upsert, upsert only updates schedule rulesets.")
+            return False
+        options = {"schedule_format": schedule_format}
+        if schedule_format == "ScheduleFile":
+            options["year"] = model_year(model)
+
+        try:
+            if prebuilt:
+                with trace.phase("prebuilt"):
+                    text = prebuilt_library(data, workbook, **options)
+                with trace.phase("merge"):
+                    added = merge_library(model, text)
+                    copy_schedule_csvs(text, workbook, schedule_files_dir(model, workbook))
+                runner.registerInfo(f"Merged {len(added)} objects from the prebuilt library.")
+                # the space types come back in the order of their rows, maybe renamed "Office 1"
+                added = [model.getSpaceType(o.handle()) for o in added if o.iddObject().name() == "OS:SpaceType"]
+                index = {"space_types": {r.get("name"): t.get() for r, t in zip(data.get("space_types"), added)}}
+            elif incremental:
+                with trace.phase("diff"):
+                    digest, hashes = fingerprint(data), row_hashes(data)
+                    delta, base = library_delta(model, data, hashes, digest)
+                runner.registerInfo(f"Rebuilding {sum(map(len, delta.values()))} of {sum(map(len, data.values()))} workbook rows changed since the last incremental run.")
+                index = build_library(model, delta, upsert, trace, base=base, path=workbook, **options)
+                store_library_state(model, digest, hashes, index)
+            else:
+                compiled = registry_schedules(entry, data.get("schedules") or []) if entry is not None else None
+                index = build_library(model, data, upsert, trace, compiled_schedules=compiled, path=workbook, **options)
+        except LibraryError as e:
+            runner.registerError(str(e))
+            return False
+        self.index = index
+
+        if runner.getBoolArgumentValue("assign_space_types", user_arguments):
+            with trace.phase("assign_space_types"):
+                if self.library is not None:
+                    aliases = self.library.get(ALIAS_SHEET) or []
+                elif entry is None:
+                    # the streamed workbook bypasses the registry and the cache
+                    aliases = read_excel(workbook, use_cache=False, sheets=[ALIAS_SHEET])[ALIAS_SHEET]
+                else:
+                    if entry["aliases"] is None:
+                        entry["aliases"] = read_excel(workbook, sheets=[ALIAS_SHEET])[ALIAS_SHEET]
+                    aliases = entry["aliases"]
+                assigned, unmatched, ambiguous = assign_space_types(model, index["space_types"], aliases)
+            runner.registerInfo(f"Assigned library space types to {assigned} of {len(model.getSpaces())} spaces.")
+            if unmatched:
+                runner.registerWarning(f"{len(unmatched)} spaces match no library space type: {', '.join(sorted(unmatched))}")
+            for space, names in sorted(ambiguous.items()):
+                runner.registerWarning(f"Space '{space}' matches more than one library space type, left unassigned: {', '.join(names)}")
+
+        if remove_stale:
+            with trace.phase("remove_stale"):
+                if self.library is not None:
+                    sheets = {k: self.library.get(k) or [] for k in upsert.objects}
+                else:
+                    sheets = library_sheets(entry, list(upsert.objects))
+                upsert.remove_stale(sheets)
+
+        report_path = runner.getStringArgumentValue("load_report", user_arguments).strip()
+        if report_path:
+            with trace.phase("load_report"):
+                report = load_report(model, data, index["space_types"])
+            register_load_report(runner, report)
+            try:
+                write_load_report(report, report_path)
+            except OSError as e:
+                runner.registerWarning(f"Could not write the load report {report_path}: {e}")
+
+        trace.report(runner)
+        trace_file = runner.getStringArgumentValue("trace_file", user_arguments).strip()
+        if trace_file and not trace.write(trace_file, space_types=selection, prebuilt=prebuilt, upsert=upsert is not None,
+                                             incremental=incremental):
+            runner.registerWarning(f"Could not write the trace file {trace_file}.")
+
+        if upsert is not None:
+            counts = upsert.counts
+            runner.registerInfo(f"Library objects created: {counts['created']}, updated: {counts['updated']}, unchanged: {counts['unchanged']}, removed: {counts['removed']}.")
 
         return True
 
 
 # register the measure to be used by the application
 AUSLibrary().registerWithApplication()
+
+
+def _init_worker(workbook=RESOURCES_PATH):
+    """ register the workbook in the worker once, the runs that follow find its parsed sheets there """
+    with contextlib.suppress(OSError, ValueError, zipfile.BadZipFile):
+        load_library(workbook)  # a bad workbook is reported by each run instead
+
+def run_measure(model, options:dict):
+    """ AUSLibrary.run on model with options as its arguments, returns the measure or raises LibraryError with the run's errors """
+    measure = AUSLibrary()
+    runner = openstudio.measure.OSRunner(openstudio.WorkflowJSON())
+    arguments = measure.arguments(model)
+    argument_map = openstudio.measure.convertOSArgumentVectorToMap(arguments)
+    for arg in arguments:
+        if arg.name() in options:
+            value = arg.clone()
+            value.setValue(options[arg.name()])
+            argument_map[arg.name()] = value
+
+    if not measure.run(model, runner, argument_map):
+        raise LibraryError("; ".join(e.logMessage() for e in runner.result().errors()) or "measure returned False")
+    return measure
+
+def patch_file(seed, output, options:dict):
+    """ patch_osm with the measure options apply_to_file takes, the ones that need a loaded model raise LibraryError """
+    selection = str(options.get("space_types") or "All").strip()
+    refused = [name for name in ("upsert", "remove_stale", "incremental", "prebuilt", "assign_space_types", "stream_workbook") if options.get(name)]
+    if selection.lower() == "model":
+        refused.insert(0, "space_types=Model")
+    if refused:
+        raise LibraryError(f"The text patch works without a model and cannot be combined with {', '.join(refused)}.")
+    workbook = options.get("workbook") or RESOURCES_PATH
+    names = None if selection.lower() == "all" else {n.strip() for n in selection.split(",") if n.strip()}
+    try:
+        entry = load_library(workbook)
+        data = read_library(names, entry=entry)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        raise LibraryError(f"Could not read the workbook {workbook}: {e}") from None
+    selected = "All"
+    if names is not None:
+        selected = tuple(sorted(names))
+        missing = names - {r.get("name") for r in data.get("space_types")}
+        if missing:
+            raise LibraryError(f"Space types not in the library: {', '.join(sorted(missing))}")
+    if selected not in entry["checks"]:
+        entry["checks"][selected] = validate_library(data)
+    errors, _ = entry["checks"][selected]
+    if errors:
+        raise LibraryError("; ".join(errors))
+    return patch_osm(seed, output, data, options.get("schedule_format") or "Ruleset", entry["path"])
+
+def apply_to_file(seed, output, options:dict):
+    """ load seed with the VersionTranslator, run the measure with options as its arguments and save to output
+
+    With options["text_patch"] the library is appended to the seed's text by patch_file instead, no model is loaded.
+    Never raises, the outcome is returned as {"seed", "output", "ok", "seconds", "message"}.
+    """
+    start = time.perf_counter()
+    outcome = {"seed": str(seed), "output": str(output), "ok": False, "message": ""}
+    try:
+        if options.get("text_patch"):
+            patch_file(seed, output, options)
+        else:
+            model = openstudio.osversion.VersionTranslator().loadModel(str(seed))
+            if not model.is_initialized():
+                raise LibraryError(f"{seed} is not a model the VersionTranslator can load")
+            model = model.get()
+            # a workflow beside the output, its files directory is where the schedule CSVs go
+            model.workflowJSON().setOswPath(str(Path(output).with_suffix(".osw")))
+            run_measure(model, options)
+            model.save(str(output), True)
+            copy_external_files(model, Path(output).parent / "files")
+        outcome["ok"] = True
+    except Exception as e:
+        outcome["message"] = f"{type(e).__name__}: {e}" if not isinstance(e, LibraryError) else str(e)
+    outcome["seconds"] = time.perf_counter() - start
+    return outcome
+
+def apply_to_files(seeds, output_dir, options:dict, workers=1):
+    """ apply_to_file over seeds, spread over worker processes that each read the workbook once, yields outcomes as they finish
+
+    Every seed is saved under its path below the folder all seeds share, so a/in.osm and b/in.osm
+    become output_dir/a/in.osm and output_dir/b/in.osm. A seed listed twice fails instead of
+    writing the same output twice.
+    """
+    workbook = options.get("workbook") or RESOURCES_PATH
+    output_dir = Path(output_dir)
+    seeds = [Path(seed) for seed in seeds]
+    resolved = [seed.resolve() for seed in seeds]
+    root = Path(os.path.commonpath([seed.parent for seed in resolved])) if seeds else output_dir
+    jobs, targets = [], set()
+    for seed, path in zip(seeds, resolved):
+        output = output_dir / path.relative_to(root)
+        if output in targets:
+            yield {"seed": str(seed), "output": str(output), "ok": False, "seconds": 0.0,
+                   "message": f"{output} is already the output of another seed"}
+            continue
+        targets.add(output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        jobs.append((seed, output, options))
+    if workers <= 1:
+        _init_worker(workbook)
+        for job in jobs:
+            yield apply_to_file(*job)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(workbook,)) as pool:
+        futures = [pool.submit(apply_to_file, *job) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def variant_targets(space_types):
+    """ {sheet: [(object, setter, value)]} of the VARIANT_FIELDS values the space types' definitions hold, each object once """
+    targets, seen = {sheet: [] for sheet in VARIANT_FIELDS}, set()
+    for space_type in space_types:
+        for sheet, (loads, definition, getter, setter) in VARIANT_FIELDS.items():
+            if loads is None:
+                objects = [o.get() for o in [getattr(space_type, definition)()] if o.is_initialized()]
+            else:
+                objects = [getattr(load, definition)() for load in getattr(space_type, loads)()]
+            for obj in objects:
+                value = getattr(obj, getter)()
+                if hasattr(value, "is_initialized"):
+                    if not value.is_initialized():
+                        continue
+                    value = value.get()
+                if str(obj.handle()) not in seen:
+                    seen.add(str(obj.handle()))
+                    targets[sheet].append((obj, setter, value))
+    return targets
+
+def apply_variant(targets:dict, scales:dict):
+    """ set every target to its built value times the variant's {sheet: factor}, 1 for sheets it leaves out """
+    for sheet, items in targets.items():
+        factor = scales.get(sheet, 1.0)
+        for obj, setter, value in items:
+            getattr(obj, setter)(value * factor)
+
+# sweep workers keep the base model and its variant targets here between variants
+_SWEEP = {}
+
+def _init_sweep(base, space_types:list):
+    model = openstudio.model.Model.load(str(base)).get()
+    found = [model.getSpaceType(openstudio.toUUID(h)) for h in space_types]
+    _SWEEP["model"], _SWEEP["targets"] = model, variant_targets(t.get() for t in found if t.is_initialized())
+
+def save_variant(name, scales:dict, output):
+    """ apply_variant to the worker's base model and save it to output, never raises, see apply_to_file """
+    start = time.perf_counter()
+    outcome = {"variant": name, "output": str(output), "ok": False, "message": ""}
+    try:
+        apply_variant(_SWEEP["targets"], scales)
+        if not _SWEEP["model"].save(str(output), True):
+            raise LibraryError(f"could not save {output}")
+        outcome["ok"] = True
+    except Exception as e:
+        outcome["message"] = f"{type(e).__name__}: {e}" if not isinstance(e, LibraryError) else str(e)
+    outcome["seconds"] = time.perf_counter() - start
+    return outcome
+
+def variant_path(output_dir, name):
+    """ output_dir/<name>.osm, raises LibraryError when name is not a plain file name that stays in output_dir """
+    if name in ("", ".", "..") or Path(name).name != name or "\\" in name:
+        raise LibraryError(f"The variant name {name!r} has to be a plain file name.")
+    return Path(output_dir) / f"{name}.osm"
+
+def sweep(seed, output_dir, variants:dict, options:dict, workers=1):
+    """ apply the library to seed once, then save a copy per variant {name: {sheet: factor}} as output_dir/<name>.osm
+
+    Only the VARIANT_FIELDS values of the definitions the library space types use change between
+    variants, so N variants cost one run plus N patch-and-save steps. With several workers each
+    loads the built base once and patches its own copy. Yields outcomes as they finish.
+    """
+    output_dir = Path(output_dir)
+    jobs = [(name, scales, variant_path(output_dir, name)) for name, scales in variants.items()]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = openstudio.osversion.VersionTranslator().loadModel(str(seed))
+    if not model.is_initialized():
+        raise LibraryError(f"{seed} is not a model the VersionTranslator can load")
+    model = model.get()
+    model.workflowJSON().setOswPath(str(output_dir / f"{Path(seed).stem}.osw"))
+    space_types = list(run_measure(model, options).index["space_types"].values())
+    copy_external_files(model, output_dir / "files")
+    if workers <= 1:
+        _SWEEP["model"], _SWEEP["targets"] = model, variant_targets(space_types)
+        for job in jobs:
+            yield save_variant(*job)
+        return
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp:
+        base = Path(tmp) / "base.osm"
+        model.save(str(base), True)
+        handles = [str(t.handle()) for t in space_types]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep, initargs=(base, handles)) as pool:
+            futures = [pool.submit(save_variant, *job) for job in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+def parse_variant(text):
+    """ "lpd80:lights=0.8,equipment=1.2" -> ("lpd80", {"lights": 0.8, "equipment": 1.2}) """
+    name, _, spec = text.partition(":")
+    scales = {}
+    for item in filter(None, spec.split(",")):
+        sheet, _, factor = item.partition("=")
+        if sheet.strip() not in VARIANT_FIELDS:
+            raise argparse.ArgumentTypeError(f"{sheet.strip()!r} is not one of {', '.join(VARIANT_FIELDS)}")
+        try:
+            scales[sheet.strip()] = float(factor)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{factor!r} is not a number") from None
+    if not name.strip() or not scales:
+        raise argparse.ArgumentTypeError(f"{text!r} is not NAME:sheet=factor[,sheet=factor...]")
+    return name.strip(), scales
+
+def export_paths(output_dir=None):
+    """ (manifest, library file for a version) of the export in output_dir, the workbook's resources folder by default """
+    output_dir = Path(output_dir or RESOURCES_PATH.parent)
+    return output_dir / f"{EXPORT_NAME}.json", lambda version: output_dir / f"{EXPORT_NAME}.{version}.osm"
+
+def stale_export(output_dir=None, workbook=RESOURCES_PATH):
+    """ why the export in output_dir does not match workbook and this OpenStudio, None when it is fresh
+
+    Only the workbook is hashed, consumers can run this without building anything.
+    """
+    manifest_path, _ = export_paths(output_dir)
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return f"no export manifest at {manifest_path}"
+    if manifest.get("cache_version") != CACHE_VERSION or manifest.get("openstudio") != openstudio.openStudioVersion():
+        return f"exported with OpenStudio {manifest.get('openstudio')} and cache version {manifest.get('cache_version')}"
+    if manifest.get("workbook_hash") != workbook_hash(workbook):
+        return f"{workbook} changed since the export"
+    missing = [f for f in [manifest.get("file")] + manifest.get("components", []) if not f or not (manifest_path.parent / f).exists()]
+    if missing:
+        return f"exported files missing: {', '.join(map(str, missing))}"
+    return None
+
+def export_library(output_dir=None, workbook=RESOURCES_PATH, components=False, force=False):
+    """ build the whole library into an empty model and save it as a versioned .osm, returns the manifest
+
+    The manifest ({EXPORT_NAME}.json) records the workbook hash, OpenStudio and cache versions and
+    the object counts, see stale_export. A fresh export is returned as it is unless force is set.
+    components also saves every space type with its loads and schedules as an .osc the
+    OpenStudio Application can drag in. Schedules are rulesets so the files stand on their own.
+    """
+    manifest_path, library_path = export_paths(output_dir)
+    if not force and stale_export(output_dir, workbook) is None:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        if manifest.get("components") or not components:
+            return manifest
+    entry = load_library(workbook)
+    sheets = read_library(entry=entry)
+    if "All" not in entry["checks"]:
+        entry["checks"]["All"] = validate_library(sheets)
+    errors, _ = entry["checks"]["All"]
+    if errors:
+        raise LibraryError("; ".join(errors))
+
+    digest = workbook_hash(workbook)
+    version = fingerprint([digest], [CACHE_VERSION, openstudio.openStudioVersion()])[:16]
+    model = openstudio.model.Model()
+    index = build_library(model, sheets, compiled_schedules=registry_schedules(entry, sheets["schedules"]))
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    model.save(str(library_path(version)), True)
+    manifest = {
+        "file": library_path(version).name,
+        "version": version,
+        "workbook": Path(workbook).name,
+        "workbook_hash": digest,
+        "openstudio": openstudio.openStudioVersion(),
+        "cache_version": CACHE_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "rows": {sheet: len(rows) for sheet, rows in sheets.items()},
+        "objects": dict(sorted(collections.Counter(o.iddObject().name() for o in model.objects()).items())),
+    }
+    if components:
+        folder = library_path(version).with_suffix("")
+        folder.mkdir(exist_ok=True)
+        manifest["components"] = []
+        for name, space_type in index["space_types"].items():
+            path = folder / (re.sub(r"[^\w.-]+", "_", name) + ".osc")
+            # Component.save does not take a path from Python, the IdfFile text is the same file
+            path.write_text(str(space_type.createComponent().toIdfFile()), encoding="utf-8")
+            manifest["components"].append(f"{folder.name}/{path.name}")
+
+    try:
+        previous = json.loads(manifest_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        previous = {}
+    fd, tmp = tempfile.mkstemp(dir=manifest_path.parent, prefix=manifest_path.name, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_path)
+    # files of the previous export the manifest no longer points at
+    current = {manifest["file"], *manifest.get("components", [])}
+    for name in {previous.get("file"), *previous.get("components", [])} - current - {None}:
+        with contextlib.suppress(OSError):
+            (manifest_path.parent / name).unlink()
+    if previous.get("version"):
+        with contextlib.suppress(OSError):
+            library_path(previous["version"]).with_suffix("").rmdir()
+    return manifest
+
+def _add_measure_options(parser):
+    parser.add_argument("--space-types", default="All", help="the measure's space_types argument (default: All)")
+    parser.add_argument("--workbook", default="", help="library workbook to build from (default: the measure's resources.xlsx)")
+    parser.add_argument("--upsert", action="store_true", help="update library objects from a previous upsert run")
+    parser.add_argument("--remove-stale", action="store_true", help="with --upsert, remove objects whose row left the workbook")
+    parser.add_argument("--incremental", action="store_true", help="with --upsert, rebuild only the rows changed since the model's last incremental run")
+    parser.add_argument("--prebuilt", action="store_true", help="merge the cached prebuilt library instead of building it per model")
+    parser.add_argument("--schedule-format", choices=SCHEDULE_FORMATS, default="Ruleset", help="schedules as rulesets or as ScheduleFile columns of a shared CSV")
+    parser.add_argument("--assign-space-types", action="store_true", help="assign the matching library space type to every space")
+    parser.add_argument("--stream-workbook", action="store_true", help="build the whole library while reading the workbook row by row")
+
+def _measure_options(args):
+    return {"space_types": args.space_types, "workbook": args.workbook, "upsert": args.upsert, "remove_stale": args.remove_stale,
+            "incremental": args.incremental, "prebuilt": args.prebuilt, "schedule_format": args.schedule_format,
+            "assign_space_types": args.assign_space_types, "stream_workbook": args.stream_workbook}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m aus_library.measure", description="AUS library command line tools.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    apply = commands.add_parser("apply", help="apply the library to a batch of .osm files")
+    apply.add_argument("seeds", nargs="+", help="seed .osm files or glob patterns, e.g. 'seeds/*.osm'")
+    apply.add_argument("-o", "--output-dir", required=True, help="where the updated models are saved, under their path below the folder the seeds share")
+    apply.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: one per CPU)")
+    _add_measure_options(apply)
+    apply.add_argument("--text-patch", action="store_true",
+                       help="append the rendered library to the seed text without loading it, for seeds saved by this OpenStudio version")
+
+    sweep_parser = commands.add_parser("sweep", help="apply the library to one model and save variants with scaled load densities")
+    sweep_parser.add_argument("seed", help="seed .osm file")
+    sweep_parser.add_argument("-o", "--output-dir", required=True, help="where the variants are saved, as <name>.osm")
+    sweep_parser.add_argument("-v", "--variant", type=parse_variant, action="append", required=True,
+                              help=f"NAME:sheet=factor[,sheet=factor...] with sheets {', '.join(VARIANT_FIELDS)}, e.g. lpd80:lights=0.8, repeatable")
+    sweep_parser.add_argument("-j", "--workers", type=int, default=1, help="worker processes saving variants (default: 1)")
+    _add_measure_options(sweep_parser)
+
+    report = commands.add_parser("report", help="write the load densities and schedule hours of a model's spaces and space types")
+    report.add_argument("model", help=".osm file, loaded with the VersionTranslator")
+    report.add_argument("-o", "--output", required=True, help="report file, .csv or .json")
+    report.add_argument("--workbook", default=str(RESOURCES_PATH), help="library the space types are checked against (default: the measure's resources.xlsx)")
+
+    export = commands.add_parser("export", help="save the whole library as a versioned .osm plus a manifest for other tools")
+    export.add_argument("-o", "--output-dir", default=str(RESOURCES_PATH.parent), help="where the export goes (default: the measure's resources)")
+    export.add_argument("--workbook", default=str(RESOURCES_PATH), help="library workbook to export (default: the measure's resources.xlsx)")
+    export.add_argument("--components", action="store_true", help="also save every space type as an .osc component")
+    export.add_argument("--force", action="store_true", help="rebuild even when the export matches the workbook")
+    export.add_argument("--check", action="store_true", help="only report whether the export is fresh, exit 1 when stale")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        model = openstudio.osversion.VersionTranslator().loadModel(args.model)
+        if not model.is_initialized():
+            print(f"FAIL  {args.model} is not a model the VersionTranslator can load")
+            return 1
+        model = model.get()
+        try:
+            result = load_report(model, read_library(entry=load_library(args.workbook)))
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            print(f"FAIL  {args.workbook}: {e}")
+            return 1
+        write_load_report(result, args.output)
+        mismatched = [row for row in result["space_types"] if row.get("mismatches")]
+        for row in mismatched:
+            print(f"differs  {row['name']}: {', '.join(row['mismatches'])}")
+        print(f"ok    {args.output}  ({len(result['spaces'])} spaces, {len(result['space_types'])} space types, {len(mismatched)} differ from the workbook)")
+        return 1 if mismatched else 0
+
+    if args.command == "export":
+        stale = stale_export(args.output_dir, args.workbook)
+        if args.check:
+            print(f"stale: {stale}" if stale else "fresh")
+            return 1 if stale else 0
+        try:
+            manifest = export_library(args.output_dir, args.workbook, args.components, args.force)
+        except (LibraryError, OSError, ValueError, zipfile.BadZipFile) as e:
+            print(f"FAIL  {args.workbook}: {e}")
+            return 1
+        print(f"ok    {Path(args.output_dir) / manifest['file']}  "
+              f"({sum(manifest['objects'].values())} objects, {len(manifest.get('components', []))} components)")
+        return 0
+
+    if args.command == "apply":
+        seeds = sorted({str(p) for pattern in args.seeds for p in (glob.glob(pattern) or [pattern])})
+        start = time.perf_counter()
+        failed = 0
+        for outcome in apply_to_files(seeds, args.output_dir, dict(_measure_options(args), text_patch=args.text_patch), args.workers):
+            if outcome["ok"]:
+                print(f"ok    {outcome['seconds']:7.2f}s  {outcome['seed']} -> {outcome['output']}")
+            else:
+                failed += 1
+                print(f"FAIL  {outcome['seconds']:7.2f}s  {outcome['seed']}: {outcome['message']}")
+        print(f"{len(seeds) - failed} of {len(seeds)} models done in {time.perf_counter() - start:.2f}s")
+        return 1 if failed else 0
+
+    if args.command == "sweep":
+        names = collections.Counter(name for name, _ in args.variant)
+        repeated = sorted(name for name, count in names.items() if count > 1)
+        if repeated:
+            sweep_parser.error(f"variant names have to be unique, repeated: {', '.join(repeated)}")
+        start = time.perf_counter()
+        done = failed = 0
+        try:
+            for outcome in sweep(args.seed, args.output_dir, dict(args.variant), _measure_options(args), args.workers):
+                if outcome["ok"]:
+                    done += 1
+                    print(f"ok    {outcome['seconds']:7.2f}s  {outcome['variant']} -> {outcome['output']}")
+                else:
+                    failed += 1
+                    print(f"FAIL  {outcome['seconds']:7.2f}s  {outcome['variant']}: {outcome['message']}")
+        except LibraryError as e:
+            print(f"FAIL  {args.seed}: {e}")
+            return 1
+        print(f"{done} of {done + failed} variants done in {time.perf_counter() - start:.2f}s")
+        return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""Benchmarks for AUSLibrary.run on the real workbook and synthetic scaled copies.
+
+Not collected by pytest. Run from the repository root:
+
+    python aus_library/tests/benchmark_aus_library.py --output bench.json
+    python aus_library/tests/benchmark_aus_library.py --output new.json --compare bench.json
+
+Every workbook (the real one and copies scaled to 10x and 100x its rows) is timed on an
+empty seed and on a large seed model. The results are the best of --repeat runs, keyed by
+(workbook, seed, phase), so two result files can be compared phase by phase.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import openstudio
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from aus_library.measure import (  # noqa: E402
+    KEYS,
+    REFERENCES,
+    RESOURCES_PATH,
+    SHEETS,
+    AUSLibrary,
+    compile_schedules,
+    read_excel,
+    schedule_name,
+    xlsx_to_json,
+)
+
+
+def scale_library(data: dict, factor: int):
+    """data with every row repeated factor times, copy k renames its keys and references with " x{k}" """
+    scaled = {sheet: list(rows) for sheet, rows in data.items()}
+    for k in range(2, factor + 1):
+        suffix = f" x{k}"
+        renamed = {}
+        for sheet, rows in data.items():
+            copies = []
+            for row in rows:
+                row = dict(row)
+                if sheet == "schedules":
+                    old = schedule_name(row)
+                    row["space_type"] = f"{row['space_type']}{suffix}"
+                    renamed.setdefault(sheet, {})[old] = schedule_name(row)
+                elif KEYS.get(sheet) and row.get(KEYS[sheet]):
+                    old = row[KEYS[sheet]]
+                    row[KEYS[sheet]] = f"{old}{suffix}"
+                    renamed.setdefault(sheet, {})[old] = row[KEYS[sheet]]
+                copies.append(row)
+            scaled[sheet].extend(copies)
+        for sheet, references in REFERENCES.items():
+            for row in scaled[sheet][-len(data[sheet]):] if data[sheet] else []:
+                for column, target in references.items():
+                    if row.get(column) in renamed.get(target, {}):
+                        row[column] = renamed[target][row[column]]
+    return scaled
+
+
+def _column(index):
+    name = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        name = chr(65 + rest) + name
+    return name
+
+
+def _sheet_xml(rows: list):
+    columns = list(dict.fromkeys(c for row in rows for c in row))
+    lines = []
+    for number, values in enumerate([dict(zip(columns, columns))] + rows, start=1):
+        cells = []
+        for i, column in enumerate(columns):
+            value = values.get(column)
+            ref = f"{_column(i)}{number}"
+            if value is None:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cells.append(f'<c r="{ref}"><v>{value!r}</v></c>')
+            else:
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+        lines.append(f'<row r="{number}">{"".join(cells)}</row>')
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            f'<sheetData>{"".join(lines)}</sheetData></worksheet>')
+
+
+def write_workbook(path, data: dict):
+    """minimal xlsx holding data, one sheet per key, cells as numbers or inline strings"""
+    names = list(data)
+    main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    rel = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as book:
+        book.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                      for i in range(1, len(names) + 1))
+            + '</Types>'))
+        book.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{rel}/officeDocument" Target="xl/workbook.xml"/></Relationships>'))
+        book.writestr("xl/workbook.xml", (
+            f'<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="{main}" xmlns:r="{rel}"><sheets>'
+            + "".join(f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>' for i, name in enumerate(names, start=1))
+            + '</sheets></workbook>'))
+        book.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(f'<Relationship Id="rId{i}" Type="{rel}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                      for i in range(1, len(names) + 1))
+            + '</Relationships>'))
+        for i, name in enumerate(names, start=1):
+            book.writestr(f"xl/worksheets/sheet{i}.xml", _sheet_xml(data[name]))
+
+
+def large_seed(spaces: int):
+    """model with `spaces` spaces, each in its own thermal zone and with its own space type"""
+    model = openstudio.model.Model()
+    for i in range(spaces):
+        space_type = openstudio.model.SpaceType(model)
+        space_type.setName(f"Seed Space Type {i}")
+        space = openstudio.model.Space(model)
+        space.setName(f"Seed Space {i}")
+        space.setSpaceType(space_type)
+        zone = openstudio.model.ThermalZone(model)
+        space.setThermalZone(zone)
+    return model
+
+
+def run_measure(model, workbook):
+    """AUSLibrary.run on model with the library read from workbook, returns the Trace phases"""
+    measure = AUSLibrary(read_excel(workbook))
+    arguments = measure.arguments(model)
+    argument_map = openstudio.measure.convertOSArgumentVectorToMap(arguments)
+    runner = openstudio.measure.OSRunner(openstudio.WorkflowJSON())
+    start = time.perf_counter()
+    if not measure.run(model, runner, argument_map):
+        raise RuntimeError("; ".join(e.logMessage() for e in runner.result().errors()))
+    seconds = time.perf_counter() - start
+    phases = {}
+    for value in runner.result().stepValues():
+        if value.name().endswith("_seconds") and value.name() != "total_seconds":
+            phases[value.name()[:-len("_seconds")]] = value.valueAsDouble()
+    phases["run"] = seconds
+    return phases
+
+
+def benchmark(workbook, seeds: dict, repeat: int):
+    """best time of each phase over repeat runs, {(seed, phase): seconds}"""
+    best = {}
+
+    def _keep(seed, phase, seconds):
+        best[(seed, phase)] = min(seconds, best.get((seed, phase), float("inf")))
+
+    # the cached load below should not pay for writing the cache
+    read_excel(workbook)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sheets = read_excel(workbook, use_cache=False)
+        _keep("-", "load_uncached", time.perf_counter() - start)
+        start = time.perf_counter()
+        read_excel(workbook)
+        _keep("-", "load_cached", time.perf_counter() - start)
+        start = time.perf_counter()
+        compile_schedules(sheets["schedules"])
+        _keep("-", "compile_schedules", time.perf_counter() - start)
+        for seed, make_seed in seeds.items():
+            for phase, seconds in run_measure(make_seed(), workbook).items():
+                _keep(seed, phase, seconds)
+    return best
+
+
+def compare(results: list, baseline: list, threshold: float):
+    """print phases slower than baseline by more than threshold (a ratio), returns how many"""
+    previous = {(r["workbook"], r["seed"], r["phase"]): r["seconds"] for r in baseline}
+    regressions = 0
+    for r in results:
+        before = previous.get((r["workbook"], r["seed"], r["phase"]))
+        if not before:
+            continue
+        ratio = r["seconds"] / before
+        flag = ""
+        if ratio > 1 + threshold and r["seconds"] - before > 0.001:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{r['workbook']:>5} {r['seed']:>6} {r['phase']:<18} {before:9.4f}s -> {r['seconds']:9.4f}s  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AUSLibrary.run on scaled workbooks.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="workbook row multipliers (default: 1 10 100)")
+    parser.add_argument("--seed-spaces", type=int, default=2000, help="spaces in the large seed model (default: 2000)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best is kept (default: 3)")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown ratio reported as a regression (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    library = xlsx_to_json(SHEETS, RESOURCES_PATH)
+    seeds = {"empty": openstudio.model.Model, "large": lambda: large_seed(args.seed_spaces)}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            workbook = RESOURCES_PATH if scale == 1 else Path(tmp) / f"resources_{scale}x.xlsx"
+            if scale != 1:
+                write_workbook(workbook, scale_library(library, scale))
+            for (seed, phase), seconds in benchmark(workbook, seeds, args.repeat).items():
+                results.append({"workbook": f"{scale}x", "seed": seed, "phase": phase, "seconds": seconds})
+                print(f"{scale:>4}x {seed:>6} {phase:<18} {seconds:9.4f}s")
+
+    payload = {
+        "openstudio": openstudio.openStudioLongVersion(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed_spaces": args.seed_spaces,
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(payload, indent=2))
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text())["results"], args.threshold)
+        print(f"{regressions} regressions")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,11 @@
 """insert your copyright here."""
 
+import csv
+import json
+import os
+import shutil
+import stat
+import zipfile
 from pathlib import Path
 
 import openstudio
@@ -7,7 +13,71 @@ import pytest
 from inspect import getsourcefile
 from os.path import abspath
 
-from aus_library.measure import AUSLibrary
+from aus_library.measure import (
+    AUSLibrary,
+    LIBRARY_REGISTRY,
+    LibraryError,
+    RESOURCES_PATH,
+    Record,
+    SHEETS,
+    apply_to_files,
+    assign_space_types,
+    build_library,
+    cache_path,
+    check_columns,
+    clear_registry,
+    compile_profile,
+    compile_schedules,
+    create_complex_schedule,
+    create_construction_sets,
+    create_constructions,
+    create_materials,
+    create_space_types,
+    evict_prebuilt,
+    export_library,
+    fingerprint,
+    load_cache,
+    load_library,
+    load_report,
+    main,
+    make_schedule_files,
+    make_schedule_rulesets,
+    merge_library,
+    patch_file,
+    prebuilt_library,
+    prebuilt_path,
+    read_excel,
+    read_library,
+    render_library,
+    run_measure,
+    schedule_8760,
+    schedules_8760,
+    stale_export,
+    sweep,
+    xlsx_to_json,
+)
+
+
+def run_with(model, measure=None, **values):
+    """Run the measure on model with only the named arguments set, returns (result, runner)."""
+    measure = measure or AUSLibrary()
+    arguments = measure.arguments(model)
+    argument_map = openstudio.measure.convertOSArgumentVectorToMap(arguments)
+    for arg in arguments:
+        if arg.name() in values:
+            value = arg.clone()
+            assert value.setValue(values[arg.name()])
+            argument_map[arg.name()] = value
+    runner = openstudio.measure.OSRunner(openstudio.WorkflowJSON())
+    return measure.run(model, runner, argument_map), runner
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    """A copy of the shipped workbook, so the caches, prebuilt libraries and CSVs written beside it stay in tmp_path."""
+    path = tmp_path / "resources.xlsx"
+    shutil.copy(RESOURCES_PATH, path)
+    return path
 
 
 class TestAUSLibrary:
@@ -23,10 +93,10 @@ class TestAUSLibrary:
 
         # get arguments and test that they are what we are expecting
         arguments = measure.arguments(model)
-        assert arguments.size() == 1
-        assert arguments[0].name() == "space_name"
+        assert [arg.name() for arg in arguments] == ["space_types", "workbook", "upsert", "remove_stale", "incremental", "prebuilt", "schedule_format",
+                                                    "assign_space_types", "library_registry", "stream_workbook", "load_report", "trace_file"]
 
-    def test_bad_argument_values(self):
+    def test_bad_argument_values(self, workbook):
         """Test running the measure with inappropriate arguments, and that the measure reports failure."""
         # create an instance of the measure
         measure = AUSLibrary()
@@ -46,7 +116,8 @@ class TestAUSLibrary:
         # If the argument has a default that you want to use,
         # you don't need it in the dict
         args_dict = {}
-        args_dict["space_name"] = ""
+        args_dict["space_types"] = "Not A Library Space Type"
+        args_dict["workbook"] = str(workbook)
 
         # populate argument with specified hash value if specified
         for arg in arguments:
@@ -64,9 +135,9 @@ class TestAUSLibrary:
         print(f"results: {result}")
 
         # assert that it failed
-        #assert result.value().valueName() == "Fail"
+        assert result.value().valueName() == "Fail"
 
-    def test_good_argument_values(self):
+    def test_good_argument_values(self, tmp_path, workbook):
         """Test running the measure with appropriate arguments.
         Asserts that the measure runs fine and with expected results.
         """
@@ -100,7 +171,8 @@ class TestAUSLibrary:
         # If the argument has a default that you want to use,
         # you don't need it in the dict
         args_dict = {}
-        args_dict["space_name"] = "New Space"
+        args_dict["space_types"] = "All"
+        args_dict["workbook"] = str(workbook)
         # using defaults values from measure.py for other arguments
 
         # populate argument with specified hash value if specified
@@ -119,7 +191,7 @@ class TestAUSLibrary:
         print(f"results: {result}")
 
         # assert that it ran correctly
-        #assert result.value().valueName() == "Success"
+        assert result.value().valueName() == "Success"
         #assert len(result.info()) == 1
         #assert len(result.warnings()) == 0
 
@@ -134,6 +206,664 @@ class TestAUSLibrary:
 
         #output_file_path = openstudio.toPath(str(Path(__file__).parent.absolute() / "output" / "test_output.osm"))
 
-        output_file_path = Path(abspath(getsourcefile(lambda:0))).parent.joinpath("output/test_output.osm").resolve()
+        output_file_path = tmp_path / "test_output.osm"
 
         model.save(output_file_path, True)
+
+    def test_read_excel_cache(self, workbook):
+        """Test that the compiled workbook cache is written, reused and invalidated."""
+
+        assert load_cache(workbook) is None
+        sheets = read_excel(workbook)
+        assert cache_path(workbook).exists()
+        assert load_cache(workbook) == sheets
+        assert read_excel(workbook, use_cache=False) == sheets
+
+        # a new mtime with the same content is still a cache hit
+        stat = os.stat(workbook)
+        os.utime(workbook, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert load_cache(workbook) == sheets
+
+        # different content invalidates the cache
+        with open(workbook, "ab") as f:
+            f.write(b"\0")
+        assert load_cache(workbook) is None
+
+    def test_records(self, workbook):
+        """Rows are Records sharing their sheet's columns that read, compare and hash like the dicts they replace."""
+        lights = read_excel(workbook, use_cache=False)["lights"]
+        assert all(isinstance(r, Record) for r in lights)
+        assert len({id(r._columns) for r in lights}) == 1
+        row = dict(lights[0])
+        assert lights[0] == row and lights[0].get("Adjusted IPD") == row["Adjusted IPD"] and lights[0].get("missing") is None
+        assert fingerprint(lights) == fingerprint([dict(r) for r in lights])
+        assert not hasattr(lights[0], "__dict__")
+
+        check_columns("equipment", [Record({"description": 0, "W/m2": 1}, ("Office", 10))])
+        with pytest.raises(ValueError, match="W/m2"):
+            check_columns("equipment", [Record({"description": 0}, ("Office",))])
+
+    def test_library_registry(self, tmp_path, monkeypatch):
+        """Test that parsed workbooks are kept per path and content, evicted least recently used first and can be bypassed."""
+        clear_registry()
+        workbooks = [tmp_path / f"zone{i}.xlsx" for i in range(3)]
+        for workbook in workbooks:
+            shutil.copy(RESOURCES_PATH, workbook)
+
+        entry = load_library(workbooks[0])
+        assert load_library(workbooks[0]) is entry
+        assert load_library(workbooks[1]) is not entry
+        stat = os.stat(workbooks[0])
+        os.utime(workbooks[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert load_library(workbooks[0]) is entry
+        with open(workbooks[0], "ab") as f:
+            f.write(b"\0")
+        assert load_library(workbooks[0]) is not entry
+        assert load_library(workbooks[2], use_registry=False) is not load_library(workbooks[2], use_registry=False)
+
+        monkeypatch.setattr("aus_library.measure.REGISTRY_SIZE", 2)
+        clear_registry()
+        first = load_library(workbooks[0])
+        load_library(workbooks[1])
+        load_library(workbooks[0])
+        load_library(workbooks[2])
+        assert [entry["path"] for entry in LIBRARY_REGISTRY.values()] == [workbooks[0].resolve(), workbooks[2].resolve()]
+        assert load_library(workbooks[0]) is first
+
+        def _run(registry):
+            model = openstudio.model.Model()
+            assert run_with(model, workbook=str(workbooks[1]), library_registry=registry)[0]
+            return model
+
+        assert _run("Bypass").getSpaceTypeByName("Office").is_initialized()
+        assert workbooks[1].resolve() not in [entry["path"] for entry in LIBRARY_REGISTRY.values()]
+        _run("Use")
+        entry = next(entry for entry in LIBRARY_REGISTRY.values() if entry["path"] == workbooks[1].resolve())
+        assert entry["schedules"] is not None and "All" in entry["checks"]
+        _run("Clear")
+        assert len(LIBRARY_REGISTRY) == 1 and next(iter(LIBRARY_REGISTRY.values())) is not entry
+
+        # a selection only parses the sheets its closure reaches, the entry keeps them for later runs
+        clear_registry()
+        run_measure(openstudio.model.Model(), {"workbook": str(workbooks[1]), "space_types": "Warehouse"})
+        entry = next(iter(LIBRARY_REGISTRY.values()))
+        assert "space_types" in entry["sheets"] and not {"constructions", "materials"} & set(entry["sheets"])
+        run_measure(openstudio.model.Model(), {"workbook": str(workbooks[1])})
+        assert next(iter(LIBRARY_REGISTRY.values())) is entry and set(SHEETS) <= set(entry["sheets"])
+
+    def test_xlsx_loader_matches_pandas(self):
+        """Test that the stdlib workbook reader returns the same records as the pandas one."""
+        pytest.importorskip("pandas")
+        from aus_library.measure import sheets_to_json
+
+        assert xlsx_to_json(SHEETS) == sheets_to_json(SHEETS)
+
+    def test_stream_loader(self, tmp_path, workbook):
+        """Test that the streamed sheets hold the same records and build the same library."""
+        streamed = read_excel(workbook, loader="stream")
+        assert all(not isinstance(rows, list) for rows in streamed.values())
+        assert {sheet: list(rows) for sheet, rows in streamed.items()} == xlsx_to_json(SHEETS, workbook)
+
+        model = openstudio.model.Model()
+        build_library(model, read_excel(workbook, loader="stream"))
+        reference = openstudio.model.Model()
+        build_library(reference, read_excel(workbook))
+        assert model.numObjects() == reference.numObjects()
+
+        # the measure builds from the stream, each row checked as it is read
+        model = openstudio.model.Model()
+        run_measure(model, {"stream_workbook": True, "workbook": str(workbook)})
+        assert model.numObjects() == reference.numObjects()
+        with pytest.raises(LibraryError, match="cannot be combined with a space type selection, upsert"):
+            run_measure(openstudio.model.Model(), {"stream_workbook": True, "workbook": str(workbook), "space_types": "Office", "upsert": True})
+
+        # the aliases are read from the workbook, the stream leaves no registry entry
+        model = openstudio.model.Model()
+        space = openstudio.model.Space(model)
+        space.setName("Warehouse 2")
+        run_measure(model, {"stream_workbook": True, "workbook": str(workbook), "assign_space_types": True})
+        assert space.spaceType().get().nameString() == "Warehouse"
+
+        saturday = tmp_path / "saturday.xlsx"
+        with zipfile.ZipFile(workbook) as src, zipfile.ZipFile(saturday, "w") as dst:
+            for item in src.infolist():
+                data = src.read(item)
+                if item.filename == "xl/sharedStrings.xml":
+                    data = data.replace(b">weekend<", b">Saturday<")
+                dst.writestr(item, data)
+        with pytest.raises(LibraryError, match="day_type has to be one of"):
+            run_measure(openstudio.model.Model(), {"stream_workbook": True, "workbook": str(saturday)})
+
+    def test_selected_space_types(self, workbook):
+        """Test that only the dependency closure of the selected space types is built."""
+        data = read_library({"Warehouse"}, workbook)
+        assert [r["name"] for r in data["space_types"]] == ["Warehouse"]
+        assert [r["description"] for r in data["outdoor_air"]] == ["warehouse 10 L/s/person"]
+        assert [r["description"] for r in data["lights"]] == ["Wholesale : None  =1  4W/m2"]
+        assert len(data["people"]) == 1 and len(data["equipment"]) == 1
+        assert [r["name"] for r in data["schedule_sets"]] == ["Office"]
+
+        model = openstudio.model.Model()
+        assert run_with(model, space_types="Warehouse", workbook=str(workbook))[0]
+        assert [s.nameString() for s in model.getSpaceTypes()] == ["Warehouse"]
+        assert len(model.getLightsDefinitions()) == 1
+        assert len(model.getDesignSpecificationOutdoorAirs()) == 1
+        assert len(model.getDefaultScheduleSets()) == 1
+
+    def test_assign_space_types(self, workbook):
+        """Spaces get the library space type their name, story or alias matches, others are reported."""
+        model = openstudio.model.Model()
+        index = build_library(model, read_excel(workbook))
+        story = openstudio.model.BuildingStory(model)
+        story.setName("Warehouse level")
+        spaces = {}
+        for name in ["Office perimeter 2", "L1 office", "Store 3", "Lobby", "Plant room", "Bay 7"]:
+            spaces[name] = openstudio.model.Space(model)
+            spaces[name].setName(name)
+        spaces["Bay 7"].setBuildingStory(story)
+        aliases = [{"alias": "store", "space_type": "Warehouse"}, {"alias": "lobby", "space_type": "Office"},
+                   {"alias": "Lobby", "space_type": "Office internal"}, {"alias": "plant", "space_type": "Not In The Library"}]
+
+        assigned, unmatched, ambiguous = assign_space_types(model, index["space_types"], aliases)
+        assert assigned == 4
+        assert {name: space.spaceType().get().nameString() for name, space in spaces.items() if space.spaceType().is_initialized()} == {
+            "Office perimeter 2": "Office perimeter", "L1 office": "Office", "Store 3": "Warehouse", "Bay 7": "Warehouse"}
+        assert unmatched == ["Plant room"]
+        assert ambiguous == {"Lobby": ["Office", "Office internal"]}
+
+        # the example model's spaces match through the standards tags of their space type, on either build path
+        for prebuilt in [False, True]:
+            model = openstudio.osversion.VersionTranslator().loadModel(str(Path(__file__).parent / "example_model.osm")).get()
+            assert run_with(model, assign_space_types=True, prebuilt=prebuilt, workbook=str(workbook))[0]
+            assert {space.spaceType().get().nameString() for space in model.getSpaces()} == {"Office"}
+            assert all(space.spaceType().get().lights() for space in model.getSpaces())
+
+    def test_dangling_reference(self):
+        """Test that a space type naming a missing definition raises a readable error."""
+        model = openstudio.model.Model()
+        index = {"schedule_sets": {"Office": openstudio.model.DefaultScheduleSet(model)}, "lights": {}}
+        row = {"name": "Broken", "lights": "No Such Lights"}
+
+        with pytest.raises(LibraryError, match="space type 'Broken' references 'No Such Lights'"):
+            create_space_types(model, [row], index)
+
+    def test_validation(self, workbook):
+        """Test that every problem in the workbook is reported before the model is touched."""
+        library = read_excel(workbook)
+        library = dict(library,
+                       space_types=[dict(library["space_types"][0], lights="No Such Lights"), *library["space_types"][1:]],
+                       people=[dict(library["people"][0], **{"area per person": "ten"}), *library["people"][1:]],
+                       lights=[*library["lights"], dict(library["lights"][5], **{"Adjusted IPD": 9.0})],
+                       schedules=[dict(r, day_type="Saturday") if r["day_type"] == "weekend" else r for r in library["schedules"]])
+        model = openstudio.model.Model()
+        num_objects = model.numObjects()
+        ok, runner = run_with(model, AUSLibrary(library))
+        assert not ok
+        errors = [e.logMessage() for e in runner.result().errors()]
+        assert len(errors) == 3 + sum(r["day_type"] == "weekend" for r in read_excel(workbook)["schedules"])
+        assert any("day_type has to be one of weekdays, default, weekend, not 'Saturday'" in e for e in errors)
+        assert "space_types 'Office' references 'No Such Lights' but there is no such row in the lights sheet" in errors
+        assert any("area per person has to be a number" in e for e in errors)
+        assert any("appears more than once with different values" in e for e in errors)
+        assert model.numObjects() == num_objects
+
+    def test_upsert_rerun(self, workbook):
+        """Test that re-running in upsert mode reuses the library objects instead of duplicating them."""
+        model = openstudio.model.Model()
+        assert run_with(model, upsert=True, workbook=str(workbook))[0]
+        num_objects = model.numObjects()
+
+        ok, runner = run_with(model, upsert=True, workbook=str(workbook))
+        assert ok
+        assert model.numObjects() == num_objects
+        assert len(model.getSpaceTypes()) == 4
+        assert "created: 0, updated: 0" in runner.result().info()[-1].logMessage()
+
+        # a changed definition is updated in place
+        lights = model.getLightsDefinitionByName("Office int: None  =1  4.5W/m2").get()
+        lights.additionalProperties().setFeature("aus_library_fingerprint", "stale")
+        ok, runner = run_with(model, upsert=True, workbook=str(workbook))
+        assert ok
+        assert model.numObjects() == num_objects
+        assert "created: 0, updated: 1" in runner.result().info()[-1].logMessage()
+
+        # objects whose row left the workbook are removed on request
+        gone = openstudio.model.LightsDefinition(model)
+        gone.additionalProperties().setFeature("aus_library_sheet", "lights")
+        gone.additionalProperties().setFeature("aus_library_key", "Not In The Workbook")
+        gone.additionalProperties().setFeature("aus_library_fingerprint", "")
+        ok, runner = run_with(model, upsert=True, remove_stale=True, workbook=str(workbook))
+        assert ok
+        assert model.numObjects() == num_objects
+        assert "removed: 1" in runner.result().info()[-1].logMessage()
+
+        # without upsert nothing is removed and the run says so
+        gone = openstudio.model.LightsDefinition(model)
+        gone.additionalProperties().setFeature("aus_library_sheet", "lights")
+        gone.additionalProperties().setFeature("aus_library_key", "Not In The Workbook")
+        ok, runner = run_with(model, remove_stale=True, workbook=str(workbook))
+        assert ok and model.getLightsDefinition(gone.handle()).is_initialized()
+        assert "remove_stale only applies together with upsert, no objects are removed." in [w.logMessage() for w in runner.result().warnings()]
+
+        # a library handed to the measure is the one stale objects are checked against
+        library = read_excel(workbook)
+        library["space_types"] = [r for r in library["space_types"] if r["name"] != "Warehouse"]
+        ok, runner = run_with(model, AUSLibrary(library), upsert=True, remove_stale=True)
+        assert ok
+        # the Warehouse space type and the lights definition left over from the run without upsert
+        assert "removed: 2" in runner.result().info()[-1].logMessage()
+        assert model.getSpaceTypeByName("Warehouse").is_initialized() is False
+
+    def test_incremental_apply(self, workbook):
+        """Test that an incremental run rebuilds only the rows changed since the last one."""
+        library = read_excel(workbook)
+        model = openstudio.model.Model()
+
+        def _run(library):
+            ok, runner = run_with(model, AUSLibrary(library), upsert=True, incremental=True)
+            assert ok
+            return runner.result().info()[-1].logMessage()
+
+        _run(library)
+        num_objects = model.numObjects()
+        assert "created: 0, updated: 0, unchanged: 0" in _run(library)
+        assert model.numObjects() == num_objects
+
+        # an edited definition is updated in place, the space type using it is only checked
+        edited = dict(library, lights=[dict(r, **{"Adjusted IPD": 6.0}) if r["description"] == "Office int: None  =1  4.5W/m2" else r
+                                       for r in library["lights"]])
+        assert "created: 0, updated: 1, unchanged: 1" in _run(edited)
+        assert model.getLightsDefinitionByName("Office int: None  =1  4.5W/m2").get().wattsperSpaceFloorArea().get() == 6.0
+
+        # an edited schedule reaches the schedule set that uses it
+        schedules = [dict(r, value=0.5) if r["space_type"] == "Class 5 Office building" and r["schedule_type"] == "Lighting" else r
+                     for r in edited["schedules"]]
+        assert "created: 0, updated: 0" not in _run(dict(edited, schedules=schedules))
+        schedule_set = model.getSpaceTypeByName("Office").get().defaultScheduleSet().get()
+        assert list(schedule_set.lightingSchedule().get().to_ScheduleRuleset().get().defaultDaySchedule().values()) == [0.5]
+
+        # a deleted object is rebuilt and its dependents re-pointed
+        num_objects = model.numObjects()
+        model.getSpaceTypeByName("Office").get().designSpecificationOutdoorAir().get().remove()
+        assert "created: 1" in _run(dict(edited, schedules=schedules))
+        assert model.getSpaceTypeByName("Office").get().designSpecificationOutdoorAir().is_initialized()
+        assert model.numObjects() == num_objects
+
+        # without upsert there is nothing to compare against, the full build says so
+        fresh = openstudio.model.Model()
+        ok, runner = run_with(fresh, AUSLibrary(library), incremental=True)
+        assert ok and len(fresh.getSpaceTypes()) == len(library["space_types"])
+        assert "incremental only applies together with upsert, the whole library is built." in [w.logMessage() for w in runner.result().warnings()]
+
+    def test_batch_apply(self, tmp_path, workbook):
+        """A batch keeps going past a model that fails and saves the others."""
+        seeds = tmp_path / "seeds"
+        seeds.mkdir()
+        shutil.copy(Path(__file__).parent / "example_model.osm", seeds / "good.osm")
+        (seeds / "broken.osm").write_text("not a model")
+
+        outcomes = list(apply_to_files(sorted(seeds.glob("*.osm")), tmp_path / "out", {"space_types": "Warehouse", "workbook": str(workbook)}, workers=1))
+        outcomes = {Path(o["seed"]).name: o for o in outcomes}
+
+        assert not outcomes["broken.osm"]["ok"]
+        assert outcomes["good.osm"]["ok"], outcomes["good.osm"]["message"]
+        model = openstudio.osversion.VersionTranslator().loadModel(str(tmp_path / "out" / "good.osm")).get()
+        assert model.getSpaceTypeByName("Warehouse").is_initialized()
+
+        # the same file name in two folders gets two outputs, the same seed twice only one
+        for folder in ["a", "b"]:
+            (seeds / folder).mkdir()
+            shutil.copy(seeds / "good.osm", seeds / folder / "in.osm")
+        jobs = [seeds / "a" / "in.osm", seeds / "b" / "in.osm", seeds / "b" / ".." / "b" / "in.osm"]
+        outcomes = list(apply_to_files(jobs, tmp_path / "nested", {"space_types": "Warehouse", "workbook": str(workbook)}, workers=2))
+        assert sorted(o["output"] for o in outcomes if o["ok"]) == [str(tmp_path / "nested" / f / "in.osm") for f in ["a", "b"]]
+        assert [o["message"] for o in outcomes if not o["ok"]] == [f"{tmp_path / 'nested' / 'b' / 'in.osm'} is already the output of another seed"]
+
+    def test_text_patch(self, tmp_path, monkeypatch, workbook):
+        """Appending the rendered library to the seed text gives the objects the measure adds to the loaded model."""
+        example = Path(__file__).parent / "example_model.osm"
+        with pytest.raises(LibraryError, match="VersionTranslator"):
+            patch_file(example, tmp_path / "old.osm", {"workbook": str(workbook)})
+        assert not (tmp_path / "old.osm").exists() and not (tmp_path / "files").exists()
+
+        # OpenStudio's files directory for a model without a workflow path is in the working directory, nothing goes there
+        cwd = tmp_path / "cwd"
+        cwd.mkdir()
+        monkeypatch.chdir(cwd)
+        seeds = tmp_path / "seeds"
+        seeds.mkdir()
+        model = openstudio.osversion.VersionTranslator().loadModel(str(example)).get()
+        model.save(str(seeds / "seed.osm"), True)
+
+        def _names(path):
+            model = openstudio.model.Model.load(str(path)).get()
+            return sorted((o.iddObject().name(), o.nameString()) for o in model.objects())
+
+        for schedule_format in ["Ruleset", "ScheduleFile"]:
+            options = {"space_types": "Office,Warehouse", "schedule_format": schedule_format, "workbook": str(workbook)}
+            for text_patch in [False, True]:
+                outcome, = apply_to_files([seeds / "seed.osm"], tmp_path / str(text_patch), dict(options, text_patch=text_patch))
+                assert outcome["ok"], outcome["message"]
+            assert _names(tmp_path / "True" / "seed.osm") == _names(tmp_path / "False" / "seed.osm")
+        # both keep the ScheduleFile CSV beside the output, where a workflow next to it looks
+        assert [p.name for p in (tmp_path / "True" / "files").iterdir()] == [p.name for p in (tmp_path / "False" / "files").iterdir()]
+        assert not list(cwd.iterdir())
+
+        # re-applied to models that already hold the library, the text patch, the loaded model and the prebuilt
+        # merge number their suffixes alike ("weekend 11")
+        options = {"space_types": "Office,Warehouse", "workbook": str(workbook)}
+        for text_patch, prebuilt in [(False, False), (True, False), (False, True)]:
+            seed = seeds / "seed.osm"
+            for run in range(2):
+                folder = tmp_path / f"again-{text_patch}-{prebuilt}-{run}"
+                outcome, = apply_to_files([seed], folder, dict(options, text_patch=text_patch, prebuilt=prebuilt))
+                assert outcome["ok"], outcome["message"]
+                seed = folder / "seed.osm"
+        again = [_names(tmp_path / f"again-{text_patch}-{prebuilt}-1" / "seed.osm") for text_patch, prebuilt in [(False, False), (True, False), (False, True)]]
+        assert again[0] == again[1] == again[2]
+        assert ("OS:Schedule:Rule", "weekend 11") in again[0]
+
+        with pytest.raises(LibraryError, match="upsert"):
+            patch_file(seeds / "seed.osm", tmp_path / "upsert.osm", {"upsert": True})
+
+    def test_export_library(self, tmp_path, workbook):
+        """The export holds the whole library, is reused while the workbook is unchanged and goes stale with it."""
+        out = tmp_path / "export"
+        assert stale_export(out, workbook)
+
+        manifest = export_library(out, workbook, components=True)
+        assert stale_export(out, workbook) is None
+        model = openstudio.model.Model.load(str(out / manifest["file"])).get()
+        assert len(model.getSpaceTypes()) == manifest["objects"]["OS:SpaceType"] == manifest["rows"]["space_types"]
+        assert sum(manifest["objects"].values()) == len(model.objects())
+        component = openstudio.model.Component.load(str(out / manifest["components"][0])).get()
+        assert openstudio.model.Model().insertComponent(component).is_initialized()
+        assert export_library(out, workbook) == manifest
+
+        shutil.copy(Path(__file__).parent / "example_model.osm", workbook)
+        assert "changed" in stale_export(out, workbook)
+
+    def test_sweep(self, tmp_path, capsys, workbook):
+        """Every variant is the library applied once with only its scaled definition values changed."""
+        variants = {"base": {}, "lpd80": {"lights": 0.8}, "dense": {"equipment": 1.2, "people": 0.5, "outdoor_air": 2.0}}
+        outcomes = list(sweep(Path(__file__).parent / "example_model.osm", tmp_path, variants, {"space_types": "Office", "workbook": str(workbook)}))
+        assert all(o["ok"] for o in outcomes), outcomes
+
+        def _values(name):
+            model = openstudio.model.Model.load(str(tmp_path / f"{name}.osm")).get()
+            office = model.getSpaceTypeByName("Office").get()
+            return (office.lights()[0].lightsDefinition().wattsperSpaceFloorArea().get(),
+                    office.electricEquipment()[0].electricEquipmentDefinition().wattsperSpaceFloorArea().get(),
+                    office.people()[0].peopleDefinition().spaceFloorAreaperPerson().get(),
+                    office.designSpecificationOutdoorAir().get().outdoorAirFlowperPerson())
+
+        lights, equipment, area_per_person, outdoor_air = _values("base")
+        assert _values("lpd80") == pytest.approx((lights * 0.8, equipment, area_per_person, outdoor_air))
+        assert _values("dense") == pytest.approx((lights, equipment * 1.2, area_per_person * 0.5, outdoor_air * 2.0))
+
+        # names are file names in the output directory, checked before anything runs
+        for name in ["../escaped", "sub/dir", ".."]:
+            with pytest.raises(LibraryError, match="has to be a plain file name"):
+                next(sweep(Path(__file__).parent / "example_model.osm", tmp_path / "bad", {name: {"lights": 0.8}}, {}))
+        assert not (tmp_path / "bad").exists() and not (tmp_path / "escaped.osm").exists()
+        with pytest.raises(SystemExit):
+            main(["sweep", str(Path(__file__).parent / "example_model.osm"), "-o", str(tmp_path / "bad"),
+                  "-v", "lpd80:lights=0.8", "-v", "lpd80:lights=0.5"])
+        assert "repeated: lpd80" in capsys.readouterr().err
+
+    def test_prebuilt_library(self, tmp_path, workbook):
+        """Merging the prebuilt library gives the objects the per-object path builds and can be repeated."""
+
+        def _run(prebuilt):
+            model = openstudio.osversion.VersionTranslator().loadModel(str(Path(__file__).parent / "example_model.osm")).get()
+            assert run_with(model, prebuilt=prebuilt, workbook=str(workbook))[0]
+            return model
+
+        def _names(model):
+            return sorted((o.iddObject().name(), o.nameString()) for o in model.objects())
+
+        built, merged = _run(False), _run(True)
+        assert _names(built) == _names(merged)
+        office = merged.getSpaceTypeByName("Office").get()
+        assert office.defaultScheduleSet().get().hoursofOperationSchedule().is_initialized()
+        assert len(office.lights()) == 1
+
+        num_objects = merged.numObjects()
+        added = merge_library(merged, prebuilt_library(read_excel(workbook), workbook))
+        assert merged.numObjects() == num_objects + len(added)
+        assert merged.getSpaceTypeByName("Office 2").get().defaultScheduleSet().is_initialized()
+
+        # a prebuilt library per selection, only the PREBUILT_SIZE most recently used stay
+        libraries = [prebuilt_path(read_library({name}, workbook), workbook) for name in ["Office", "Warehouse", "Office internal"]]
+        for name in ["Office", "Warehouse", "Office internal"]:
+            prebuilt_library(read_library({name}, workbook), workbook)
+        assert all(path.exists() for path in libraries)
+        prebuilt_library(read_library({"Office"}, workbook), workbook)
+        evict_prebuilt(workbook, keep=2)
+        assert [path.exists() for path in libraries] == [True, False, True]
+        assert len(list(tmp_path.glob("resources.*.osm"))) == 2
+
+    def test_render_library(self, workbook):
+        """The rendered library holds the objects and field values build_library creates."""
+        def _objects(model):
+            names = {str(o.handle()): o.nameString() for o in model.objects()}
+            return sorted((o.iddObject().name(), *(names.get(o.getString(i).get(), o.getString(i).get()) for i in range(1, o.numFields())))
+                          for o in model.objects())
+
+        data = read_excel(workbook)
+        for schedule_format in ["Ruleset", "ScheduleFile"]:
+            built, merged = openstudio.model.Model(), openstudio.model.Model()
+            build_library(built, data, schedule_format=schedule_format, year=2009, path=workbook)
+            merge_library(merged, render_library(data, schedule_format=schedule_format, year=2009, path=workbook))
+            assert _objects(built) == _objects(merged)
+
+    def test_schedule_dedupe(self, workbook):
+        """Day profiles are compiled to runs and identical schedules share one ruleset."""
+        profile = compile_profile([(480, 0.0), (540, 0.0), (1020, 1.0), (1440, 0.0)], "day")
+        assert list(profile["minutes"]) == [540, 1020, 1440]
+        assert list(profile["values"]) == [0.0, 1.0, 0.0]
+
+        rows = read_excel(workbook, sheets=["schedules"])["schedules"]
+        rows = rows + [dict(r, space_type="Class 6 Office") for r in rows]
+        model = openstudio.model.Model()
+        rulesets = make_schedule_rulesets(model, compile_schedules(rows))
+        assert rulesets["Class6Office-Lighting"] == rulesets["Class5Officebuilding-Lighting"]
+        assert len(model.getScheduleRulesets()) == len(rulesets) // 2
+
+        # a weekend equal to the weekday profile needs no rule
+        flat = [dict(r, space_type="Flat", value=1.0) for r in rows if r["space_type"] == "Class 6 Office"]
+        ruleset = make_schedule_rulesets(model, compile_schedules(flat))["Flat-Occupancy"]
+        assert list(ruleset.defaultDaySchedule().values()) == [1.0]
+        assert len(ruleset.scheduleRules()) == 0
+
+    def test_constructions(self):
+        """Materials are built once per name and shared by the constructions and sets using them."""
+        materials = [
+            {"name": "Brick", "type": "StandardOpaqueMaterial", "roughness": "Rough", "thickness": 0.11, "conductivity": 0.8,
+             "density": 1900.0, "specific_heat": 840.0},
+            {"name": "Plasterboard", "roughness": "Smooth", "thickness": 0.013, "conductivity": 0.17, "density": 800.0,
+             "specific_heat": 1090.0},
+            {"name": "Cavity", "type": "AirGap", "thermal_resistance": 0.17},
+            {"name": "Clear", "type": "SimpleGlazing", "u_factor": 5.8, "shgc": 0.8, "visible_transmittance": 0.88},
+            {"name": "Brick", "type": "StandardOpaqueMaterial", "roughness": "Rough", "thickness": 0.11, "conductivity": 0.8,
+             "density": 1900.0, "specific_heat": 840.0},
+        ]
+        constructions = [
+            {"name": "Cavity Brick", "material": "Brick"},
+            {"name": "Cavity Brick", "material": "Cavity"},
+            {"name": "Cavity Brick", "material": "Brick"},
+            {"name": "Cavity Brick", "material": "Plasterboard"},
+            {"name": "Stud Wall", "material": "Plasterboard"},
+            {"name": "Stud Wall", "material": "Plasterboard"},
+            {"name": "Single Glazing", "material": "Clear"},
+        ]
+        model = openstudio.model.Model()
+        built = create_materials(model, materials)
+        assert len(model.getMaterials()) == 4
+        assert built["Brick"].to_StandardOpaqueMaterial().get().thickness() == 0.11
+
+        built = create_constructions(model, constructions, built)
+        layers = built["Cavity Brick"].layers()
+        assert [m.nameString() for m in layers] == ["Brick", "Cavity", "Brick", "Plasterboard"]
+        assert layers[0].handle() == layers[2].handle()
+        assert built["Stud Wall"].layers()[0].handle() == layers[3].handle()
+
+        sets = create_construction_sets(model, [{"name": "Office", "exterior_wall": "Cavity Brick", "interior_wall": "Stud Wall",
+                                                 "fixed_window": "Single Glazing"}], built)
+        exterior = sets["Office"].defaultExteriorSurfaceConstructions().get()
+        assert exterior.wallConstruction().get().nameString() == "Cavity Brick"
+        assert not exterior.roofCeilingConstruction().is_initialized()
+        windows = sets["Office"].defaultExteriorSubSurfaceConstructions().get()
+        assert windows.fixedWindowConstruction().get().nameString() == "Single Glazing"
+        assert not sets["Office"].defaultGroundContactSurfaceConstructions().is_initialized()
+
+        with pytest.raises(LibraryError, match="different properties"):
+            create_materials(model, [materials[0], dict(materials[0], thickness=0.22)])
+        with pytest.raises(LibraryError, match="no such row in the materials sheet"):
+            create_constructions(model, [{"name": "Bad", "material": "Concrete"}], {})
+
+    def test_schedule_validation(self):
+        """Profiles must increase, end at 24:00 and respect the schedule type limits."""
+        with pytest.raises(LibraryError, match="times must increase"):
+            compile_profile([(600, 0.0), (540, 1.0), (1440, 0.0)], "day")
+        with pytest.raises(LibraryError, match="has to end at 24:00"):
+            compile_profile([(600, 0.0), (1380, 1.0)], "day")
+        with pytest.raises(LibraryError, match="outside the Lighting limits"):
+            compile_profile([(600, 0.0), (1440, 1.5)], "day", "Lighting")
+        assert list(compile_profile([(600, 0.0), (1440, 21.0)], "day", "Heating Setpoint")["values"]) == [0.0, 21.0]
+
+        # an unknown day type is refused before the ruleset is touched
+        model = openstudio.model.Model()
+        day = compile_profile([(1440, 1.0)], "day")
+        with pytest.raises(LibraryError, match="unknown day type 'Saturday'"):
+            make_schedule_rulesets(model, {"Office-Lighting": {"weekdays": day, "Saturday": day}})
+        assert not model.getScheduleRules()
+
+        ruleset = create_complex_schedule(model, {"name": "Complex", "default_day": ["weekday", [8.5, 0.0], [24.0, 1.0]]})
+        assert [str(t) for t in ruleset.defaultDaySchedule().times()] == ["08:30:00", "24:00:00"]
+
+    def test_trace(self, tmp_path, workbook):
+        """Each phase reports its time, objects and lookups and the trace file has the same phases."""
+        model = openstudio.model.Model()
+        ok, runner = run_with(model, trace_file=str(tmp_path / "trace.json"), workbook=str(workbook))
+        assert ok
+
+        trace = json.loads((tmp_path / "trace.json").read_text())
+        phases = {p["phase"]: p for p in trace["phases"]}
+        assert list(phases) == ["read", "validate", "schedules", "schedule_sets", "people", "lights", "equipment", "infiltration", "outdoor_air",
+                                "materials", "constructions", "construction_sets", "space_types"]
+        assert sum(p["objects"] for p in trace["phases"]) == model.numObjects()
+        assert phases["space_types"]["lookups"] > 0
+        values = {v.name() for v in runner.result().stepValues()}
+        assert {"space_types_seconds", "space_types_objects", "space_types_lookups", "total_seconds"} <= values
+
+    def test_schedule_8760(self, workbook):
+        """Rulesets expand to hourly values with rules applied by date range, weekday and priority."""
+        pytest.importorskip("numpy")
+        model = openstudio.model.Model()
+        ruleset = openstudio.model.ScheduleRuleset(model, 0.0)
+        ruleset.defaultDaySchedule().addValue(openstudio.Time(0, 8, 30, 0), 0.0)
+        ruleset.defaultDaySchedule().addValue(openstudio.Time(0, 24, 0, 0), 1.0)
+        weekend = openstudio.model.ScheduleRule(ruleset)
+        weekend.setApplySaturday(True)
+        weekend.setApplySunday(True)
+        weekend.daySchedule().addValue(openstudio.Time(0, 24, 0, 0), 0.25)
+        # higher priority than the weekend rule, January only
+        january = openstudio.model.ScheduleRule(ruleset)
+        january.setApplySaturday(True)
+        january.setStartDate(openstudio.Date(openstudio.MonthOfYear(1), 1))
+        january.setEndDate(openstudio.Date(openstudio.MonthOfYear(1), 31))
+        january.daySchedule().addValue(openstudio.Time(0, 24, 0, 0), 0.5)
+        ruleset.setScheduleRuleIndex(january, 0)
+
+        values = schedule_8760(ruleset)
+        assert values.shape == (8760,)
+        # 2009 starts on a Thursday, 08:00-09:00 is half on
+        assert list(values[7:10]) == [0.0, 0.5, 1.0]
+        assert values[2 * 24] == 0.5  # Saturday 3 January
+        assert values[3 * 24] == 0.25  # Sunday 4 January
+        assert values[37 * 24] == 0.25  # Saturday 7 February
+        assert schedule_8760(ruleset) is values
+
+        # HVAC runs 07:00-18:00 on the 261 weekdays of 2009
+        library = openstudio.model.Model()
+        build_library(library, read_excel(workbook))
+        hvac = schedules_8760(library)["Class5Officebuilding-HVAC"]
+        assert hvac.sum() == 11 * 261
+
+    def test_load_report(self, tmp_path, workbook):
+        """Space values match OpenStudio's own sums, space types are checked against the workbook and the measure writes the report."""
+        np = pytest.importorskip("numpy")
+        model = openstudio.osversion.VersionTranslator().loadModel(str(Path(__file__).parent / "example_model.osm")).get()
+        data = read_excel(workbook)
+        index = build_library(model, data)
+        space_types = list(index["space_types"].values())
+        for i, space in enumerate(model.getSpaces()):
+            space.setSpaceType(space_types[i % len(space_types)])
+        report = load_report(model, data, index["space_types"])
+
+        spaces = {row["name"]: row for row in report["spaces"]}
+        for space in model.getSpaces():
+            row = spaces[space.nameString()]
+            assert np.allclose([row["lighting_w_m2"], row["equipment_w_m2"], row["m2_per_person"], row["infiltration_ach"]],
+                               [space.lightingPowerPerFloorArea(), space.electricEquipmentPowerPerFloorArea(),
+                                space.floorAreaPerPerson(), space.infiltrationDesignAirChangesPerHour()])
+        library = [row for row in report["space_types"] if "mismatches" in row]
+        assert len(library) == len(data["space_types"]) and not any(row["mismatches"] for row in library)
+
+        index["lights"]["Office int: None  =1  4.5W/m2"].setWattsperSpaceFloorArea(6.0)
+        office = next(row for row in load_report(model, data, index["space_types"])["space_types"] if row["name"] == "Office")
+        assert office["mismatches"] == ["lighting_w_m2"] and office["expected_lighting_w_m2"] == 4.5
+
+        run_measure(openstudio.model.Model(), {"workbook": str(workbook), "schedule_format": "ScheduleFile",
+                                               "load_report": str(tmp_path / "report.csv")})
+        with open(tmp_path / "report.csv", newline="") as f:
+            rows = list(csv.DictReader(f))
+        assert {row["name"] for row in rows if row["level"] == "space_type"} == {row["name"] for row in data["space_types"]}
+        assert not any(row["mismatches"] for row in rows)
+        assert all(float(row["lighting_eflh"]) > 0 for row in rows)
+
+    def test_schedule_files(self, tmp_path, monkeypatch, workbook):
+        """ScheduleFile columns hold the hourly values the rulesets expand to, identical schedules share one."""
+        np = pytest.importorskip("numpy")
+        # OpenStudio's files directory for a model without a workflow path is in the working directory, nothing goes there
+        cwd = tmp_path / "cwd"
+        cwd.mkdir()
+        monkeypatch.chdir(cwd)
+        rows = read_excel(workbook, sheets=["schedules"])["schedules"]
+        rows = rows + [dict(r, space_type="Class 6 Office") for r in rows]
+
+        model = openstudio.model.Model()
+        model.workflowJSON().setOswPath(str(tmp_path / "run" / "workflow.osw"))
+        files = make_schedule_files(model, compile_schedules(rows), path=workbook)
+        assert files["Class6Office-HVAC"] == files["Class5Officebuilding-HVAC"]
+        assert len(model.getScheduleFiles()) == len(files) // 2
+        assert len(model.getExternalFiles()) == 1
+
+        # the model names a copy in its workflow's files directory, the shared CSV stays readable for everyone
+        name = model.getExternalFiles()[0].fileName()
+        assert Path(name).name == name and (tmp_path / "run" / "files" / name).exists()
+        csv = workbook.with_name(name)
+        assert stat.S_IMODE(os.stat(csv).st_mode) == 0o644
+        columns = np.loadtxt(str(csv), delimiter=",", skiprows=1)
+        ruleset_model = openstudio.model.Model()
+        rulesets = make_schedule_rulesets(ruleset_model, compile_schedules(rows))
+        for name, schedule_file in files.items():
+            assert (columns[:, schedule_file.columnNumber() - 1] == schedule_8760(rulesets[name])).all()
+
+        # the CSV is only written once for the same schedules, a model without a workflow path uses it
+        # where it is instead of OpenStudio's files directory in the working directory
+        stamp = os.stat(str(csv)).st_mtime_ns
+        bare = openstudio.model.Model()
+        make_schedule_files(bare, compile_schedules(rows), path=workbook)
+        assert os.stat(str(csv)).st_mtime_ns == stamp
+        assert str(bare.workflowJSON().findFile(csv.name).get()) == str(csv)
+        assert not list(cwd.iterdir())
+
+        # the shared CSV is evicted with the prebuilt libraries, the model keeps its copy
+        evict_prebuilt(workbook, keep=0)
+        assert not csv.exists() and (tmp_path / "run" / "files" / csv.name).exists()
+
+        # a CSV that cannot be written is a library error the measure reports, not a traceback
+        with pytest.raises(LibraryError, match="could not write the schedule CSV"):
+            make_schedule_files(openstudio.model.Model(), compile_schedules(rows), path=tmp_path / "missing" / "resources.xlsx")